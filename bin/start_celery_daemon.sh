@@ -4,7 +4,9 @@
 # Workers 1, 2 and 3 will work together to manage the detect_provider queue
 # Workers 3, 4, 5 and 6 will work together to manage the provider_licence queue
 # Worker 7 will be responsible for processing the store_results queue
-# Worker 8 will be responsible for processing the flush_buffer queue
+# Worker 8 will be responsible for processing the flush_buffer queue.  Each partition
+# of the storage buffer (see BUFFER_PARTITIONS in config.py) can be flushed in parallel,
+# so give worker 8 a concurrency equal to the number of partitions (e.g. -c:8 4)
 # Worker 9 will be the priority detect_provider queue
 # Worker 10 will be the priority provider_licence queue
 # Worker 11 will be the priority store_results queue
@@ -14,6 +16,6 @@ celery multi start 11 -A openarticlegauge.slavedriver -l info --pidfile=%n.pid -
 # http://celery.readthedocs.org/en/latest/reference/celery.bin.multi.html
 
 # start a celery beat instance which will publish flush_buffer requests
-# to the flush_buffer queue (managed by Worker 8 above)
+# to the flush_buffer queue (managed by Worker 8 above), one for each partition of the buffer
 celery beat --app=openarticlegauge.slavedriver --pidfile=beat.pid --logfile=beat.log -l info --detach
 
@@ -2,20 +2,281 @@
 Implementation of all functions which allow the OAG application to interface with
 the cache.
 
-This cache implementation uses Redis as a key/value store in which to place json
-serialised copies of python data structures passed in.  Keys used are up to the
+This cache implementation uses Redis as a key/value store in which to place serialised
+(see the codec module) copies of python data structures passed in.  Keys used are up to the
 implementing code, but should be the canonical representations of the record being cached
 identifier.
 
+Cache entries belong to a generation.  Bumping the generation (see bump_generation)
+effectively empties the cache, as every process stops looking at the keys of the
+previous generation, which are then left to expire in their own time.  Generation 0
+(the generation before the first bump) uses the bare keys, and every later generation
+prefixes them with "g<generation>:".
+
+Optionally (see CACHE_L1_ENABLED in config), each process also keeps a small in-process
+cache of the records it has most recently retrieved from Redis, so that popular records
+don't cost a round trip to Redis every time they are looked up.  Whenever a record in
+Redis is changed or removed, its key is published on CACHE_INVALIDATION_CHANNEL, and every
+process which is holding a copy of it throws that copy away.
+
 """
 
 import redis, json, datetime, logging, models
-import config
+import os, time, marshal, threading
+from collections import OrderedDict
+import config, codec
 
 log = logging.getLogger(__name__)
 
 CLIENT = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
 
+# prefix for the keys which record that a record has been claimed by a lookup and
+# is in flight in the back-end
+INFLIGHT_PREFIX = "inflight_"
+
+# the current cache generation as last read from redis, and the time at which it was read
+_generation = (0, None)
+
+def _current_generation():
+    """
+    get the current cache generation, re-reading it from redis if we haven't done so
+    in the last config.CACHE_GENERATION_REFRESH seconds
+    
+    """
+    global _generation
+    generation, checked = _generation
+    now = time.time()
+    if checked is not None and now - checked < config.CACHE_GENERATION_REFRESH:
+        return generation
+    
+    s = CLIENT.get(config.CACHE_GENERATION_KEY)
+    latest = int(s) if s is not None else 0
+    if latest != generation:
+        # everything we're holding belongs to an old generation
+        L1.clear()
+    _generation = (latest, now)
+    return latest
+
+def _versioned(key):
+    """
+    get the redis key under which the entry for the given key is stored in the current generation
+    
+    """
+    generation = _current_generation()
+    if generation == 0:
+        return key
+    return "g" + str(generation) + ":" + key
+
+def bump_generation():
+    """
+    start a new generation of the cache, which effectively empties it.  Entries from
+    the previous generation are not deleted, but will no longer be used, and will expire
+    after config.REDIS_CACHE_TIMEOUT.  Other processes will see the new generation within
+    config.CACHE_GENERATION_REFRESH seconds
+    
+    returns:
+    the new generation
+    
+    """
+    global _generation
+    generation = CLIENT.incr(config.CACHE_GENERATION_KEY)
+    L1.clear()
+    _generation = (generation, time.time())
+    log.info("cache generation is now " + str(generation))
+    return generation
+
+class LocalCache(object):
+    """
+    Thread-safe, size bounded, least recently used cache with a time-to-live on each
+    entry, for holding the records retrieved from Redis within a single process.
+    
+    Records are held in marshalled form, which means that every call to get returns
+    a brand new copy of the record that the caller is free to modify, and that making
+    that copy is a great deal cheaper than parsing the JSON from Redis again.
+    
+    Every eviction (and clear) is numbered, so that a record read from Redis can be
+    refused if its key was evicted after the read started (see stamp), rather than
+    putting back a copy which an invalidation has already thrown away.
+    
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # the number of the latest eviction, and the number of the latest eviction of each
+        # key (for the most recently evicted keys).  Any read which started before the
+        # latest of the evictions we have forgotten, or the latest clear, is refused
+        self._sequence = 0
+        self._evictions = OrderedDict()
+        self._forgotten = 0
+    
+    def get(self, key):
+        """
+        get the python data structure stored under the given key
+        
+        arguments:
+        key -- the key to look up
+        
+        returns
+        - None if there is nothing stored under the key, or what is there has expired
+        - a copy of the python data structure otherwise
+        
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.time():
+                return None
+            # re-insert the entry to mark it as the most recently used
+            self._entries[key] = entry
+        return marshal.loads(data)
+    
+    def stamp(self):
+        """
+        get a stamp to pass to set, which should be taken before reading the record to
+        be set from Redis
+        
+        """
+        with self._lock:
+            return self._sequence
+    
+    def set(self, key, obj, stamp=None):
+        """
+        store the python data structure under the given key, evicting the least
+        recently used entry if the cache is full
+        
+        arguments:
+        key -- the key to store the object under
+        obj -- a python data structure of the kind produced by json.loads
+        stamp -- the stamp taken before obj was read.  If the key has been evicted since then,
+            obj may be out of date, and is not stored
+        
+        returns:
+        True if the object was stored, False if not
+        
+        """
+        if self.size <= 0:
+            return False
+        data = marshal.dumps(obj)
+        with self._lock:
+            if stamp is not None and stamp < max(self._evictions.get(key, 0), self._forgotten):
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, data)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return True
+    
+    def evict(self, key):
+        """
+        remove anything stored under the given key
+        
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._sequence += 1
+            self._evictions.pop(key, None)
+            self._evictions[key] = self._sequence
+            while len(self._evictions) > max(self.size, 1):
+                forgotten_key, sequence = self._evictions.popitem(last=False)
+                self._forgotten = sequence
+    
+    def clear(self):
+        """
+        remove everything from the cache
+        
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sequence += 1
+            self._evictions.clear()
+            self._forgotten = self._sequence
+    
+    def __len__(self):
+        return len(self._entries)
+
+L1 = LocalCache(config.CACHE_L1_SIZE, config.CACHE_L1_TTL)
+
+# the process id in which the invalidation listener was started.  Gunicorn and celery
+# fork their workers after this module is imported, so each worker has to start (and
+# subscribe) its own listener the first time it uses the in-process cache
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def _l1_active():
+    """
+    determine whether the in-process cache is to be used, starting the invalidation
+    listener for this process if it is and that has not already been done
+    
+    """
+    if not config.CACHE_L1_ENABLED:
+        return False
+    if _listener_pid != os.getpid():
+        _start_listener()
+    return True
+
+def _start_listener():
+    global _listener_pid
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        # anything in the cache was inherited from the parent process, whose
+        # invalidations we have not been listening to
+        L1.clear()
+        # subscribe before we return, so that no invalidation published after the
+        # first read from Redis can be missed
+        pubsub = _subscribe()
+        t = threading.Thread(target=_listen, args=(pubsub,), name="oag-cache-invalidation")
+        t.daemon = True
+        t.start()
+        _listener_pid = os.getpid()
+
+def _subscribe():
+    pubsub = CLIENT.pubsub()
+    pubsub.subscribe(config.CACHE_INVALIDATION_CHANNEL)
+    return pubsub
+
+def _listen(pubsub):
+    """
+    Listen for invalidations published by any process, and evict the keys concerned
+    from this process's in-process cache.  Runs forever in a daemon thread.
+    
+    """
+    while True:
+        try:
+            for message in pubsub.listen():
+                if message.get("type") == "message":
+                    L1.evict(message.get("data"))
+        except Exception as e:
+            log.error("lost connection to the cache invalidation channel: " + str(e))
+        
+        # we may have missed invalidations while we were disconnected, so we can't
+        # trust anything we're holding
+        L1.clear()
+        time.sleep(1)
+        try:
+            pubsub = _subscribe()
+        except Exception as e:
+            log.error("unable to re-subscribe to the cache invalidation channel: " + str(e))
+
+def _announce(keys):
+    """
+    evict the given keys from this process's in-process cache, and tell every other
+    process to do the same
+    
+    """
+    if not config.CACHE_L1_ENABLED:
+        return
+    pipe = CLIENT.pipeline(transaction=False)
+    for key in keys:
+        L1.evict(key)
+        pipe.publish(config.CACHE_INVALIDATION_CHANNEL, key)
+    pipe.execute()
+
 def check_cache(key):
     """
     check the cache for an object stored under the given key, and convert it
@@ -29,30 +290,99 @@ def check_cache(key):
     - A python data structure if one can be found, which will hopefully be a bibjson record if you stored it right
     
     """
+    rkey = _versioned(key)
+    l1 = _l1_active()
+    if l1:
+        obj = L1.get(key)
+        if obj is not None:
+            return models.MessageObject(record=obj)
+        stamp = L1.stamp()
+    
     # client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    s = CLIENT.get(key)
+    s = CLIENT.get(rkey)
     
     if s is None:
         return None
     
     try:
-        obj = json.loads(s)
+        obj = codec.decode(s)
     except ValueError as e:
         # cache is corrupt, just get rid of it
         invalidate(key)
         return None
     
+    if l1:
+        # unless it has been invalidated since we read it
+        L1.set(key, obj, stamp)
+    
     return models.MessageObject(record=obj)
+
+def check_cache_multi(keys):
+    """
+    check the cache for the objects stored under each of the given keys, resolving
+    all of them in a single round trip to the cache rather than one per key
+    
+    arguments:
+    keys -- list of keys to look up in the cache.  These should be the canonical identifiers of the items being looked up
+    
+    returns
+    a list of the same length as keys, where each entry is either None (if the object
+    couldn't be found in the cache, or there is an error with the cached object) or a
+    MessageObject for the corresponding key
+    
+    """
+    if len(keys) == 0:
+        return []
+    
+    results = [None] * len(keys)
+    rkeys = [_versioned(key) for key in keys]
+    
+    # answer what we can from the in-process cache, and only go to Redis for the rest
+    l1 = _l1_active()
+    misses = range(len(keys))
+    if l1:
+        misses = []
+        for i, key in enumerate(keys):
+            obj = L1.get(key)
+            if obj is None:
+                misses.append(i)
+            else:
+                results[i] = models.MessageObject(record=obj)
+        if len(misses) == 0:
+            return results
+        stamp = L1.stamp()
+    
+    strings = CLIENT.mget([rkeys[i] for i in misses])
+    
+    corrupt = []
+    for i, s in zip(misses, strings):
+        if s is None:
+            continue
+        try:
+            obj = codec.decode(s)
+        except ValueError as e:
+            # cache is corrupt, we'll get rid of it below
+            corrupt.append(keys[i])
+            continue
+        if l1:
+            L1.set(keys[i], obj, stamp)
+        results[i] = models.MessageObject(record=obj)
+    
+    if len(corrupt) > 0:
+        invalidate_multi(corrupt)
+    
+    return results
     
 def is_stale(record):
     """
-    Check to see if the bibjson record in the supplied record is stale.  Look
-    in bibjson['license'][n]['provenance']['date'] for all n.  If the newest date
-    is older than the stale time, then the record is stale.  If the record does
-    not have a licence, it is stale.
+    Check to see if the bibjson record in the supplied record is stale.  Records
+    which have been through store_results carry a precomputed freshness deadline
+    in bibjson['fresh_until'] (see calculate_fresh_until), and are stale once it
+    has passed.  Older records which lack it are checked by looking at the licence
+    dates directly.  If the record does not have a licence, it is stale.
     
     arguments:
-    bibjson -- a bibjson record in a python datastructure.  It may contain zero or more
+    record -- an OAG record object containing a bibjson record.  It may contain zero or more
         licence statements which meet the OAG specification for licence records (see the
         top level documentation for details)
     
@@ -65,16 +395,32 @@ def is_stale(record):
     if not record.has_license():
         return True
     
+    fresh_until = record.fresh_until
+    if fresh_until is None:
+        fresh_until = calculate_fresh_until(record)
+    
+    return fresh_until < time.time()
+
+def calculate_fresh_until(record):
+    """
+    Work out the time until which the bibjson record in the supplied record will be
+    fresh.  Look in bibjson['license'][n]['provenance']['date'] for all n.  The record
+    is fresh until the configured stale time has passed since the newest of those dates.
+    
+    arguments:
+    record -- an OAG record object containing a bibjson record
+    
+    returns:
+    the time (in seconds since the epoch) after which the record will be stale, or 0
+    if the record has no usable licence dates and is therefore necessarily stale
+    
+    """
     # get the date strings of all the licences
-    log.debug("stale check on: " + str(record.bibjson))
+    log.debug("freshness check on: " + str(record.bibjson))
     date_strings = [licence.get("provenance", {}).get("date") 
-                for licence in record.bibjson.get("license", []) 
+                for licence in record.license 
                 if licence.get("provenance", {}).get("date") is not None]
     
-    # check that there were any dates, if not then the record is necessarily stale
-    if len(date_strings) == 0:
-        return True
-    
     # convert all the viable date strings to datetimes
     dates = []
     for d in date_strings:
@@ -86,17 +432,11 @@ def is_stale(record):
     
     # check that at least one date has parsed, and if not assume that the record is stale
     if len(dates) == 0:
-        return True
-    
-    # get the most recent date by sorting the list (reverse, most recent date first)
-    dates.sort(reverse=True)
-    most_recent = dates[0]
+        return 0
     
-    # now determine if the most recent date is older or newer than the stale timeout
-    td = datetime.timedelta(seconds=config.licence_stale_time)
-    n = datetime.datetime.now()
-    stale_date = most_recent + td
-    return stale_date < n
+    # the licence dates are in local time, as is mktime
+    most_recent = max(dates)
+    return int(time.mktime(most_recent.timetuple())) + config.licence_stale_time
     
 def invalidate(key):
     """
@@ -107,11 +447,56 @@ def invalidate(key):
     
     """
     # client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    CLIENT.delete(key)
+    CLIENT.delete(_versioned(key))
+    _announce([key])
+
+def invalidate_multi(keys):
+    """
+    remove anything identified by any of the supplied keys from the cache
+    
+    arguments:
+    keys -- list of keys to be removed from the cache.  These should be the canonical identifiers of the records concerned
+    
+    """
+    if len(keys) == 0:
+        return
+    CLIENT.delete(*[_versioned(key) for key in keys])
+    _announce(keys)
     
+def claim_multi(keys):
+    """
+    attempt to take the exclusive claim on sending each of the records identified by
+    the supplied keys to the back-end.  A claim is held until it is released, or until
+    config.INFLIGHT_LEASE_TIMEOUT seconds have passed, whichever is sooner.
+    
+    arguments:
+    keys -- list of keys identifying the records to claim.  These should be the canonical identifiers of the records concerned
+    
+    returns
+    a list of the same length as keys, with True for each record which has been claimed by
+    this call, and False for each one which is already claimed by someone else
+    
+    """
+    if len(keys) == 0:
+        return []
+    pipe = CLIENT.pipeline(transaction=False)
+    for key in keys:
+        pipe.set(INFLIGHT_PREFIX + key, "1", ex=config.INFLIGHT_LEASE_TIMEOUT, nx=True)
+    return [bool(claimed) for claimed in pipe.execute()]
+
+def release(key):
+    """
+    release any claim on sending the record identified by the supplied key to the back-end
+    
+    arguments:
+    key -- the key identifying the record.  This should be the canonical identifier of the record concerned
+    
+    """
+    CLIENT.delete(INFLIGHT_PREFIX + key)
+
 def cache(key, record):
     """
-    take the provided python data structure, serialise it via json to a string, and
+    take the provided python data structure, serialise it to a string, and
     store it at the provided key with the appropriate timeout.  This may be
     required to create a new cache entry or update an existing one
     
@@ -121,14 +506,15 @@ def cache(key, record):
     
     """
     try:
-        s = record.json()
+        s = codec.encode(record.record)
     except TypeError:
         raise CacheException("can only cache python objects that can be sent through json.dumps")
     except AttributeError:
-        raise CacheException("record object does not support json() attribute - you should use a MessageObject")
+        raise CacheException("record object does not support record attribute - you should use a MessageObject")
     
     # client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
-    CLIENT.setex(key, config.REDIS_CACHE_TIMEOUT, s)
+    CLIENT.setex(_versioned(key), config.REDIS_CACHE_TIMEOUT, s)
+    _announce([key])
     
 class CacheException(Exception):
     """
@@ -42,9 +42,22 @@ CELERY_ROUTES = {
     'openarticlegauge.models.flush_buffer' : {'queue' : 'flush_buffer'},
     'openarticlegauge.workflow.priority_detect_provider' : {"queue" : "priority_detect_provider"},
     'openarticlegauge.workflow.priority_provider_licence' : {"queue" : "priority_provider_licence"},
-    'openarticlegauge.workflow.priority_store_results' : {"queue" : "priority_store_results"}
+    'openarticlegauge.workflow.priority_store_results' : {"queue" : "priority_store_results"},
+    'openarticlegauge.workflow.detect_provider_batch' : {"queue": "detect_provider"},
+    'openarticlegauge.workflow.provider_licence_batch' : {"queue" : "provider_licence"},
+    'openarticlegauge.workflow.store_results_batch' : {"queue" : "store_results"},
+    'openarticlegauge.workflow.priority_detect_provider_batch' : {"queue" : "priority_detect_provider"},
+    'openarticlegauge.workflow.priority_provider_licence_batch' : {"queue" : "priority_provider_licence"},
+    'openarticlegauge.workflow.priority_store_results_batch' : {"queue" : "priority_store_results"}
 }
 
+# batch tasks process up to BACK_END_BATCH_SIZE records each, so they are given
+# a proportionally longer time limit than the single record tasks
+CELERY_ANNOTATIONS = dict(
+    (name, {"time_limit" : CELERYD_TASK_TIME_LIMIT * config.BACK_END_BATCH_SIZE})
+    for name in CELERY_ROUTES.keys() if name.endswith("_batch")
+)
+
 CELERYBEAT_SCHEDULE = {
     'flush_archive_buffer': {
         'task': 'openarticlegauge.models.flush_buffer',
@@ -0,0 +1,132 @@
+"""
+Serialisation of the python data structures which OAG stores in Redis (the cache and
+the storage buffer).
+
+Payloads are written with the codec named in config.PAYLOAD_CODEC.  The "json" codec
+writes plain JSON strings, exactly as OAG always has done, and every other codec writes
+a three byte header followed by the encoded data:
+
+    \\x00 <format version> <codec id>
+
+JSON can never start with a null byte, so any payload can be decoded without knowing
+which codec was used to write it.  This means that the codec can be changed on a running
+system, and old and new entries will both continue to be read correctly until the old
+ones expire or are replaced.
+
+The msgpack codecs require the optional msgpack library.
+
+"""
+
+import json, zlib, logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import config
+
+log = logging.getLogger(__name__)
+
+HEADER_MARKER = "\x00"
+FORMAT_VERSION = 1
+
+# codec ids as they appear in the header.  These must never be changed or re-used, as
+# they are written into stored payloads
+JSON = 0
+JSON_ZLIB = 1
+MSGPACK = 2
+MSGPACK_ZLIB = 3
+
+CODECS = {
+    "json" : JSON,
+    "json+zlib" : JSON_ZLIB,
+    "msgpack" : MSGPACK,
+    "msgpack+zlib" : MSGPACK_ZLIB
+}
+
+def encode(obj, codec=None):
+    """
+    serialise the python data structure with the given codec
+    
+    arguments:
+    obj -- a python data structure which is serialisable to json
+    codec -- the name of the codec to use (see CODECS).  Defaults to config.PAYLOAD_CODEC
+    
+    returns:
+    a string containing the serialised data structure
+    
+    """
+    if codec is None:
+        codec = config.PAYLOAD_CODEC
+    
+    codec_id = CODECS.get(codec)
+    if codec_id is None:
+        raise CodecException("unknown codec: " + str(codec))
+    
+    # plain JSON is written without a header, so that it can be read by older code
+    if codec_id == JSON:
+        return json.dumps(obj)
+    
+    if codec_id in [MSGPACK, MSGPACK_ZLIB]:
+        if msgpack is None:
+            raise CodecException("the msgpack library is required to use the " + codec + " codec")
+        data = msgpack.packb(obj, use_bin_type=True)
+    else:
+        data = json.dumps(obj)
+    
+    if codec_id in [JSON_ZLIB, MSGPACK_ZLIB]:
+        data = zlib.compress(data)
+    
+    return HEADER_MARKER + chr(FORMAT_VERSION) + chr(codec_id) + data
+
+def decode(s):
+    """
+    convert a string written by encode (with any codec) back into a python data structure
+    
+    arguments:
+    s -- the serialised data structure
+    
+    returns:
+    the python data structure
+    
+    """
+    # anything without a header is plain JSON
+    if not s.startswith(HEADER_MARKER):
+        return json.loads(s)
+    
+    if len(s) < 3:
+        raise CodecException("payload header is truncated")
+    
+    version = ord(s[1])
+    if version != FORMAT_VERSION:
+        raise CodecException("unsupported payload format version: " + str(version))
+    
+    codec_id = ord(s[2])
+    data = s[3:]
+    
+    try:
+        if codec_id in [JSON_ZLIB, MSGPACK_ZLIB]:
+            data = zlib.decompress(data)
+        
+        if codec_id in [JSON, JSON_ZLIB]:
+            return json.loads(data)
+        
+        if codec_id in [MSGPACK, MSGPACK_ZLIB]:
+            if msgpack is None:
+                raise CodecException("the msgpack library is required to read this payload")
+            return msgpack.unpackb(data, raw=False)
+    except zlib.error as e:
+        raise CodecException("payload is corrupt: " + str(e))
+    
+    raise CodecException("unknown codec id in payload header: " + str(codec_id))
+
+class CodecException(ValueError):
+    """
+    Exception class to handle any problems encoding or decoding payloads.  This is a
+    ValueError, so that code which deals with corrupt JSON also deals with corrupt payloads
+    
+    """
+    def __init__(self, message):
+        self.message = message
+        super(CodecException, self).__init__(self, message)
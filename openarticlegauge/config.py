@@ -87,6 +87,64 @@ REDIS_CACHE_PORT = 6379
 REDIS_CACHE_DB = 2
 REDIS_CACHE_TIMEOUT = 7776000 # approximately 3 months
 
+# redis key (in the cache database) holding the current cache generation.  To empty
+# the cache, bump the generation with openarticlegauge/scripts/reset_cache.py rather
+# than flushing the database
+CACHE_GENERATION_KEY = "cache_generation"
+
+# number of seconds between each process checking for a new cache generation
+CACHE_GENERATION_REFRESH = 10
+
+# redis key (in the cache database) holding the version of the publisher configs and
+# licence statements, which is bumped whenever one of them is saved or deleted so that
+# every process knows to recompile its index of them (see the generic string matcher)
+PUBLISHER_CONFIG_VERSION_KEY = "publisher_config_version"
+
+# number of seconds between each process checking for a new publisher config version
+PUBLISHER_CONFIG_VERSION_REFRESH = 5
+
+# the codec with which records are serialised into the cache and the storage buffer.
+# One of "json" (plain JSON, as read by all versions of OAG), "json+zlib", "msgpack"
+# or "msgpack+zlib" (the msgpack codecs require the msgpack library).  Entries written
+# with any codec can always be read, so this can be changed on a running system, once
+# all the processes which read the cache and buffer have been upgraded to understand it
+PAYLOAD_CODEC = "json"
+
+# whether or not to keep a small in-process cache of recently used records in front
+# of the Redis cache.  Each gunicorn and celery worker has its own copy, and they
+# are kept in step by publishing invalidations on CACHE_INVALIDATION_CHANNEL
+CACHE_L1_ENABLED = False
+
+# maximum number of records to hold in each process's in-process cache
+CACHE_L1_SIZE = 10000
+
+# number of seconds a record may be served from the in-process cache before it must
+# be fetched from Redis again.  This bounds how out of date a process can be if it
+# misses an invalidation message
+CACHE_L1_TTL = 300
+
+# Redis pub/sub channel on which changes to cached records are announced
+CACHE_INVALIDATION_CHANNEL = "oag_cache_invalidation"
+
+# whether or not to send records into the back-end in batches.  If True, a single
+# lookup request will send its uncached records through the back-end as a small
+# number of batch tasks, rather than as a separate chain of tasks for each record.
+# This cuts the number of messages on the queues, but the records in a batch have
+# their licences looked up one after the other, so the last one waits for all the
+# rest.  The batch tasks' time limit is also shared by the whole batch (see
+# celeryconfig), and if it is exceeded every record in the batch stays queued and
+# claimed until INFLIGHT_LEASE_TIMEOUT, rather than just the one that overran
+BACK_END_BATCHING = False
+
+# maximum number of records to send through the back-end in a single batch of tasks
+BACK_END_BATCH_SIZE = 20
+
+# number of seconds for which a lookup which has sent an identifier to the back-end
+# holds the exclusive claim on processing it.  The claim is released as soon as the
+# results are stored, so this only matters if the back-end loses the record, and
+# should be comfortably longer than a record can be expected to spend on the queues
+INFLIGHT_LEASE_TIMEOUT = 3600
+
 # Number of seconds it takes for a licence record to be considered stale
 licence_stale_time = 15552000 # approximately 6 months
 
@@ -107,18 +165,69 @@ BUFFER_FLUSH_PERIOD = 30
 # as otherwise they'll keep tripping over eachother
 BUFFER_GRACE_PERIOD = 10
 
+# in addition to the scheduled flushes, the buffer is flushed as soon as it contains
+# this many records, or this many bytes of records, so that it doesn't grow without
+# bound when records are being stored quickly.  Set to 0 to disable either trigger
+BUFFER_FLUSH_SIZE = 5000
+BUFFER_FLUSH_BYTES = 50000000
+
+# minimum number of seconds between flushes triggered by the size of the buffer
+BUFFER_FLUSH_TRIGGER_INTERVAL = 5
+
+# number of partitions to divide the storage buffer into.  Each partition is flushed
+# separately, so up to this many workers can flush the buffer in parallel (see the
+# flush_buffer worker in bin/start_celery_daemon.sh).  The buffer size triggers above
+# apply to each partition.  This may be increased at any time, but if it is decreased
+# the buffer should be flushed first
+BUFFER_PARTITIONS = 1
+
+# number of seconds after which the lock on flushing a partition of the buffer is released, even
+# if the flush which took it never finished
+BUFFER_FLUSH_LOCK_TIMEOUT = 300
+
 # Redis buffer configuration
 REDIS_BUFFER_HOST = DEFAULT_HOST
 REDIS_BUFFER_PORT = 6379
 REDIS_BUFFER_DB = 3
 
 # elastic search buffer bulk loading block size - the maximum number of items
-# permitted in a single elastic search bulk request
+# read from the buffer and passed to the bulk writer at once (which will itself
+# split them into requests of ES_BULK_CHUNK_SIZE)
 BUFFER_BLOCK_SIZE = 1000
 
+# where to keep the archive of records and the other stored objects (publisher configs,
+# licence statements, accounts etc).  "elasticsearch" uses the index below, and "sqlite"
+# uses the embedded single-file database at ARCHIVE_SQLITE_PATH instead, which is suitable
+# for single-node deployments and test rigs, but only supports simple queries (see the
+# localstore module)
+ARCHIVE_BACKEND = "elasticsearch"
+ARCHIVE_SQLITE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "archive.sqlite3")
+
 # elasticsearch configs
 ELASTIC_SEARCH_HOST = 'http://{host}:9200'.format(host=DEFAULT_HOST)
 ELASTIC_SEARCH_DB = 'oag'
+
+# maximum number of connections to elasticsearch which each process keeps open for
+# re-use.  This should be at least ES_BULK_CONCURRENCY
+ES_POOL_SIZE = 10
+
+# number of seconds to wait for elasticsearch to respond to a request, and to a bulk
+# request, before giving up
+ES_TIMEOUT = 30
+ES_BULK_TIMEOUT = 120
+
+# number of times to retry a request to elasticsearch if the connection to it fails
+ES_MAX_RETRIES = 3
+
+# maximum number of objects to send to elasticsearch in a single bulk request
+ES_BULK_CHUNK_SIZE = 500
+
+# maximum number of bulk requests to send to elasticsearch at the same time
+ES_BULK_CONCURRENCY = 4
+
+# number of times to retry objects which elasticsearch rejects during a bulk request
+ES_BULK_MAX_RETRIES = 3
+
 INITIALISE_INDEX = True
 
 # if index does not exist, it will be created first time round using the mapping below
@@ -1,15 +1,16 @@
-import os, requests, json, redis
+import os, requests, json
 from flask import Flask
 
-from openarticlegauge import config, licenses
+from openarticlegauge import config, licenses, localstore
 from flask.ext.login import LoginManager, current_user
 login_manager = LoginManager()
 
 def create_app():
     app = Flask(__name__)
     configure_app(app)
-    if app.config['INITIALISE_INDEX']: initialise_index(app)
-    prep_redis(app)
+    if app.config['INITIALISE_INDEX']:
+        if app.config.get('ARCHIVE_BACKEND', 'elasticsearch') == 'elasticsearch': initialise_index(app)
+        load_licenses(app)
     setup_error_email(app)
     login_manager.setup_app(app)
     return app
@@ -22,17 +23,24 @@ def configure_app(app):
     if os.path.exists(config_path):
         app.config.from_pyfile(config_path)
 
-def prep_redis(app):
-    # wipe the redis temp cache (not the non-temp one)
-    client = redis.StrictRedis(host=app.config['REDIS_CACHE_HOST'], port=app.config['REDIS_CACHE_PORT'], db=app.config['REDIS_CACHE_DB'])
-    client.flushdb()
-
 def initialise_index(app):
     # refreshing the mappings and making all known licenses available
     # in the index are split out since the latter can take quite a while
-    # but refreshing the mappings has to be done every time dao.DomainObject.delete_all() is called
+    # but refreshing the mappings has to be done every time dao.DomainObject.delete_all() is called.
+    # The licenses are loaded separately by load_licenses, as every archive backend needs them
     refresh_mappings(app)
-    put_licenses_in_index(app)
+
+def load_licenses(app):
+    # make all known licenses available in whichever archive backend is in use.  The backends
+    # are the ones dao.local_store knows about, and anything else is refused here so that a
+    # misconfigured backend stops the app starting, rather than having licences written to it
+    backend = app.config.get('ARCHIVE_BACKEND', 'elasticsearch')
+    if backend == 'elasticsearch':
+        put_licenses_in_index(app)
+    elif backend == 'sqlite':
+        put_licenses_in_local_store(app)
+    else:
+        raise ValueError("unknown archive backend: " + str(backend))
 
 def get_index_path(app):
     i = str(app.config['ELASTIC_SEARCH_HOST']).rstrip('/')
@@ -56,6 +64,15 @@ def put_licenses_in_index(app):
     for l in licenses.LICENSES:
         r = requests.post(i + '/license/' + l, json.dumps(licenses.LICENSES[l]))
 
+class _License(object):
+    # stands in for models.License, which can't be imported until the app has been created
+    __type__ = 'license'
+
+def put_licenses_in_local_store(app):
+    # put the currently available licences into the embedded store (see dao.local_store)
+    store = localstore.get_store(app.config['ARCHIVE_SQLITE_PATH'])
+    store.bulk(_License, [dict(licenses.LICENSES[l], id=l) for l in licenses.LICENSES])
+
 def setup_error_email(app):
     ADMINS = app.config.get('ADMINS', '')
     if not app.debug and ADMINS:
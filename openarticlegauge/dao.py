@@ -2,15 +2,102 @@
 Generic Data Access Object for mediating between the OAG application and the
 storage back end.
 
-This implementation provides storage in an Elasticsearch index.
+This implementation provides storage in an Elasticsearch index, or, if ARCHIVE_BACKEND
+is set to "sqlite" in config, in an embedded single-file database (see the localstore
+module), which answers the same calls with the same responses.
 
 """
 
-import json, requests, uuid
+import json, requests, uuid, logging, time, os, threading
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 from openarticlegauge.core import app, refresh_mappings
+from openarticlegauge import localstore
+
+log = logging.getLogger(__name__)
+
+# the HTTP session shared by all the threads in this process, and the id of the process
+# that it belongs to.  Sessions hold open connections, so a forked process (e.g. a gunicorn
+# or celery worker) must create its own rather than use its parent's
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def es_session():
+    """
+    Get the HTTP session for talking to Elasticsearch, which keeps a pool of up to
+    ES_POOL_SIZE open connections for re-use by any thread in this process
+    
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=app.config.get('ES_POOL_SIZE', 10))
+                adapter.max_retries = app.config.get('ES_MAX_RETRIES', 0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+def local_store():
+    """
+    Get the embedded store which objects are kept in if ARCHIVE_BACKEND is "sqlite", or
+    None if they are kept in Elasticsearch
+    
+    """
+    backend = app.config.get('ARCHIVE_BACKEND', 'elasticsearch')
+    if backend == 'elasticsearch':
+        return None
+    if backend == 'sqlite':
+        return localstore.get_store(app.config['ARCHIVE_SQLITE_PATH'])
+    raise ValueError("unknown archive backend: " + str(backend))
+
+def _request(method, url, **kwargs):
+    """
+    Make an HTTP request to Elasticsearch using the shared session, with the configured timeout
+    unless another is given
+    
+    arguments:
+    method -- the HTTP method, e.g. "get"
+    url -- the url to request
+    kwargs -- any other arguments to pass on to requests (e.g. data)
+    
+    """
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = app.config.get('ES_TIMEOUT')
+    return es_session().request(method, url, **kwargs)
+
+def _source_params(source_include=None, source_exclude=None):
+    """
+    Get the URL parameters which limit the fields of the source document returned for
+    a GET request to the given include and exclude lists (either of which may be None)
+    
+    """
+    params = {}
+    if source_include is not None:
+        params['_source_include'] = ','.join(source_include)
+    if source_exclude is not None:
+        params['_source_exclude'] = ','.join(source_exclude)
+    return params
+
+def _bulk_item_retryable(item):
+    """
+    Determine if the bulk response item is for an object which was rejected for a reason
+    which may have gone away if we try again, such as the bulk queue being full.  Objects
+    which failed for other reasons (such as being unparseable) will never succeed
+    
+    """
+    result = item.values()[0] if len(item) > 0 else {}
+    if "error" not in result:
+        return False
+    status = result.get("status", 0)
+    return status == 429 or status >= 500 or "RejectedExecution" in str(result.get("error"))
 
 class DomainObject(dict):
     """
@@ -73,34 +160,128 @@ class DomainObject(dict):
             except:
                 self.data['author'] = "anonymous"
 
-        r = requests.post(self.target() + self.data['id'], data=json.dumps(self.data))
+        store = local_store()
+        if store is not None:
+            store.save(self.__class__, self.data)
+            return
+        r = _request("post", self.target() + self.data['id'], data=json.dumps(self.data))
 
 
     @classmethod
     def bulk(cls, bibjson_list, refresh=False):
-        data = ''
-        for r in bibjson_list:
-            data += json.dumps( {'index':{'_id':r['id']}} ) + '\n'
-            data += json.dumps( r ) + '\n'
-        r = requests.post(cls.target() + '_bulk', data=data)
+        """
+        Index all of the supplied objects.  The objects are sent in chunks of ES_BULK_CHUNK_SIZE,
+        up to ES_BULK_CONCURRENCY chunks at a time, and any items which Elasticsearch rejects
+        for reasons which may be temporary (e.g. a full bulk queue) are retried up to
+        ES_BULK_MAX_RETRIES times.
+        
+        arguments:
+        bibjson_list -- list of objects to index, each of which must have an 'id'
+        refresh -- refresh the index once all the objects have been indexed
+        
+        returns:
+        a bulk response object, with an entry in 'items' for each of the supplied objects, in
+        the same order.  The entry for an object which could not be indexed contains an 'error'
+        
+        """
+        store = local_store()
+        if store is not None:
+            return store.bulk(cls, bibjson_list)
+        
+        start = time.time()
+        chunk_size = max(app.config.get('ES_BULK_CHUNK_SIZE', 500), 1)
+        chunks = [bibjson_list[i:i + chunk_size] for i in range(0, len(bibjson_list), chunk_size)]
+        
+        concurrency = min(max(app.config.get('ES_BULK_CONCURRENCY', 1), 1), len(chunks))
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                results = pool.map(cls._bulk_chunk, chunks)
+            finally:
+                # wait for the worker threads to exit, so that they are not left behind by every call
+                pool.close()
+                pool.join()
+        else:
+            results = [cls._bulk_chunk(chunk) for chunk in chunks]
+        
+        items = [item for result in results for item in result]
+        failed = len([item for item in items if "error" in item.values()[0]])
+        
+        elapsed = time.time() - start
+        rate = len(items) / elapsed if elapsed > 0 else 0
+        log.info("bulk indexed {0} {1} objects in {2:.2f}s ({3:.0f} per second), {4} failed".format(
+                len(items) - failed, cls.__type__, elapsed, rate, failed))
+        
         if refresh:
             cls.refresh()
-        return r.json()
+        return {"took" : int(elapsed * 1000), "errors" : failed > 0, "items" : items}
+    
+    @classmethod
+    def _bulk_chunk(cls, chunk):
+        """
+        Send a single bulk request for the chunk of objects, retrying any which are rejected
+        
+        returns:
+        a list of the bulk response items for the objects in the chunk, in the same order
+        
+        """
+        items = [None] * len(chunk)
+        pending = range(len(chunk))
+        attempt = 0
+        while True:
+            # build the request body for everything that is still pending
+            lines = []
+            for i in pending:
+                lines.append(json.dumps({'index' : {'_id' : chunk[i]['id']}}))
+                lines.append(json.dumps(chunk[i]))
+            data = '\n'.join(lines) + '\n'
+            
+            try:
+                r = _request("post", cls.target() + '_bulk', data=data, timeout=app.config.get('ES_BULK_TIMEOUT'))
+                response_items = r.json().get("items", []) if r.status_code == 200 else []
+                if len(response_items) != len(pending):
+                    raise ValueError("bulk request failed with status " + str(r.status_code))
+            except Exception as e:
+                # the whole request went wrong, so all of the pending items need to be tried again
+                response_items = [{'index' : {'_id' : chunk[i]['id'], 'error' : str(e), 'status' : 503}} for i in pending]
+            
+            retry = []
+            for i, item in zip(pending, response_items):
+                items[i] = item
+                if _bulk_item_retryable(item):
+                    retry.append(i)
+            
+            attempt += 1
+            if len(retry) == 0 or attempt > app.config.get('ES_BULK_MAX_RETRIES', 0):
+                return items
+            
+            log.warn("retrying {0} of {1} {2} objects rejected by bulk request".format(len(retry), len(chunk), cls.__type__))
+            time.sleep(0.5 * attempt)
+            pending = retry
 
 
     @classmethod
     def refresh(cls):
-        r = requests.post(cls.target() + '_refresh')
+        if local_store() is not None:
+            # the local store has nothing to refresh; everything is searchable as soon as it is written
+            return {"ok" : True}
+        r = _request("post", cls.target() + '_refresh')
         return r.json()
 
 
     @classmethod
-    def pull(cls, id_):
-        '''Retrieve object by id.'''
+    def pull(cls, id_, source_include=None, source_exclude=None):
+        '''Retrieve object by id.
+
+        :param source_include: list of the fields of the object to retrieve.  If omitted, all fields are retrieved
+        :param source_exclude: list of the fields of the object not to retrieve'''
         if id_ is None:
             return None
+        store = local_store()
+        if store is not None:
+            return store.pull(cls, id_, source_include, source_exclude)
         try:
-            out = requests.get(cls.target() + id_)
+            out = _request("get", cls.target() + id_, params=_source_params(source_include, source_exclude))
             if out.status_code == 404:
                 return None
             else:
@@ -108,9 +289,35 @@ class DomainObject(dict):
         except:
             return None
 
+    @classmethod
+    def pull_multi(cls, ids):
+        '''Retrieve a list of objects by id in a single request.
+
+        Returns a list of the same length as ids, containing None wherever
+        the corresponding object could not be found.'''
+        if len(ids) == 0:
+            return []
+        store = local_store()
+        if store is not None:
+            return store.pull_multi(cls, ids)
+        try:
+            out = _request("post", cls.target() + '_mget', data=json.dumps({"ids" : ids}))
+            docs = out.json().get("docs", [])
+        except:
+            return [None] * len(ids)
+
+        results = []
+        for doc in docs:
+            # older versions of ES report "exists", newer ones "found"
+            if doc.get("exists", doc.get("found", False)):
+                results.append(cls(**doc))
+            else:
+                results.append(None)
+        return results
+
     @classmethod
     def all(cls, size=10000000, **kwargs):
-        return cls.q2obj(size=size, consistent_order=True, **kwargs)
+        return list(cls.iterate(limit=size, **kwargs))
 
     @classmethod
     def q2obj(cls, **kwargs):
@@ -135,7 +342,7 @@ class DomainObject(dict):
         return result
 
     @classmethod
-    def query(cls, recid='', endpoint='_search', q='', terms=None, facets=None, consistent_order=False, **kwargs):
+    def query(cls, recid='', endpoint='_search', q='', terms=None, facets=None, consistent_order=False, source_include=None, source_exclude=None, **kwargs):
         '''Perform a query on backend.
 
         :param recid: needed if endpoint is about a record, e.g. mlt
@@ -143,6 +350,8 @@ class DomainObject(dict):
         :param q: maps to query_string parameter if string, or query dict if dict.
         :param terms: dictionary of terms to filter on. values should be lists. 
         :param facets: dict of facets to return from the query. {'facet_name': <term object>}
+        :param source_include: list of the fields of each object to return.  If omitted, all fields are returned
+        :param source_exclude: list of the fields of each object not to return
             examples of term objects (under the "terms" key in each facet):
             http://www.elasticsearch.org/guide/en/elasticsearch/reference/0.90/search-facets-terms-facet.html
         :param kwargs: any keyword args as per
@@ -150,6 +359,24 @@ class DomainObject(dict):
             q["sort"] = [{"id" : {"order" : "asc"}}]
         '''
         if recid and not recid.endswith('/'): recid += '/'
+        query = cls._build_query(q=q, terms=terms, facets=facets, consistent_order=consistent_order,
+                                 source_include=source_include, source_exclude=source_exclude, **kwargs)
+
+        store = local_store()
+        if store is not None:
+            if endpoint != '_search' or recid:
+                raise localstore.LocalStoreException("unsupported endpoint: " + recid + endpoint)
+            return store.query(cls, query)
+
+        if endpoint in ['_mapping']:
+            r = _request("get", cls.target() + recid + endpoint)
+        else:
+            r = _request("post", cls.target() + recid + endpoint, data=json.dumps(query))
+        return r.json()
+
+    @classmethod
+    def _build_query(cls, q='', terms=None, facets=None, consistent_order=False, source_include=None, source_exclude=None, **kwargs):
+        '''Build the query object for a search, from the same arguments as query.'''
         if isinstance(q,dict):
             query = q
         elif q:
@@ -187,14 +414,17 @@ class DomainObject(dict):
             else:
                 query[k] = v
 
-        if not sort_specified and consistent_order:
+        if not sort_specified and consistent_order and 'sort' not in query:
             query['sort'] = [{"id" : {"order" : "asc"}}]
 
-        if endpoint in ['_mapping']:
-            r = requests.get(cls.target() + recid + endpoint)
-        else:
-            r = requests.post(cls.target() + recid + endpoint, data=json.dumps(query))
-        return r.json()
+        if source_include is not None or source_exclude is not None:
+            query['_source'] = {}
+            if source_include is not None:
+                query['_source']['include'] = source_include
+            if source_exclude is not None:
+                query['_source']['exclude'] = source_exclude
+
+        return query
 
     def accessed(self):
         if 'last_access' not in self.data:
@@ -204,40 +434,77 @@ class DomainObject(dict):
         except:
             usr = "anonymous"
         self.data['last_access'].insert(0, { 'user':usr, 'date':datetime.now().strftime("%Y-%m-%d %H%M") } )
-        r = requests.put(self.target() + self.data['id'], data=json.dumps(self.data))
+        store = local_store()
+        if store is not None:
+            store.save(self.__class__, self.data)
+            return
+        r = _request("put", self.target() + self.data['id'], data=json.dumps(self.data))
 
     @classmethod
     def delete_all(cls):
-        r = requests.delete(cls.target())  # will delete the mapping for this type
+        store = local_store()
+        if store is not None:
+            store.delete_all(cls)
+            return
+        r = _request("delete", cls.target())  # will delete the mapping for this type
         refresh_mappings(app)  # put the mapping back in, dynamic templates and .exact won't work otherwise
 
     def delete(self):        
-        r = requests.delete(self.target() + self.id)
+        store = local_store()
+        if store is not None:
+            store.delete(self.__class__, self.id)
+            return
+        r = _request("delete", self.target() + self.id)
     
     @classmethod
-    def iterate(cls, q, page_size=1000, limit=None):
-        q["size"] = page_size
-        q["from"] = 0
-        q["sort"] = [{"id" : {"order" : "asc"}}]
+    def iterate(cls, q='', page_size=1000, limit=None, keep_alive='5m', **kwargs):
+        '''Iterate over every object matching a query, using the scroll API, so that
+        only one page of results is held in memory at a time and the results are not
+        disturbed by changes made to the index during the iteration.
+
+        :param q: the query, as for query.  The query object is not modified
+        :param page_size: the number of objects to retrieve with each request
+        :param limit: the maximum number of objects to return
+        :param keep_alive: how long elasticsearch should keep the scroll open between requests
+        :param kwargs: any other arguments to build the query with, as for query (e.g. terms, sort)
+        '''
+        query = cls._build_query(q=deepcopy(q), consistent_order=True, **kwargs)
+        query["size"] = page_size
+        query.pop("from", None)
+
+        store = local_store()
+        if store is not None:
+            for obj in store.iterate(cls, query, limit=limit):
+                yield obj
+            return
+
+        scroll_url = app.config['ELASTIC_SEARCH_HOST'].rstrip('/') + '/_search/scroll?scroll=' + keep_alive
+        res = _request("post", cls.target() + '_search?scroll=' + keep_alive, data=json.dumps(query)).json()
+        scroll_id = res.get("_scroll_id")
         counter = 0
-        while True:
-            # apply the limit
-            if limit is not None and counter >= limit:
-                break
-            
-            res = cls.query(q=q)
-            rs = [r.get("_source") for r in res.get("hits", {}).get("hits", [])]
-            # print counter, len(rs), res.get("hits", {}).get("total"), len(res.get("hits", {}).get("hits", [])), json.dumps(q)
-            if len(rs) == 0:
-                break
-            for r in rs:
-                # apply the limit (again)
-                if limit is not None and counter >= limit:
+        try:
+            while True:
+                hits = res.get("hits", {}).get("hits", [])
+                if len(hits) == 0:
                     break
-                counter += 1
-                yield cls(**r)
-            q["from"] += page_size   
-    
+                for hit in hits:
+                    # apply the limit
+                    if limit is not None and counter >= limit:
+                        return
+                    counter += 1
+                    yield cls(**hit.get("_source"))
+                if scroll_id is None:
+                    break
+                res = _request("post", scroll_url, data=scroll_id).json()
+                scroll_id = res.get("_scroll_id", scroll_id)
+        finally:
+            # let elasticsearch free the scroll now, rather than when it times out
+            if scroll_id is not None:
+                try:
+                    _request("delete", app.config['ELASTIC_SEARCH_HOST'].rstrip('/') + '/_search/scroll', data=scroll_id)
+                except Exception as e:
+                    log.warn("unable to clear scroll: " + str(e))
+
     @classmethod
     def iterall(cls, page_size=1000, limit=None):
         return cls.iterate(deepcopy(all_query), page_size, limit)
@@ -29,6 +29,7 @@ Definition of options:
 
 """
 from openarticlegauge import models, cache
+from copy import deepcopy
 import json
 
 ES_PAGE_SIZE = 100
@@ -108,54 +109,52 @@ def invalidate_license_by_query(query, license_type=None, handler=None, handler_
     if reporter is None:
         reporter = lambda x: None
     
-    # set us up for paging
-    query["size"] = ES_PAGE_SIZE
-    query["from"] = 0
+    # find out how many records we are going to deal with
+    count_query = deepcopy(query)
+    count_query["size"] = 0
+    total = models.Record.query(q=count_query).get("hits", {}).get("total", 0)
+    print "total number of relevant records found: " + str(total)
+    reporter("total number of relevant records found: " + str(total))
+    
+    # walk through all of the records, and do the invalidation a page at a time.  We
+    # iterate over a snapshot of the index, so our own changes don't disturb the paging
+    page = []
+    processed = 0
+    for record in models.Record.iterate(q=query, page_size=ES_PAGE_SIZE):
+        page.append(record.data)
+        if len(page) >= ES_PAGE_SIZE:
+            processed = _process_page(page, processed, license_type, handler, handler_version, reporter)
+            page = []
+    if len(page) > 0:
+        _process_page(page, processed, license_type, handler, handler_version, reporter)
+
+def _process_page(records, processed, license_type, handler, handler_version, reporter):
+    """
+    Process a page of records, reporting on progress
     
-    # page through the results and do the invalidation
-    first = True
-    while True:
-        # do the query
-        response = models.Record.query(q=query)
-        
-        # get the important numbers for paging
-        total = response.get("hits", {}).get("total", 0)
-        page_size = len(response.get("hits", {}).get("hits", []))
-        end_of_current_page = query["from"] + page_size
-        
-        if first:
-            print "total number of relevant records found: " + str(total)
-            reporter("total number of relevant records found: " + str(total))
-            first = False
-        print "processing records " + str(query["from"]) + " - " + str(end_of_current_page)
-        reporter("processing records " + str(query["from"]) + " - " + str(end_of_current_page))
-        
-        # process the response from the query
-        _process_response(response, license_type, handler, handler_version, reporter)
-        
-        if total > end_of_current_page:
-            query["from"] = query["from"] + query["size"]
-        else:
-            break
+    returns the number of records processed so far, including this page
+    
+    """
+    end_of_current_page = processed + len(records)
+    print "processing records " + str(processed) + " - " + str(end_of_current_page)
+    reporter("processing records " + str(processed) + " - " + str(end_of_current_page))
+    _process_records(records, license_type, handler, handler_version, reporter)
+    return end_of_current_page
 
-def _process_response(response, license_type, handler, handler_version, reporter):
+def _process_records(records, license_type, handler, handler_version, reporter):
     """
-    Process the Elasticsearch response object by taking all the records therein and deleting
-    the licences consistent with the arguments.
+    Process the bibjson records by deleting the licences consistent with the arguments.
     
     For each item that is affected, we also must invalidate the cache
     
     arguments:
-    response -- Elastic search response object containing bibjson records as the individual results
+    records -- list of bibjson records from the archive
     license_type -- the type of licence to remove (can be None)
     handler -- the handler to remove (can be None)
     handler_version -- the handler_version to remove (can be None)
     reporter -- a callback function which can be used to report on the progress of this method.  Used for command line or logging integration
     
     """
-    # extract the records
-    records = [hit.get("_source") for hit in response.get("hits", {}).get("hits", [])]
-    
     # for each record go through all of its licences and delete any which meet the criteria provided
     ids = []
     for record in records:
@@ -191,6 +190,8 @@ def _process_response(response, license_type, handler, handler_version, reporter
         record['license'] = keep
         if diff > 0:
             ids += canonicals
+            # the licence that the record's freshness was based on may have gone
+            record['fresh_until'] = cache.calculate_fresh_until(models.MessageObject(bibjson=record))
         
         # report
         print "removed " + str(diff) + " licenses from " + str(record.get("id"))
@@ -203,8 +204,7 @@ def _process_response(response, license_type, handler, handler_version, reporter
     # the relevant items (it will rebuild itself as time goes on, if someone
     # requests the item)
     ids = list(set(ids))
-    for i in ids:
-        cache.invalidate(i)
+    cache.invalidate_multi(ids)
 
 def _handler_match(license, handler):
     """
@@ -0,0 +1,491 @@
+"""
+An embedded, single-file archive which can be used instead of Elasticsearch to store the
+DomainObjects (see ARCHIVE_BACKEND in config).  This lets a single-node deployment, or a
+test or benchmark rig, run without an Elasticsearch service.
+
+Objects are held in a SQLite database, serialised with the codec module, and keyed on
+their type and id, so retrieving an object by id (as the archive check in the workflow
+does) is a single primary key lookup.
+
+Queries are answered in the same form as Elasticsearch answers them, so that code which
+reads search responses does not need to know which archive it is talking to.  Only the
+subset of the query language which OAG itself uses is supported:
+
+    match_all, term, terms, ids, exists, query_string (of the form field:value only),
+    bool, filtered, and, or, not, terms facets, sort, from, size and _source
+
+and the matching is done in python, against every object of the type being queried.  This
+is fine for the small configuration types, but querying the record archive scans all of
+it, so this archive is not a replacement for Elasticsearch on a large deployment.  Any
+query which uses something outside this subset raises a LocalStoreException.
+
+"""
+
+import sqlite3, os, re, threading, logging, time
+from collections import defaultdict
+
+from openarticlegauge import codec
+
+log = logging.getLogger(__name__)
+
+# the stores which have been opened by this process, by path
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path):
+    """
+    Get the store for the database file at the given path, opening it if necessary
+    
+    arguments:
+    path -- path to the SQLite database file.  It is created if it does not exist
+    
+    returns:
+    a SQLiteStore
+    
+    """
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(path)
+            if store is None:
+                store = SQLiteStore(path)
+                _stores[path] = store
+    return store
+
+class SQLiteStore(object):
+    """
+    DomainObject storage in a single SQLite database file.  Every method which is given
+    a klass expects a DomainObject subclass, and stores objects under its __type__
+    
+    """
+    
+    # number of rows to read from the database at a time when iterating
+    FETCH_SIZE = 1000
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS documents (type TEXT NOT NULL, id TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (type, id))"
+        )
+    
+    def _connection(self):
+        """
+        Get the connection to the database for this thread.  SQLite connections can't be
+        shared between threads, or with a forked process, so each thread of each process
+        opens its own
+        
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # write-ahead logging lets readers carry on while another process writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def pull(self, klass, id_, source_include=None, source_exclude=None):
+        """
+        Retrieve the object of the given type with the given id
+        
+        returns:
+        an instance of klass, or None if there is no such object
+        
+        """
+        row = self._connection().execute(
+            "SELECT data FROM documents WHERE type = ? AND id = ?", (klass.__type__, id_)
+        ).fetchone()
+        if row is None:
+            return None
+        return klass(**_hit(klass, id_, _project(_load(row[0]), source_include, source_exclude)))
+    
+    def pull_multi(self, klass, ids):
+        """
+        Retrieve the objects of the given type with each of the given ids
+        
+        returns:
+        a list of the same length as ids, containing an instance of klass, or None wherever
+        there is no such object
+        
+        """
+        conn = self._connection()
+        found = {}
+        # keep well inside SQLite's limit on the number of parameters to a statement
+        for i in range(0, len(ids), 500):
+            block = ids[i:i + 500]
+            rows = conn.execute(
+                "SELECT id, data FROM documents WHERE type = ? AND id IN (" + ",".join(["?"] * len(block)) + ")",
+                [klass.__type__] + list(block)
+            )
+            for id_, data in rows:
+                found[id_] = data
+        return [klass(**_hit(klass, id_, _load(found[id_]))) if id_ in found else None for id_ in ids]
+    
+    def save(self, klass, data):
+        """
+        Store the object data, replacing any object of the same type with the same id
+        
+        """
+        self._connection().execute(
+            "INSERT OR REPLACE INTO documents (type, id, data) VALUES (?, ?, ?)",
+            (klass.__type__, data['id'], _dump(data))
+        )
+    
+    def bulk(self, klass, bibjson_list):
+        """
+        Store all of the objects in a single transaction
+        
+        returns:
+        a bulk response object, in the same form as DomainObject.bulk
+        
+        """
+        start = time.time()
+        conn = self._connection()
+        with _transaction(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO documents (type, id, data) VALUES (?, ?, ?)",
+                [(klass.__type__, obj['id'], _dump(obj)) for obj in bibjson_list]
+            )
+        items = [{"index" : {"_id" : obj['id'], "ok" : True}} for obj in bibjson_list]
+        return {"took" : int((time.time() - start) * 1000), "errors" : False, "items" : items}
+    
+    def delete(self, klass, id_):
+        self._connection().execute("DELETE FROM documents WHERE type = ? AND id = ?", (klass.__type__, id_))
+    
+    def delete_all(self, klass):
+        self._connection().execute("DELETE FROM documents WHERE type = ?", (klass.__type__,))
+    
+    def query(self, klass, query):
+        """
+        Search the objects of the given type
+        
+        arguments:
+        klass -- the DomainObject subclass to search
+        query -- an Elasticsearch query object (see the module documentation for what is supported)
+        
+        returns:
+        a search response in the same form as Elasticsearch's
+        
+        """
+        start = time.time()
+        matches = list(self._search(klass, query))
+        
+        response = {"took" : 0, "timed_out" : False, "hits" : {"total" : len(matches), "hits" : []}}
+        if "facets" in query:
+            response["facets"] = _facets(matches, query["facets"])
+        
+        offset = int(query.get("from", 0))
+        size = int(query.get("size", 10))
+        for id_, doc in matches[offset:offset + size]:
+            response["hits"]["hits"].append(_hit(klass, id_, _project(doc, *_source_filter(query))))
+        
+        response["took"] = int((time.time() - start) * 1000)
+        return response
+    
+    def iterate(self, klass, query, limit=None):
+        """
+        Iterate over every object of the given type which matches the query
+        
+        arguments:
+        klass -- the DomainObject subclass to search
+        query -- an Elasticsearch query object.  Any from and size are ignored
+        limit -- the maximum number of objects to return
+        
+        """
+        include, exclude = _source_filter(query)
+        counter = 0
+        for id_, doc in self._search(klass, query):
+            if limit is not None and counter >= limit:
+                return
+            counter += 1
+            yield klass(**_project(doc, include, exclude))
+    
+    def _search(self, klass, query):
+        """
+        Generate (id, object) pairs for every object of the given type which matches the query,
+        in the order that the query asks for
+        
+        """
+        sort = _sort_fields(query.get("sort"))
+        clauses = [query[k] for k in ["query", "filter"] if query.get(k)]
+        for clause in clauses:
+            # find out about unsupported queries now, rather than halfway through the results
+            _check(clause)
+        matches = (
+            (id_, doc) for id_, doc in self._scan(klass)
+            if all([_matches(doc, clause) for clause in clauses])
+        )
+        
+        # the objects are read in id order, so if that's what's wanted they can be streamed
+        if len(sort) == 0 or sort == [("id", False)]:
+            return matches
+        
+        # otherwise sort them by each field in turn, least significant first
+        matches = list(matches)
+        for field, descending in reversed(sort):
+            matches.sort(key=lambda m: _sort_value(m[1], field), reverse=descending)
+        return iter(matches)
+    
+    def _scan(self, klass):
+        """
+        Generate (id, object) pairs for every object of the given type, in id order
+        
+        """
+        # read the result set a block at a time, so that the whole type isn't held in memory at
+        # once.  The cursor stays open between blocks, so it is closed when the generator is, which
+        # also happens if the caller stops iterating early and the generator is discarded
+        cursor = self._connection().execute(
+            "SELECT id, data FROM documents WHERE type = ? ORDER BY id", (klass.__type__,)
+        )
+        try:
+            rows = cursor.fetchmany(self.FETCH_SIZE)
+            while len(rows) > 0:
+                for id_, data in rows:
+                    yield id_, _load(data)
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+        finally:
+            cursor.close()
+
+class _transaction(object):
+    """
+    Context manager which runs the statements inside it as a single transaction on a
+    connection in autocommit mode
+    
+    """
+    def __init__(self, conn):
+        self.conn = conn
+    def __enter__(self):
+        self.conn.execute("BEGIN")
+    def __exit__(self, type_, value, traceback):
+        self.conn.execute("COMMIT" if type_ is None else "ROLLBACK")
+        return False
+
+def _dump(obj):
+    return sqlite3.Binary(codec.encode(obj))
+
+def _load(data):
+    return codec.decode(str(data))
+
+def _hit(klass, id_, doc):
+    return {"_index" : "local", "_type" : klass.__type__, "_id" : id_, "exists" : True, "_source" : doc}
+
+def _source_filter(query):
+    source = query.get("_source")
+    if source is None:
+        return None, None
+    if isinstance(source, dict):
+        return source.get("include"), source.get("exclude")
+    if source is False:
+        return [], None
+    return source if isinstance(source, list) else [source], None
+
+def _project(doc, include=None, exclude=None):
+    """
+    Reduce the object to the given top level fields.  Dotted field names select the
+    whole of the top level field that they are in
+    
+    """
+    if include is not None:
+        keep = set([f.split(".")[0] for f in include])
+        doc = dict([(k, v) for k, v in doc.items() if k in keep])
+    if exclude is not None:
+        drop = set([f for f in exclude if "." not in f])
+        doc = dict([(k, v) for k, v in doc.items() if k not in drop])
+    return doc
+
+def _field_values(doc, field):
+    """
+    Get all the values of the (dotted) field in the object, looking inside any lists
+    on the way.  The ".exact" suffix used for the unanalysed versions of fields is ignored
+    
+    """
+    if field.endswith(".exact"):
+        field = field[:-len(".exact")]
+    values = [doc]
+    for part in field.split("."):
+        found = []
+        for v in values:
+            if isinstance(v, dict) and part in v:
+                found.append(v[part])
+        values = []
+        for v in found:
+            if isinstance(v, list):
+                values += v
+            else:
+                values.append(v)
+    return values
+
+def _tokens(value):
+    return re.findall(r"\w+", unicode(value).lower(), re.UNICODE)
+
+def _value_matches(values, wanted, exact):
+    """
+    Does any of the values match the wanted value?  Unless the match is exact this
+    approximates Elasticsearch's analysed fields: the words of the wanted value must
+    appear together, ignoring case, in the value
+    
+    """
+    for value in values:
+        if exact or not isinstance(value, basestring) or not isinstance(wanted, basestring):
+            if value == wanted:
+                return True
+            continue
+        v, w = _tokens(value), _tokens(wanted)
+        if len(w) == 0:
+            continue
+        for i in range(len(v) - len(w) + 1):
+            if v[i:i + len(w)] == w:
+                return True
+    return False
+
+def _term_matches(doc, field, wanted):
+    exact = field.endswith(".exact") or field == "id"
+    values = _field_values(doc, field)
+    return any([_value_matches(values, w, exact) for w in wanted])
+
+QUERY_STRING = re.compile(r'^\s*(?:([\w.]+):)?(?:"([^"]*)"|(\S+))\s*$')
+
+def _query_string_matches(doc, query):
+    if query.strip() in ["", "*", "*:*"]:
+        return True
+    m = QUERY_STRING.match(query)
+    if m is None:
+        raise LocalStoreException("unsupported query string: " + query)
+    field, phrase, word = m.groups()
+    wanted = phrase if phrase is not None else word
+    if phrase is None and ("*" in word or "?" in word):
+        raise LocalStoreException("unsupported query string: " + query)
+    if field is None or field == "_all":
+        return _value_matches(_all_values(doc), wanted, False)
+    return _value_matches(_field_values(doc, field), wanted, False)
+
+def _all_values(obj):
+    if isinstance(obj, dict):
+        return [v for val in obj.values() for v in _all_values(val)]
+    if isinstance(obj, list):
+        return [v for val in obj for v in _all_values(val)]
+    return [obj]
+
+def _as_list(clauses):
+    if clauses is None:
+        return []
+    return clauses if isinstance(clauses, list) else [clauses]
+
+def _check(clause):
+    """
+    Raise a LocalStoreException if the clause uses anything that isn't supported.  This
+    evaluates the clause against an empty object, which exercises every part of it
+    
+    """
+    _matches({}, clause, check=True)
+
+def _matches(doc, clause, check=False):
+    """
+    Does the object match the query or filter clause?
+    
+    arguments:
+    doc -- the object
+    clause -- an Elasticsearch query or filter clause
+    check -- evaluate every part of the clause, rather than stopping once the answer is known
+    
+    """
+    results = []
+    for kind, spec in clause.items():
+        if kind == "match_all":
+            results.append(True)
+        elif kind == "term":
+            results += [_term_matches(doc, f, [v]) for f, v in spec.items() if f != "_cache"]
+        elif kind == "terms":
+            results += [_term_matches(doc, f, _as_list(v)) for f, v in spec.items() if f not in ["execution", "minimum_match", "_cache"]]
+        elif kind == "ids":
+            results.append(doc.get("id") in spec.get("values", []))
+        elif kind == "exists":
+            results.append(len(_field_values(doc, spec.get("field", ""))) > 0)
+        elif kind == "missing":
+            results.append(len(_field_values(doc, spec.get("field", ""))) == 0)
+        elif kind == "query_string":
+            results.append(_query_string_matches(doc, spec.get("query", "")))
+        elif kind == "filtered":
+            results += [_matches(doc, c, check) for c in [spec.get("query"), spec.get("filter")] if c]
+        elif kind == "bool":
+            must = [_matches(doc, c, check) for c in _as_list(spec.get("must"))]
+            must_not = [_matches(doc, c, check) for c in _as_list(spec.get("must_not"))]
+            should = [_matches(doc, c, check) for c in _as_list(spec.get("should"))]
+            results.append(all(must) and not any(must_not) and (len(should) == 0 or any(should)))
+        elif kind == "and":
+            results.append(all([_matches(doc, c, check) for c in _as_list(spec.get("filters") if isinstance(spec, dict) else spec)]))
+        elif kind == "or":
+            results.append(any([_matches(doc, c, check) for c in _as_list(spec.get("filters") if isinstance(spec, dict) else spec)]))
+        elif kind == "not":
+            results.append(not _matches(doc, spec.get("filter", spec), check))
+        elif kind == "constant_score":
+            results += [_matches(doc, c, check) for c in [spec.get("query"), spec.get("filter")] if c]
+        else:
+            raise LocalStoreException("unsupported query: " + kind)
+        if not check and not all(results):
+            return False
+    return all(results)
+
+def _sort_fields(sort):
+    """
+    Normalise the sort part of a query into a list of (field, descending) tuples
+    
+    """
+    fields = []
+    for s in _as_list(sort):
+        if isinstance(s, basestring):
+            fields.append((s, False))
+            continue
+        for field, order in s.items():
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+            fields.append((field, order == "desc"))
+    fields = [(f[:-len(".exact")] if f.endswith(".exact") else f, d) for f, d in fields if f != "_score"]
+    return fields
+
+def _sort_value(doc, field):
+    values = _field_values(doc, field)
+    if len(values) == 0:
+        return None
+    value = values[0]
+    return value.lower() if isinstance(value, basestring) else value
+
+def _facets(matches, facets):
+    """
+    Calculate terms facets over all the matching objects, in the same form as Elasticsearch
+    
+    """
+    result = {}
+    for name, spec in facets.items():
+        if "terms" not in spec:
+            raise LocalStoreException("unsupported facet: " + ", ".join(spec.keys()))
+        field = spec["terms"].get("field")
+        size = spec["terms"].get("size", 10)
+        counts = defaultdict(int)
+        missing = 0
+        for id_, doc in matches:
+            values = _field_values(doc, field)
+            if len(values) == 0:
+                missing += 1
+            for v in values:
+                counts[v] += 1
+        terms = sorted(counts.items(), key=lambda t: (-t[1], t[0]))
+        result[name] = {
+            "_type" : "terms",
+            "missing" : missing,
+            "total" : sum(counts.values()),
+            "other" : sum([c for t, c in terms[size:]]),
+            "terms" : [{"term" : t, "count" : c} for t, c in terms[:size]]
+        }
+    return result
+
+class LocalStoreException(Exception):
+    """
+    Exception class for queries which the local store can't answer
+    
+    """
+    def __init__(self, message):
+        self.message = message
+        super(LocalStoreException, self).__init__(self, message)
@@ -3,10 +3,10 @@ Data model objects, some of which extend the DAO for storage purposes
 
 """
 
-import json, redis, logging
+import json, redis, logging, uuid, zlib, time
 from datetime import datetime
 
-from openarticlegauge import config
+from openarticlegauge import config, codec
 from openarticlegauge.dao import DomainObject
 from openarticlegauge.slavedriver import celery
 
@@ -15,6 +15,103 @@ from flask.ext.login import UserMixin
 
 log = logging.getLogger(__name__)
 
+# Redis list of the canonical identifiers of records which have been placed in the
+# storage buffer and have not yet been flushed to the archive
+BUFFER_LOG = "buffer_log"
+
+# Redis counter of the (approximate) number of bytes of records waiting in the buffer
+BUFFER_BYTES = "buffer_bytes"
+
+# Redis key which is set for a short time whenever a flush is triggered by the size of the buffer
+FLUSH_TRIGGER = "flush_buffer_trigger"
+
+# Redis key holding the lease on flushing the buffer
+FLUSH_LOCK = "flush_buffer_lock"
+
+# the version of the publisher configs as last read from redis, and the time at which it was read
+_publisher_config_version = (0, None)
+
+def publisher_config_version():
+    """
+    Get the current version of the publisher configs and licence statements.  The version
+    is re-read from redis at most every PUBLISHER_CONFIG_VERSION_REFRESH seconds
+    
+    """
+    global _publisher_config_version
+    version, read_at = _publisher_config_version
+    now = time.time()
+    if read_at is None or now - read_at >= config.PUBLISHER_CONFIG_VERSION_REFRESH:
+        client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
+        s = client.get(config.PUBLISHER_CONFIG_VERSION_KEY)
+        version = int(s) if s is not None else 0
+        _publisher_config_version = (version, now)
+    return version
+
+def bump_publisher_config_version():
+    """
+    Record that the publisher configs or licence statements have changed, so that every
+    process recompiles anything it has built from them
+    
+    returns the new version
+    
+    """
+    global _publisher_config_version
+    client = redis.StrictRedis(host=config.REDIS_CACHE_HOST, port=config.REDIS_CACHE_PORT, db=config.REDIS_CACHE_DB)
+    version = client.incr(config.PUBLISHER_CONFIG_VERSION_KEY)
+    _publisher_config_version = (version, time.time())
+    return version
+
+def buffer_shard(canonical):
+    """
+    Get the partition of the storage buffer which the record with the given canonical
+    identifier belongs to.  See config.BUFFER_PARTITIONS
+    
+    """
+    return (zlib.crc32(canonical) & 0xffffffff) % max(config.BUFFER_PARTITIONS, 1)
+
+def buffer_key(name, shard):
+    """
+    Get the Redis key of the named buffer structure (e.g. BUFFER_LOG) for the given partition
+    of the storage buffer.  Partition 0 uses the plain name, so that the buffer can be
+    partitioned (or the number of partitions increased) without losing track of anything
+    
+    """
+    if shard == 0:
+        return name
+    return name + "_" + str(shard)
+
+# Lua script which sets the expiry on a key, but only if its value is still the one
+# given, e.g. a buffered record which has not been changed since it was flushed, or a
+# lease which has not passed to someone else
+ACKNOWLEDGE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Lua script which removes the entries which have been flushed from the front of the buffer
+# log, but only if the flush still holds the lease on the buffer (which it then renews).  If
+# the lease has passed to someone else they may be flushing the same entries, and both of
+# us trimming the log would remove entries which neither has flushed
+TRIM_SCRIPT = """
+if redis.call("get", KEYS[2]) == ARGV[2] then
+    redis.call("ltrim", KEYS[1], ARGV[1], -1)
+    redis.call("expire", KEYS[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# Lua script which resets the buffer byte count once the buffer log is empty, so that
+# any drift in the count doesn't outlive the records it was counting
+RESET_BYTES_SCRIPT = """
+if redis.call("llen", KEYS[1]) == 0 then
+    redis.call("set", KEYS[2], 0)
+end
+return redis.call("get", KEYS[2])
+"""
+
 class ModelException(Exception):
     """
     Exception to be thrown when there is a problem constructing or manipulating model objects
@@ -72,13 +169,15 @@ class Record(DomainObject):
     __type__ = 'record'
     
     @classmethod
-    def check_archive(cls, identifier):
+    def check_archive(cls, identifier, fields=None):
         """
         Check the archive layer for an object with the given (canonical) identifier,
         which can be found in the bibjson['identifier']['canonical'] field
         
         arguments:
         identifier -- the identifier of the record to look up.  This should be the canonical identifier of the record
+        fields -- list of the fields of the record which are needed.  If omitted, the whole record is retrieved.  If
+            the record is found in the buffer, the whole record is returned regardless
         
         Return a bibjson record or None if none is found
         
@@ -96,7 +195,7 @@ class Record(DomainObject):
             # by just making an ID and GETting and POSTing to it, we can do things faster.
             log.debug("checking remote archive for " + str(identifier))
             _id = identifier.replace('/','_')
-            result = cls.pull(_id)
+            result = cls.pull(_id, source_include=fields)
             if result:
                 log.debug(str(identifier) + " found in remote archive")
             else:
@@ -107,6 +206,46 @@ class Record(DomainObject):
         except:
             return result
 
+    @classmethod
+    def check_archive_multi(cls, identifiers):
+        """
+        Check the archive layer for objects with each of the given (canonical) identifiers.
+        This is equivalent to calling check_archive on each identifier, but the buffer and
+        the remote archive are each consulted only once for the whole list
+        
+        arguments:
+        identifiers -- list of identifiers of the records to look up.  These should be the canonical identifiers of the records
+        
+        Return a list of the same length as identifiers, containing a bibjson record or None
+        for each identifier
+        
+        """
+        results = [None] * len(identifiers)
+        if config.BUFFERING:
+            # before checking remote, check the buffer queue if one is enabled
+            log.debug("checking buffer for " + str(identifiers))
+            try:
+                results = cls._check_buffer_multi(identifiers)
+            except Exception as e:
+                # treat them as not buffered, as check_archive would, rather than failing the lookup
+                log.error("unable to check the buffer for " + str(identifiers) + " - checking the remote archive instead: " + str(e))
+                results = [None] * len(identifiers)
+        
+        # anything that wasn't in the buffer, we need to get from the remote archive
+        misses = [i for i in range(len(identifiers)) if not results[i]]
+        if len(misses) > 0:
+            log.debug("checking remote archive for " + str([identifiers[i] for i in misses]))
+            try:
+                pulled = cls.pull_multi([identifiers[i].replace('/','_') for i in misses])
+            except Exception as e:
+                # treat them as not archived, as check_archive would, rather than failing the lookup
+                log.error("unable to check the remote archive for " + str([identifiers[i] for i in misses]) + " - treating them as not archived: " + str(e))
+                pulled = []
+            for i, result in zip(misses, pulled):
+                results[i] = result.data if result is not None else None
+        
+        return results
+    
     @classmethod
     def store(cls, bibjson):
         """
@@ -130,7 +269,10 @@ class Record(DomainObject):
             log.info("placing item " + identifier + " into the storage buffer")
             
             # just add to the buffer, no need to actually save anything
-            cls._add_to_buffer(bibjson)
+            shard, length, size = cls._add_to_buffer(bibjson)
+            
+            # if the buffer is getting big, don't wait for the next scheduled flush
+            cls._trigger_flush(shard, length, size)
             return
         else:
             log.info("placing item " + identifier + " directly into storage")
@@ -148,6 +290,10 @@ class Record(DomainObject):
         arguments:
         bibjson -- the bibjson record to be stored.  The record must contain a canonical identifier in ['identifier'][n]['canonical']
         
+        returns:
+        a tuple of the partition of the buffer that the record was placed in, and the number of
+        records and the number of bytes of records now in that partition
+        
         """
         canonical = None
         for identifier in bibjson.get("identifier", []):
@@ -159,8 +305,48 @@ class Record(DomainObject):
             raise BufferException("cannot buffer an item without a canonical form of the identifier")
         
         client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
-        s = json.dumps(bibjson)
-        client.set("id_" + canonical, s)
+        s = codec.encode(bibjson)
+        
+        # store the record, and note in the buffer log of its partition that it needs to be flushed.
+        # The record itself is stored under the same key whatever its partition, so that it
+        # can always be found directly
+        shard = buffer_shard(canonical)
+        pipe = client.pipeline()
+        pipe.set("id_" + canonical, s)
+        pipe.rpush(buffer_key(BUFFER_LOG, shard), canonical)
+        pipe.incrby(buffer_key(BUFFER_BYTES, shard), len(s))
+        ok, length, size = pipe.execute()
+        return shard, length, size
+    
+    @classmethod
+    def _trigger_flush(cls, shard, length, size):
+        """
+        Start a flush of a partition of the storage buffer if it has grown past the configured size, unless
+        one has already been triggered in the last BUFFER_FLUSH_TRIGGER_INTERVAL seconds.  If a
+        flush is already running, the triggered one will give way to it, and the next record
+        to be stored will trigger another if the buffer is still too big
+        
+        arguments:
+        shard -- the partition of the buffer
+        length -- the number of records in the partition
+        size -- the number of bytes of records in the partition
+        
+        returns:
+        True if a flush was triggered, False if not
+        
+        """
+        too_long = config.BUFFER_FLUSH_SIZE > 0 and length >= config.BUFFER_FLUSH_SIZE
+        too_big = config.BUFFER_FLUSH_BYTES > 0 and size >= config.BUFFER_FLUSH_BYTES
+        if not too_long and not too_big:
+            return False
+        
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        if not client.set(buffer_key(FLUSH_TRIGGER, shard), "trigger", ex=config.BUFFER_FLUSH_TRIGGER_INTERVAL, nx=True):
+            return False
+        
+        log.info("storage buffer partition " + str(shard) + " contains " + str(length) + " records (" + str(size) + " bytes) - triggering a flush")
+        flush_buffer.apply_async(args=[shard])
+        return True
     
     @classmethod
     def _check_buffer(cls, canonical):
@@ -178,15 +364,40 @@ class Record(DomainObject):
         record = client.get("id_" + canonical)
         if record is None or record == "":
             return None
-        return json.loads(record)
+        return codec.decode(record)
+    
+    @classmethod
+    def _check_buffer_multi(cls, canonicals):
+        """
+        Check the storage buffer for the items identified by each of the supplied canonical
+        identifiers, in a single request to the buffer
+        
+        arguments:
+        canonicals -- list of the identifiers of the records to look up.  These should be the canonical identifiers of the records
+        
+        Return a list of the same length as canonicals, containing a bibjson record or None
+        for each identifier
+        
+        """
+        if len(canonicals) == 0:
+            return []
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        records = client.mget(["id_" + canonical for canonical in canonicals])
+        return [codec.decode(record) if record is not None and record != "" else None for record in records]
     
     @classmethod
-    def flush_buffer(cls, key_timeout=0, block_size=1000):
+    def flush_buffer(cls, key_timeout=0, block_size=1000, shard=None, lease=None):
         """
         Flush the current storage buffer out to the long-term storage (Elasticsearch).  This method
         will return after all of the records have been flushed successfully to storage, and will
         not wait until the key_timeout period has passed (this will happen asynchronously)
         
+        The records to flush are taken from the buffer log, in the order in which they were
+        buffered.  Each one is only acknowledged (its entry in the buffer given the key_timeout)
+        once Elasticsearch has confirmed that it has been indexed, and any which are not
+        confirmed are put back on the log to be tried again at the next flush.  Records
+        which are buffered while the flush is in progress are left for the next flush.
+        
         keyword arguments:
         key_timeout -- the length of time to live (in seconds) to allocate to each record in the storage buffer.  This is to 
             allow Elasticsearch time to receive and index the records and make them available - while it is
@@ -196,51 +407,145 @@ class Record(DomainObject):
             if there are more records than the block size, multiple HTTP requests will be made, none of which
             will be larger than the block_size.
         
+        shard -- the partition of the buffer to flush.  If omitted, all partitions are flushed, one after the other
+        
+        lease -- a (key, token) tuple for the lease held on flushing this partition of the buffer.  The lease is
+            renewed for BUFFER_FLUSH_LOCK_TIMEOUT seconds after each block, and the log is only trimmed while it is
+            still held.  If it has been lost (e.g. because a block took longer than that) the flush stops without
+            removing anything from the log, as another flush may now be working on the same entries.  Only used when
+            a single partition is flushed
+        
         returns:
-        False if there is nothing in the buffer to flush
+        False if there is nothing in the buffer to flush, or the lease was lost before the flush completed
         True if there are items in the buffer to flush and they are successfully flushed
         
         """
+        if shard is None:
+            flushed = [cls.flush_buffer(key_timeout, block_size, s) for s in range(max(config.BUFFER_PARTITIONS, 1))]
+            return True in flushed
+        
         client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        buffer_log = buffer_key(BUFFER_LOG, shard)
+        buffer_bytes = buffer_key(BUFFER_BYTES, shard)
         
-        # get all of the id keys
-        ids = client.keys("id_*")
-        if len(ids) == 0:
-            log.info("storage buffer contains 0 items to be flushed ... returning")
+        # find out how much of the log we are going to deal with
+        length = client.llen(buffer_log)
+        if length == 0:
+            log.info("storage buffer partition " + str(shard) + " contains 0 items to be flushed ... returning")
             return False
-        log.info("flushing storage buffer of " + str(len(ids)) + " objects")
+        log.info("flushing storage buffer partition " + str(shard) + " of " + str(length) + " objects")
         
-        # retrieve all of the bibjson records associated with those keys
+        acknowledge = client.register_script(ACKNOWLEDGE_SCRIPT)
         
-        bibjson_records = []
-        i = 0
-        for identifier in ids:
-            # obtain, decode and register the bibjson record to be archived
-            s = client.get(identifier)
-            obj = json.loads(s)
-            bibjson_records.append(obj)
+        # the identifiers already dealt with by this flush.  Each record is read from the buffer
+        # when its first entry in the log is reached, and any change to it after that adds a new
+        # entry beyond the end of what we are flushing, so its later entries can be ignored
+        seen = set()
+        
+        for start in range(0, length, block_size):
+            end = min(start + block_size, length) - 1
+            
+            # get the next block of identifiers from the log, ignoring any that we have already seen
+            canonicals = []
+            for canonical in client.lrange(buffer_log, start, end):
+                if canonical not in seen:
+                    seen.add(canonical)
+                    canonicals.append(canonical)
             
-            # if we've reached the block size, do a bulk write
-            i += 1
-            if i >= block_size:
-                # bulk load the records
-                cls.bulk(bibjson_records)
-                
-                # reset the registers
-                i = 0
-                bibjson_records = []
-        
-        if len(bibjson_records) > 0:
-            # bulk load the remaining records
-            cls.bulk(bibjson_records)
-        
-        # set a timeout on the identifiers affected, if desired.  If the key_timeout is 0, this is effectively
-        # the same as deleting those keys
-        for identifier in ids:
-            client.expire(identifier, key_timeout)
+            if len(canonicals) == 0:
+                continue
+            
+            # retrieve and decode all of the bibjson records associated with those identifiers
+            strings = client.mget(["id_" + canonical for canonical in canonicals])
+            
+            buffered = []
+            bibjson_records = []
+            read_bytes = 0
+            for canonical, s in zip(canonicals, strings):
+                # if the record is no longer in the buffer, an earlier flush has already archived it
+                # and its key has since expired
+                if s is None:
+                    continue
+                try:
+                    obj = codec.decode(s)
+                except ValueError as e:
+                    log.error("unable to decode buffered record for " + canonical + " - not flushing it: " + str(e))
+                    continue
+                buffered.append((canonical, s))
+                bibjson_records.append(obj)
+                read_bytes += len(s)
+            
+            if len(bibjson_records) == 0:
+                continue
+            
+            # bulk load the records, and find out which of them were indexed
+            response = cls.bulk(bibjson_records)
+            indexed = _bulk_successes(response, len(bibjson_records))
+            
+            # set a timeout on the records which were indexed, if desired.  If the key_timeout is 0, this is effectively
+            # the same as deleting those keys.  If a record has been buffered again since we read it, we leave
+            # it alone, as the new version still needs to be flushed.  Anything which wasn't indexed goes back on
+            # the log, to be tried again next time
+            pipe = client.pipeline(transaction=False)
+            failed = []
+            for (canonical, s), success in zip(buffered, indexed):
+                if success:
+                    acknowledge(keys=["id_" + canonical], args=[s, key_timeout], client=pipe)
+                else:
+                    failed.append(canonical)
+                    read_bytes -= len(s)
+            if len(failed) > 0:
+                log.warn("failed to flush " + str(len(failed)) + " records from the storage buffer; they will be retried")
+                pipe.rpush(buffer_log, *failed)
+            pipe.decrby(buffer_bytes, read_bytes)
+            pipe.execute()
+            
+            # hold on to the lease for the next block, or give up if it has already passed to someone else.
+            # After the last block this is done along with the trim below
+            if lease is not None and end < length - 1:
+                lease_key, token = lease
+                if not acknowledge(keys=[lease_key], args=[token, config.BUFFER_FLUSH_LOCK_TIMEOUT]):
+                    log.warn("lost the lease on storage buffer partition " + str(shard) + " while flushing it - leaving the log for the next flush")
+                    return False
+        
+        # everything we have dealt with can now be removed from the log, as long as the lease is still ours
+        if lease is None:
+            client.ltrim(buffer_log, length, -1)
+        else:
+            lease_key, token = lease
+            trim = client.register_script(TRIM_SCRIPT)
+            if not trim(keys=[buffer_log, lease_key], args=[length, token, config.BUFFER_FLUSH_LOCK_TIMEOUT]):
+                log.warn("lost the lease on storage buffer partition " + str(shard) + " while flushing it - leaving the log for the next flush")
+                return False
+        client.register_script(RESET_BYTES_SCRIPT)(keys=[buffer_log, buffer_bytes])
         
         return True
 
+def _bulk_successes(response, count):
+    """
+    Determine which of the items sent in an Elasticsearch bulk request were indexed
+    
+    arguments:
+    response -- the decoded bulk response from Elasticsearch
+    count -- the number of items that were sent in the bulk request
+    
+    returns:
+    a list of the same length as the request, with True for each item that was indexed
+    and False for each that was not
+    
+    """
+    items = response.get("items", []) if isinstance(response, dict) else []
+    if len(items) != count:
+        log.error("bulk response does not account for all the items sent - treating them all as failed")
+        return [False] * count
+    
+    successes = []
+    for item in items:
+        # each item is keyed by the action, e.g. {"index" : {"_id" : ..., "ok" : true}}
+        result = item.values()[0] if len(item) > 0 else {}
+        successes.append("error" not in result)
+    return successes
+
 class Issue(DomainObject):
     __type__ = 'issue'
 
@@ -253,7 +558,39 @@ class Error(DomainObject):
 class License(DomainObject):
     __type__ = 'license'
 
-class LicenseStatement(DomainObject):
+class PublisherConfigObject(DomainObject):
+    """
+    Base class for the objects which the publisher configurations are made of.  Saving or
+    deleting one bumps the publisher config version.  The index is not refreshed here, so
+    that saving many of them is not slowed down by a refresh for each one; anything which
+    rebuilds itself when the version changes refreshes the index first (see
+    GenericStringMatcherPlugin.config_index)
+    
+    """
+    def save(self, **kwargs):
+        super(PublisherConfigObject, self).save(**kwargs)
+        self._changed()
+    
+    def delete(self):
+        super(PublisherConfigObject, self).delete()
+        self._changed()
+    
+    @classmethod
+    def bulk(cls, bibjson_list, refresh=False):
+        r = super(PublisherConfigObject, cls).bulk(bibjson_list, refresh=refresh)
+        cls._changed()
+        return r
+    
+    @classmethod
+    def delete_all(cls):
+        super(PublisherConfigObject, cls).delete_all()
+        cls._changed()
+    
+    @classmethod
+    def _changed(cls):
+        bump_publisher_config_version()
+
+class LicenseStatement(PublisherConfigObject):
     __type__ = 'license_statement'
 
     @property
@@ -282,6 +619,13 @@ class LicenseStatement(DomainObject):
     @classmethod
     def find_by_statement(cls, statement):
         return cls.q2obj(terms={'license_statement.exact': [statement]}, size=1000000, consistent_order=True)
+    
+    @classmethod
+    def all_statements(cls):
+        """
+        Get all of the licence statements, with only the fields needed to match them against content
+        """
+        return cls.all(source_include=["license_statement", "license_type", "version"])
 
     def save(self, **kwargs):
         t = self.find_by_statement(self.license_statement)
@@ -292,7 +636,7 @@ class LicenseStatement(DomainObject):
 
         super(LicenseStatement, self).save(**kwargs)
 
-class Publisher(DomainObject):
+class Publisher(PublisherConfigObject):
     __type__ = 'publisher'
 
     @property
@@ -377,22 +721,53 @@ class ResultSet(object):
         record -- OAG record object.  See the high level documentation for details on its structure
         
         """
+        section, entry = self.classify_record(record)
+        getattr(self, section).append(entry)
+    
+    def classify_record(self, record):
+        """
+        Determine which part of the response the given record belongs in, and the
+        object which represents it there
         
+        arguments
+        record -- OAG record object.  See the high level documentation for details on its structure
+        
+        returns a tuple of the name of the part of the response ("results", "errors" or "processing")
+            and the object to be placed in it
+        
+        """
         # get the bibjson if it exists
         bibjson = self._get_bibjson(record)
         
         # now find out if it is queued or if the bibjson record is None
-        # and use this information to increment the counters
+        # and use this information to decide where it goes
         # if record.get("error") is not None:
         if record.has_error():
             # self.errors.append({"identifier" : record.get('identifier'), "error" : record.error})
-            self.errors.append({"identifier" : record.identifier, "error" : record.error})
+            return "errors", {"identifier" : record.identifier, "error" : record.error}
         # elif record.get('queued', False) or bibjson is None:
         elif record.queued or bibjson is None:
             # self.processing.append({"identifier" : record.get('identifier')})
-            self.processing.append({"identifier" : record.identifier })
+            return "processing", {"identifier" : record.identifier }
         else:
-            self.results.append(bibjson)
+            return "results", bibjson
+    
+    def json_line(self, record):
+        """
+        Get a single line JSON representation of the given record, for use in streamed
+        (newline delimited JSON) responses.  The line is an object whose only key is the
+        part of the response that the record belongs in, e.g.
+        
+        {"processing" : {"identifier" : {...}}}
+        
+        arguments
+        record -- OAG record object.  See the high level documentation for details on its structure
+        
+        returns a JSON serialisation of the record, without a trailing newline
+        
+        """
+        section, entry = self.classify_record(record)
+        return json.dumps({section : entry})
     
     def json(self):
         """
@@ -700,6 +1075,16 @@ class MessageObject(object):
         if "bibjson" in self.record:
             del self.record["bibjson"]
     
+    @property
+    def fresh_until(self):
+        return self.record.get("bibjson", {}).get("fresh_until")
+    
+    @fresh_until.setter
+    def fresh_until(self, val):
+        if "bibjson" not in self.record:
+            self.record["bibjson"] = {}
+        self.record["bibjson"]["fresh_until"] = val
+    
     # error
     
     @property
@@ -830,11 +1215,17 @@ class MessageObject(object):
         )
     
 @celery.task(name="openarticlegauge.models.flush_buffer")
-def flush_buffer():
+def flush_buffer(shard=None):
     """
     Celery task for flushing the storage buffer.  This should be promoted onto a
-    processing queue by Celery Beat (see the celeryconfig).  This will process will
-    lock the buffer so that parallel execution is not possible.
+    processing queue by Celery Beat (see the celeryconfig), and is also started by
+    Record.store whenever a partition of the buffer grows past its configured size.  This will process will
+    lock the partition of the buffer so that parallel execution is not possible, although
+    different partitions may be flushed in parallel.
+    
+    arguments:
+    shard -- the partition of the buffer to flush.  If omitted and the buffer is partitioned, a
+        separate task is started to flush each of the partitions
     
     returns
     False if no buffering is necessary (configuration) or possible (locked)
@@ -847,25 +1238,34 @@ def flush_buffer():
         log.info("BUFFERING = False ; flush_buffer is superfluous, aborting")
         return False
     
-    # check to see if we are already running a buffering process    
+    # hand each partition of the buffer to its own task, so that they can be flushed by
+    # several workers at once
+    if shard is None and config.BUFFER_PARTITIONS > 1:
+        for s in range(config.BUFFER_PARTITIONS):
+            flush_buffer.apply_async(args=[s])
+        return True
+    if shard is None:
+        shard = 0
+    
+    # take the lease on this partition, so that it isn't flushed twice at the same time.  If the
+    # lease is already held, we are already running a buffering process (either scheduled or
+    # triggered by the size of the buffer).  The lease times out in case we never finish
     client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
-    lock = client.get("flush_buffer_lock")
-    if lock is not None:
+    lock = buffer_key(FLUSH_LOCK, shard)
+    token = uuid.uuid4().hex
+    if not client.set(lock, token, ex=config.BUFFER_FLUSH_LOCK_TIMEOUT, nx=True):
         log.warn("flush_buffer ran before previous iteration had completed - consider increasing the gaps between the run times for this scheduled task")
         return False
     
-    # if we are not already running the buffering process, then carry on...
-    
-    # set a lock on this process, so that it doesn't run twice at the same time (see checks above)
-    client.set("flush_buffer_lock", "lock")
-    
-    # call flush on the record objects that are buffered
-    Record.flush_buffer(key_timeout=config.BUFFER_GRACE_PERIOD, block_size=config.BUFFER_BLOCK_SIZE)
+    # call flush on the record objects that are buffered, renewing the lease as we go
+    Record.flush_buffer(key_timeout=config.BUFFER_GRACE_PERIOD, block_size=config.BUFFER_BLOCK_SIZE, shard=shard, lease=(lock, token))
     
-    # set an expiry time on the lock, which is consistent with the expiry time applied to the 
+    # set an expiry time on the lease, which is consistent with the expiry time applied to the 
     # buffered items.  This means this method will only run again once all the previously buffered
-    # items have been removed from the buffer zone.
-    client.expire("flush_buffer_lock", config.BUFFER_GRACE_PERIOD)
+    # items have been removed from the buffer zone.  If our lease timed out while we were flushing
+    # someone else may hold it now, so we only do this if it is still ours
+    extend = client.register_script(ACKNOWLEDGE_SCRIPT)
+    extend(keys=[lock], args=[token, config.BUFFER_GRACE_PERIOD])
     
     # return true to indicate that the function ran
     return True
@@ -0,0 +1,166 @@
+"""
+Normalisation of the text of web pages (and of the licence statements which are looked
+for in them), so that statements can be found regardless of differences in whitespace,
+case and html markup.
+
+A page is normalised by reducing all runs of whitespace to a single space and making it
+lower case, and its text is then obtained by a single pass of a tokenizer which removes
+html tags and comments, followed by the replacement of html entities with the characters
+they stand for.  The text is given back in the same form bleach.clean (which this replaces)
+gave it, i.e. with "&", "<" and ">" escaped, so statements are compared exactly as they were.
+NormalisedContent holds both forms of a page, and page() memoises them, so that a page which
+is checked against many lists of licence statements (as the generic string matcher does) is
+only normalised once.
+
+The text is worked out from the normalised page, rather than both forms being produced by
+one pass over the raw page, because statements are matched against it after going through
+the same two steps: the spaces either side of a removed tag must be left exactly as they
+are in the normalised page for a statement to line up with it.  Both steps are single
+regular expression passes, and the second is only made if a statement is not found in the
+normalised page as it is.
+
+"""
+
+import re, string, threading, cgi
+from collections import OrderedDict
+from HTMLParser import HTMLParser
+
+whitespace_re = re.compile(r'\s+')
+
+# comments, doctypes and other declarations, processing instructions, and start and end
+# tags (whose attribute values may contain ">").  A "<" which does not start one of these
+# is just text
+html_markup_re = re.compile(
+    r'<!--.*?-->|<![^>]*>|<\?[^>]*>|</?[A-Za-z][^\s/>]*(?:[^>"\']|"[^"]*"|\'[^\']*\')*>',
+    re.DOTALL
+)
+
+# everything other than ASCII letters, digits and the space character
+special_chars_re = re.compile(r'[^A-Za-z0-9 ]+')
+_allowed = string.ascii_letters + string.digits + ' '
+_special_chars = ''.join([chr(i) for i in range(256) if chr(i) not in _allowed])
+
+# the number of pages which each thread keeps the normalised forms of (see page())
+PAGE_CACHE_SIZE = 4
+
+_unescaper = HTMLParser()
+_local = threading.local()
+
+def normalise_whitespace(s):
+    """
+    Reduce 1 or more occurences of whitespace to 1 ' ' blank space, ASCII 0x20.
+    """
+    return whitespace_re.sub(' ', s)
+
+def normalise_string(s, strip=False):
+    """
+    Normalise whitespace and make the string lowercase in 1 go.
+
+    arguments:
+    s -- the string to normalise
+    strip -- if True, also strip html tags and special characters (incl. Unicode)
+
+    """
+    if not s:
+        return s
+
+    if strip:
+        s = strip_html(s)
+        s = strip_special_chars(s)
+
+    s = normalise_whitespace(s)
+    return s.lower()
+
+def strip_html(s):
+    """
+    Remove the html tags and comments from the string, leaving just the text.  Html
+    entities are resolved, and "&", "<" and ">" are then escaped, as bleach.clean did
+    (so "&copy;" becomes a copyright sign and "&amp;" stays as it is).  Unlike bleach,
+    only entities which end with a ";" are resolved
+
+    returns a unicode string
+
+    """
+    s = to_unicode(s)
+    if not s:
+        return s
+    s = html_markup_re.sub('', s)
+    if '&' in s:
+        s = _unescaper.unescape(s)
+    return cgi.escape(s)
+
+def strip_special_chars(s):
+    '''
+    Only allow ASCII lower- and uppercase letters + arabic digits.
+    As well as the ' ', 1 blank space / interval, ASCII 0x20.
+    Note that as a side effect, all other whitespace characters will
+    be deleted as well, e.g. newlines \n and \r.
+    '''
+    if not s:
+        return s
+    if type(s) == str:
+        return s.translate(None, _special_chars)
+    return special_chars_re.sub('', s)
+
+def to_unicode(s):
+    """
+    Decode a (utf-8) byte string, replacing anything which can't be decoded.  Unicode
+    strings are returned as they are
+    """
+    if type(s) == str:
+        return s.decode('utf-8', 'replace')
+    return s
+
+class NormalisedContent(object):
+    """
+    The normalised forms of the content of a page: the normalised content itself (see
+    normalise_string), and the text left when html is stripped from that.  Each is worked
+    out the first time it is needed, and then kept, so a page whose statements are all
+    found in its normalised content is never stripped
+
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self._normalised = None
+        self._stripped = None
+
+    @property
+    def normalised(self):
+        """
+        The content with its whitespace normalised and made lower case, as unicode
+        """
+        if self._normalised is None:
+            self._normalised = to_unicode(normalise_string(self.content)) or u''
+        return self._normalised
+
+    @property
+    def stripped(self):
+        """
+        The normalised content with its html stripped (see strip_html)
+        """
+        if self._stripped is None:
+            self._stripped = strip_html(self.normalised)
+        return self._stripped
+
+def page(content):
+    """
+    Get the NormalisedContent for the content of a page.  The last few pages seen by
+    each thread are remembered, so asking for the same page again costs a dictionary lookup
+
+    arguments:
+    content -- the content of the page
+
+    """
+    pages = getattr(_local, "pages", None)
+    if pages is None:
+        pages = OrderedDict()
+        _local.pages = pages
+
+    normalised = pages.pop(content, None)
+    if normalised is None:
+        normalised = NormalisedContent(content)
+        if len(pages) >= PAGE_CACHE_SIZE:
+            pages.popitem(last=False)
+    pages[content] = normalised
+    return normalised
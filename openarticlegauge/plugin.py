@@ -4,21 +4,23 @@ Common infrastructure for the plugin framework
 """
 
 from openarticlegauge import config
+from openarticlegauge import models
 from openarticlegauge.licenses import LICENSES
 from openarticlegauge import oa_policy
 from openarticlegauge import util
+from openarticlegauge import normalise
 
 import logging
 from copy import deepcopy
 from datetime import datetime
-import bleach
 import requests
 
-import os, imp, string, re
+import os, imp
 
 log = logging.getLogger(__name__)
-whitespace_re = re.compile(r'\s+')
-html_tag_re = re.compile(r'<.*?>')
+
+# the number of compiled statement lists each plugin keeps (see Plugin.statement_matcher)
+MAX_STATEMENT_MATCHERS = 100
 
 class Plugin(object):
     """
@@ -168,6 +170,29 @@ class Plugin(object):
             license_support=license_support
             )
     
+    def dispatch_prefixes(self):
+        """
+        Describe the provider urls which this plugin supports, so that the PluginFactory
+        can route records to it without asking every plugin in turn.
+        
+        Each entry is either a cleaned base url (see clean_url), all urls starting with
+        which are supported, or "*." followed by a domain, in which case urls on any
+        sub-domain of that domain might be supported, and the supports method is asked to
+        confirm it.
+        
+        The default implementation describes the _base_urls of the plugins which use
+        supports_by_base_url.  Plugins which have no _base_urls get None, which means that
+        their support can't be described by url, and their supports method is called for
+        every record.  Plugins which implement supports in some other way should override
+        this method.
+        
+        returns a list of url prefixes, or None
+        
+        """
+        if len(self._base_urls) == 0:
+            return None
+        return [self.clean_url(bu) for bu in self._base_urls]
+    
     ## utilities that the sub-class can take advantage of ##
     
     def supports_by_base_url(self, provider):
@@ -227,7 +252,7 @@ class Plugin(object):
             cleaned_urls.append(self.clean_url(url, strip_leading_www=strip_leading_www))
         return cleaned_urls
 
-    def simple_extract(self, lic_statements, record, url, first_match=False, content='', handler='', extra_license=None, extra_provenance=None):
+    def simple_extract(self, lic_statements, record, url, first_match=False, content='', handler='', extra_license=None, extra_provenance=None, matcher=None):
         """
         Generic code which looks for a particular string in a given web
         page (URL), determines the licence conditions of the article and
@@ -256,6 +281,10 @@ class Plugin(object):
         out all supplied license statements and simply add multiple
         'license' objects to the record it's been passed. If you want
         "first successful match only" behaviour, set this to True.
+
+        :param matcher: the StatementMatcher for lic_statements, if the
+        caller has already compiled one. By default the plugin's own
+        (see statement_matcher) is used.
         """
         if not handler:
             handler = self._short_name  # can't put it in the method signature above, self is unresolved
@@ -274,110 +303,90 @@ class Plugin(object):
         else:
             source_size = len(content)
 
-        content = self.normalise_string(content)
+        page = normalise.page(content)
 
-        if not content:
+        if not page.normalised:
             return
         
-        # see if one of the licensing statements is in content 
-        # and populate record with appropriate license info
-        for statement_mapping in lic_statements:
+        # find the licensing statements which are in the content, in the order they
+        # were given, and populate the record with the appropriate license info
+        if matcher is None:
+            matcher = self.statement_matcher(lic_statements)
+        for i in matcher.matches(page):
+            statement_mapping = lic_statements[i]
             # get the statement string itself - always the first key of the dict
             # mapping statements to licensing info
             statement = statement_mapping.keys()[0]
+            
+            # okay, statement found on the page -> get license type
+            lic_type = statement_mapping[statement]['type']
+
+            # license identified, now use that to construct the license object
+            license = deepcopy(LICENSES[lic_type])
+            license['open_access'] = oa_policy.oa_for_license(lic_type)
+            # set some defaults which have to be there, even if empty
+            license.setdefault('version','')
+            license.setdefault('description','')
+            license.setdefault('jurisdiction','') # TODO later (or later version of OAG!)
+            
+            # Copy over all information about the license from the license
+            # statement mapping. In essence, transfer the knowledge of the 
+            # publisher plugin authors to the license object.
+            # Consequence: Values coming from the publisher plugin overwrite
+            # values specified in the licenses module.
+            license.update(statement_mapping[statement])
+            
+            # add provenance information to the license object
+            provenance = {
+                'date': datetime.strftime(datetime.now(), config.date_format),
+                'source': url,
+                "source_size" : source_size,
+                'agent': config.agent,
+                'category': 'page_scrape', # TODO we need to think how the
+                    # users get to know what the values here mean.. docs?
+                'description': self.gen_provenance_description(url, statement),
+                'handler': handler, # the name of the plugin processing this record
+                'handler_version': self.__version__ # version of the plugin processing this record
+            }
+
+            license['provenance'] = provenance
+
+            # extra fields / meanings provided by plugins
+            license.update(extra_license)
+            license['provenance'].update(extra_provenance)
+
+            record.add_license_object(license)
+            
+            if first_match:
+                break
 
-            # use a modified version of the license statement for
-            # comparison - one which has been subjected to the same
-            # normalisation as the incoming content (whitespace,
-            # lowercasing etc.)
-            cmp_statement = self.normalise_string(statement)
-            # do not try to match empty statements, will always result in a match
-            if not cmp_statement:
-                continue
-
-            # logging.debug(cmp_statement)
-
-            #content = content.decode('utf-8', errors='replace').encode('utf-8', errors='replace')
-            #print 'cmp statement type', type(cmp_statement)
-            #print 'content type', type(content)
-
-            #if type(cmp_statement) == unicode:
-            #    print 'converting cmp_statement to str'
-            #    cmp_statement = cmp_statement.encode('utf-8', 'ignore')
-            #if type(content) == unicode:
-            #    content = content.encode('utf-8', 'ignore')
-
-            if type(cmp_statement) == str:
-                #print 'converting cmp_statement to unicode'
-                cmp_statement = cmp_statement.decode('utf-8', 'replace')
-            if type(content) == str:
-                content = content.decode('utf-8', 'replace')
-
-            #print 'after safeguards'
-            #print 'cmp statement type', type(cmp_statement)
-            #print 'content type', type(content)
-
-            match = cmp_statement in content
-
-            if not match:
-                cmp_statement = self.strip_html(cmp_statement)
-                content = self.strip_html(content)
-                if cmp_statement:  # if there's anything left of the statement after the html stripping...
-                                   # otherwise '' in 'string' == True! so lots of false positives
-                    match = cmp_statement in content
-                else:
-                    continue
-
-            if match:
-                # logging.debug('... matches')
-
-                # okay, statement found on the page -> get license type
-                lic_type = statement_mapping[statement]['type']
-
-                # license identified, now use that to construct the license object
-                license = deepcopy(LICENSES[lic_type])
-                license['open_access'] = oa_policy.oa_for_license(lic_type)
-                # set some defaults which have to be there, even if empty
-                license.setdefault('version','')
-                license.setdefault('description','')
-                license.setdefault('jurisdiction','') # TODO later (or later version of OAG!)
-                
-                # Copy over all information about the license from the license
-                # statement mapping. In essence, transfer the knowledge of the 
-                # publisher plugin authors to the license object.
-                # Consequence: Values coming from the publisher plugin overwrite
-                # values specified in the licenses module.
-                license.update(statement_mapping[statement])
-                
-                # add provenance information to the license object
-                provenance = {
-                    'date': datetime.strftime(datetime.now(), config.date_format),
-                    'source': url,
-                    "source_size" : source_size,
-                    'agent': config.agent,
-                    'category': 'page_scrape', # TODO we need to think how the
-                        # users get to know what the values here mean.. docs?
-                    'description': self.gen_provenance_description(url, statement),
-                    'handler': handler, # the name of the plugin processing this record
-                    'handler_version': self.__version__ # version of the plugin processing this record
-                }
-
-                license['provenance'] = provenance
-
-                # extra fields / meanings provided by plugins
-                license.update(extra_license)
-                license['provenance'].update(extra_provenance)
-
-                record.add_license_object(license)
-                
-                if first_match:
-                    break
-
-            # logging.debug('... does NOT match')
+    def statement_matcher(self, lic_statements):
+        """
+        Get the StatementMatcher for the list of licence statements.  Matchers are compiled
+        the first time each list of statements is seen, and kept on the plugin
+        
+        arguments:
+        lic_statements -- list of {statement: meaning} dicts, as for simple_extract
+        
+        """
+        key = tuple([statement_mapping.keys()[0] for statement_mapping in lic_statements])
+        matchers = self.__dict__.setdefault("_statement_matchers", {})
+        matcher = matchers.get(key)
+        if matcher is None:
+            if len(matchers) >= MAX_STATEMENT_MATCHERS:
+                # the statement lists have changed a lot (e.g. publisher configs have been
+                # edited), so start again rather than holding on to the old ones
+                matchers.clear()
+            matcher = StatementMatcher(key, self.normalise_string, self.strip_html)
+            matchers[key] = matcher
+        return matcher
 
     def strip_html(self, html_str):
-        #html_tag_re.sub('', html_str)
-        return bleach.clean(html_str, tags=[], strip=True, strip_comments=True)
+        """
+        Remove the html tags and comments from the string, leaving just the text.  See
+        normalise.strip_html
+        """
+        return normalise.strip_html(html_str)
 
     def strip_special_chars(self, s):
         '''
@@ -386,20 +395,14 @@ class Plugin(object):
         Note that as a side effect, all other whitespace characters will
         be deleted as well, e.g. newlines \n and \r.
         '''
-        if not s:
-            return s
-
-        allowed = string.ascii_letters + string.digits + ' '
-
-        return ''.join( c for c in s if  c in allowed ) 
-                
+        return normalise.strip_special_chars(s)
 
     def normalise_whitespace(self, s):
         """
         Reduce 1 or more occurences of whitespace to 1 ' ' blank space,
         ASCII 0x20.
         """
-        return whitespace_re.sub(' ', s)
+        return normalise.normalise_whitespace(s)
 
     def normalise_string(self, s, strip=False):
         """
@@ -408,17 +411,7 @@ class Plugin(object):
         :param strip: If True, also strips HTML tags and special
         characters incl. Unicode.
         """
-        if not s:
-            return s
-
-        if strip:
-            s = self.strip_html(s)
-            s = self.strip_special_chars(s)
-
-        s = self.normalise_whitespace(s)
-        s = s.lower()
-
-        return s
+        return normalise.normalise_string(s, strip=strip)
     
     def gen_provenance_description(self, source_url, statement):
         return 'License decided by scraping the resource at ' + source_url + ' and looking for the following license statement: "' + statement + '".'
@@ -441,6 +434,112 @@ class Plugin(object):
             handler_version=self.__version__
         )
 
+class StatementMatcher(object):
+    """
+    Finds which of a list of licence statements appear in a page.
+    
+    The statements are normalised (and stripped of html) once, when the matcher is built.
+    A statement matches if its normalised form is in the normalised page, or if what is
+    left of it after stripping html is in the stripped page.
+    
+    """
+    
+    def __init__(self, statements, normalise_string, strip):
+        """
+        arguments:
+        statements -- list of the licence statement strings, in the order they should be tried
+        normalise_string -- function which normalises a string in the same way as pages are (see Plugin.normalise_string)
+        strip -- function which strips html from a unicode string (see Plugin.strip_html)
+        
+        """
+        self.statements = []
+        for i, statement in enumerate(statements):
+            cmp_statement = normalise.to_unicode(normalise_string(statement))
+            # do not try to match empty statements, will always result in a match
+            if not cmp_statement:
+                continue
+            self.statements.append((i, cmp_statement, strip(cmp_statement)))
+    
+    def matches(self, page):
+        """
+        Generate the positions (in the list the matcher was built from) of the statements
+        which appear in the page, in order.  The page is only stripped of html if one of
+        the statements is not found in it as it is, so callers which only want the first
+        match should stop iterating once they have it
+        
+        arguments:
+        page -- the normalise.NormalisedContent of the page
+        
+        """
+        for i, cmp_statement, stripped_statement in self.statements:
+            if cmp_statement in page.normalised:
+                yield i
+                continue
+            # if there's nothing left of the statement after the html stripping, then
+            # '' in 'string' == True! so lots of false positives
+            if stripped_statement and stripped_statement in page.stripped:
+                yield i
+
+class PrefixTrie(object):
+    """
+    Maps strings (e.g. cleaned urls) to values, and finds the values of all the strings
+    which are prefixes of a given string in one walk along it, however many strings the
+    trie holds.
+    
+    """
+    
+    def __init__(self):
+        # each node is a dict of the next character to the node for it; a node which ends
+        # a key also holds that key's value under None
+        self._root = {}
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    def insert(self, key, value):
+        """
+        Add the key to the trie with the given value, replacing its value if it is already there
+        """
+        node = self._root
+        for c in key:
+            node = node.setdefault(c, {})
+        if None not in node:
+            self._size += 1
+        node[None] = value
+    
+    def prefix_matches(self, s):
+        """
+        Get the keys in the trie which are prefixes of (or equal to) the string, and their values
+        
+        returns a list of (key, value) tuples, longest key first
+        
+        """
+        matches = []
+        node = self._root
+        if None in node:
+            matches.append(("", node[None]))
+        for i, c in enumerate(s):
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                matches.append((s[:i + 1], node[None]))
+        matches.reverse()
+        return matches
+    
+    def longest_prefix_match(self, s):
+        """
+        Get the longest key in the trie which is a prefix of the string, and its value
+        
+        returns a (key, value) tuple, or None if no key is a prefix of the string
+        
+        """
+        matches = self.prefix_matches(s)
+        if matches:
+            return matches[0]
+        return None
+
 class PluginDescription(object):
     def __init__(self, name=None, version=None, description=None, provider_support=None, license_support=None, edit_id=None):
         self.name = name
@@ -464,6 +563,9 @@ class PluginFactory(object):
     
     MODULE_EXTENSIONS = ('.py',) # only interested in .py files, not pyc or pyo
     PLUGIN_CONFIG = None
+    
+    # the plugin descriptions worked out so far, see _description_registry
+    DESCRIPTIONS = None
 
     @classmethod
     def load_from_directory(cls, plugin_dir=None, klazz=Plugin):
@@ -528,7 +630,71 @@ class PluginFactory(object):
             plugin_structure["detect_provider"][t] = cls._prioritise(plugin_structure["detect_provider"].get(t, []))
         plugin_structure["license_detect"] = cls._prioritise(plugin_structure.get("license_detect", []))
         
+        # compile the url support of the licence plugins, so they can be found with a lookup
+        plugin_structure["license_dispatch"] = cls._compile_dispatch(plugin_structure["license_detect"])
+        
         cls.PLUGIN_CONFIG = plugin_structure
+    
+    @classmethod
+    def _compile_dispatch(cls, plugin_instances):
+        """
+        Build the table which routes provider urls to the plugins in the (prioritised) list
+        which support them.  Plugins are referred to by their position in the list, so the
+        lowest numbered plugin which supports a url is the one with the highest priority
+        
+        returns a dict of the form
+        
+        {
+            "prefixes" : PrefixTrie of "<cleaned url prefix>" : [<position>],
+            "domains" : {"<domain>" : [<position>]},
+            "dynamic" : [<position>]
+        }
+        
+        where "prefixes" are the plugins which support every cleaned url starting with the
+        prefix (just as Plugin.supports_base_url compares them), "domains" are the plugins
+        which might support any sub-domain of the domain, and "dynamic" are the plugins
+        which have to be asked about every record
+        
+        """
+        prefixes = {}
+        dispatch = {"prefixes" : PrefixTrie(), "domains" : {}, "dynamic" : []}
+        for i, inst in enumerate(plugin_instances):
+            plugin_prefixes = inst.dispatch_prefixes()
+            if plugin_prefixes is None:
+                dispatch["dynamic"].append(i)
+                continue
+            for prefix in plugin_prefixes:
+                if prefix.startswith("*."):
+                    dispatch["domains"].setdefault(prefix[2:].lower(), []).append(i)
+                else:
+                    prefixes.setdefault(prefix, []).append(i)
+        for prefix, positions in prefixes.iteritems():
+            dispatch["prefixes"].insert(prefix, positions)
+        return dispatch
+    
+    @classmethod
+    def _dispatch(cls, dispatch, urls):
+        """
+        Look up the plugins which support the urls in the dispatch table
+        
+        returns a tuple of the positions of the plugins which support the urls, and those
+        which might support them and need to be asked
+        
+        """
+        supported = set()
+        possible = set()
+        for url in urls:
+            cleaned = Plugin.clean_url(url)
+            for prefix, positions in dispatch["prefixes"].prefix_matches(cleaned):
+                supported.update(positions)
+            
+            # the sub-domain rules are only a first cut, which the plugins confirm, so the
+            # host is looked at without its case or any port
+            host = cleaned.partition("/")[0].partition(":")[0].lower()
+            labels = host.split(".")
+            for j in range(1, len(labels)):
+                possible.update(dispatch["domains"].get(".".join(labels[j:]), []))
+        return supported, possible
 
     @classmethod
     def _prioritise(cls, plugin_instances):
@@ -614,9 +780,18 @@ class PluginFactory(object):
         if cls.PLUGIN_CONFIG is None:
             cls.load_from_directory()
         
-        for inst in cls.PLUGIN_CONFIG.get("license_detect"):
-            if inst.supports(provider_record):
-                return inst
+        plugins = cls.PLUGIN_CONFIG.get("license_detect")
+        dispatch = cls.PLUGIN_CONFIG.get("license_dispatch")
+        if dispatch is None:
+            dispatch = cls._compile_dispatch(plugins)
+            cls.PLUGIN_CONFIG["license_dispatch"] = dispatch
+        
+        # only the plugins which the urls route to, and those which can't be routed to by
+        # url, need to be considered, in order of priority
+        supported, possible = cls._dispatch(dispatch, provider_record.get("url", []))
+        for i in sorted(supported | possible | set(dispatch["dynamic"])):
+            if i in supported or plugins[i].supports(provider_record):
+                return plugins[i]
         return None
     
     @classmethod
@@ -636,9 +811,15 @@ class PluginFactory(object):
         if plugin_name == "oag":
             return cls._oag_plugin_description()
         
+        registry = cls._description_registry()
+        description = registry["names"].get(plugin_name)
+        if description is not None:
+            return description
+        
         for inst in cls.PLUGIN_CONFIG.get("all"):
             if inst.has_name(plugin_name):
                 description = inst.get_description(plugin_name)
+                registry["names"][plugin_name] = description
                 return description
 
     @classmethod
@@ -646,6 +827,11 @@ class PluginFactory(object):
         if cls.PLUGIN_CONFIG is None:
             cls.load_from_directory()
         
+        registry = cls._description_registry()
+        descriptions = registry["lists"].get((category, sort_for_display))
+        if descriptions is not None:
+            return list(descriptions)
+        
         descriptions = []
         
         instances = []
@@ -657,15 +843,38 @@ class PluginFactory(object):
         if sort_for_display:
             # plugins with multiple configs first, they won't be affected by the
             # _short_name condition (it's the same on all their instances)
-            # then sort by short name
-            instances.sort(key=lambda x: (-len(x.get_names()), getattr(x, '_short_name', '')))
+            # then sort by short name.  Sort a copy, the lists in PLUGIN_CONFIG are
+            # in priority order
+            instances = sorted(instances, key=lambda x: (-len(x.get_names()), getattr(x, '_short_name', '')))
 
         for inst in instances:
             names = inst.get_names()
             for name in names:
-                descriptions.append(inst.get_description(name))
+                description = registry["names"].get(name)
+                if description is None:
+                    description = inst.get_description(name)
+                    registry["names"][name] = description
+                descriptions.append(description)
+        
+        registry["lists"][(category, sort_for_display)] = descriptions
+        return list(descriptions)
+    
+    @classmethod
+    def _description_registry(cls):
+        """
+        Get the registry of the plugin descriptions worked out so far, which holds the
+        descriptions by plugin name, and the lists of descriptions made by list_plugins.
+        Descriptions of the publisher configs change whenever the configs do, so the
+        registry is emptied whenever the publisher config version changes (or the plugins
+        are reloaded)
         
-        return descriptions
+        """
+        version = models.publisher_config_version()
+        registry = cls.DESCRIPTIONS
+        if registry is None or registry["version"] != version or registry["plugin_config"] is not cls.PLUGIN_CONFIG:
+            registry = {"version" : version, "plugin_config" : cls.PLUGIN_CONFIG, "names" : {}, "lists" : {}}
+            cls.DESCRIPTIONS = registry
+        return registry
     
     @classmethod
     def _oag_plugin_description(cls):
@@ -57,6 +57,12 @@ class BMJPlugin(plugin.Plugin):
             return True
         return False
     
+    def dispatch_prefixes(self):
+        """
+        The supported url format only matches sub-domains of bmj.com
+        """
+        return ["*.bmj.com"]
+    
     def license_detect(self, record):
         """
         To respond to the provider identifier: *.bmj.com
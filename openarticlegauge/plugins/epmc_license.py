@@ -1,4 +1,5 @@
 from openarticlegauge import plugin
+from openarticlegauge import models
 from openarticlegauge.models import Publisher
 from openarticlegauge.util import http_stream_get
 
@@ -13,7 +14,7 @@ class EPMCLicensePlugin(plugin.Plugin):
     __desc__ = \
 """Obtains licenses from articles present in EuropePMC
 
-It will use all license statements from registered publishers who have these URLs: {urls}
+It will use the license statements of the registered publishers whose URLs match the article's URL (the longest matching URL first), e.g. publishers with these URLs: {urls}
 
 So ideally EuropePMC will be registered as a publisher. If it fails to find it, the plugin will fall back to some hardcoded license statements.
 """.format(urls=", ".join(_base_urls))
@@ -53,25 +54,50 @@ So ideally EuropePMC will be registered as a publisher. If it fails to find it,
         """
         return self.supports_by_base_url(provider)
 
+    def publisher_trie(self):
+        """
+        Get a PrefixTrie of the journal urls of the registered publishers within this
+        plugin's domains, mapped to the lists of publishers with each url.  The trie is kept until the publisher
+        config version changes (see models.publisher_config_version)
+        """
+        version = models.publisher_config_version()
+        cached = self.__dict__.get("_publisher_trie")
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        
+        base_urls = [self.clean_url(bu) for bu in self._base_urls]
+        publishers_by_url = {}
+        for pub in Publisher.all(sort=[{'publisher_name': 'asc'}], source_include=["id", "publisher_name", "journal_urls", "licenses"]):
+            for journal_url in pub['journal_urls']:
+                cjurl = self.clean_url(journal_url)
+                for cburl in base_urls:
+                    if cjurl.startswith(cburl):
+                        publishers_by_url.setdefault(cjurl, []).append(pub)
+                        break
+        
+        trie = plugin.PrefixTrie()
+        for cjurl, pubs in publishers_by_url.iteritems():
+            trie.insert(cjurl, pubs)
+        self.__dict__["_publisher_trie"] = (version, trie)
+        return trie
+    
     def license_detect(self, record):
-
-        relevant_publishers = []
-        for bu in self._base_urls:
-            cburl = self.clean_url(bu)
-            relevant_publishers += Publisher.find_by_journal_url('http://' + cburl)
-
-        lic_statements = []
-        for pub in relevant_publishers:
-            for l in pub['licenses']:
-                lic_statement = {}
-                lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l.get('version', '')}
-                lic_statements.append(lic_statement)
-
-        if not lic_statements:
-            lic_statements = self._license_mappings
+        trie = self.publisher_trie()
 
         for url in record.provider_urls:
             if self.supports_base_url(url):
+                # use the statements of the publishers whose urls match this one, longest url first
+                lic_statements = []
+                for journal_url, pubs in trie.prefix_matches(self.clean_url(url)):
+                    for pub in pubs:
+                        for l in pub['licenses']:
+                            lic_statement = {}
+                            lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l.get('version', '')}
+                            lic_statements.append(lic_statement)
+
+                if not lic_statements:
+                    lic_statements = self._license_mappings
+
                 # TODO refactor self.simple_extract into several pieces
                 # a downloader, a matcher, and a f() that records the license info
                 # so the first two (and perhaps a general version of the third)
@@ -5,11 +5,15 @@ It's a bit special - instead of storing what license statements match to what li
 in the code, it fetches these (called Publisher configurations) from the database.
 """
 import requests
+import threading
 from openarticlegauge import plugin
+from openarticlegauge import models
 from openarticlegauge.models import Publisher, LicenseStatement
 from openarticlegauge import util
 
-from collections import OrderedDict
+# the PublisherConfigIndex for this process, see GenericStringMatcherPlugin.config_index
+_config_index = None
+_config_index_lock = threading.Lock()
 
 
 class GenericStringMatcherPlugin(plugin.Plugin):
@@ -30,9 +34,7 @@ class GenericStringMatcherPlugin(plugin.Plugin):
         """
         Return the list of names of configurations supported by the GSM
         """
-        configs = Publisher.all(sort=[{"publisher_name.exact" : {"order" : "asc"}}])
-        names = [p['publisher_name'] for p in configs]
-        return names
+        return self.config_index().names
     
     def capabilities(self):
         return {
@@ -81,61 +83,56 @@ class GenericStringMatcherPlugin(plugin.Plugin):
             edit_id=p['id']
         )
     
+    def config_index(self):
+        """
+        Get the PublisherConfigIndex of the current publisher configurations and licence
+        statements.  The index is built once per process, and only rebuilt when the
+        publisher config version changes (see models.publisher_config_version).  The changes
+        which bumped the version may not be searchable yet, so the index is refreshed before
+        the configs are read
+        """
+        global _config_index
+        version = models.publisher_config_version()
+        index = _config_index
+        if index is not None and index.version == version:
+            return index
+        
+        with _config_index_lock:
+            index = _config_index
+            if index is None or index.version != version:
+                Publisher.refresh()
+                LicenseStatement.refresh()
+                all_configs = Publisher.all(sort=[{'publisher_name': 'asc'}],  # always get them in the same order relative to each other
+                                            source_include=["id", "publisher_name", "journal_urls", "licenses"])
+                all_statements = LicenseStatement.all_statements()
+                index = PublisherConfigIndex(version, all_configs, all_statements, self)
+                _config_index = index
+        return index
+    
     def license_detect(self, record):
-        # get all the URL-s from ES into a list
-        #     need some way of getting facets from the DAO, ideally
-        #     directly in list form as well as the raw form
-        all_configs = Publisher.all(sort=[{'publisher_name': 'asc'}])  # always get them in the same order relative to each other
-        url_index = self._generate_publisher_config_index_by_url(all_configs)
-        url_index = OrderedDict(sorted(url_index.iteritems(), key=lambda x: len(x[0]), reverse=True))  # longest url-s first
-        id_index = self._generate_publisher_config_index_by_id(all_configs)
-
+        index = self.config_index()
+        
         # get all the configs that match
-        matching_configs = []
         work_on = record.provider_urls
         work_on = self.clean_urls(work_on, strip_leading_www=True)
+        matching_configs = index.matching_configs(work_on)
 
-        for config_url, config_id in url_index.items():
-            for incoming_url in work_on:
-                if incoming_url.startswith(config_url):
-                    matching_configs.append(id_index[config_id])
-        # future:
-        # use tries to prefix match them to the incoming URL
-        #     if the results of this could be ordered by URL length that
-        #     would be great, or stop at first match option
-
-        urls_contents = {}
-        # prefetch the content, we'll be reusing it a lot
-        for incoming_url in record.provider_urls:
-            unused_response, urls_contents[incoming_url], unused_content_length = util.http_stream_get(incoming_url)
-
-        # order their license statements by whether they have a version,
-        # and then by length
+        # the content of each url is only fetched the first time a config (or the flat
+        # list) needs it, and is then kept, as it may be reused a lot
+        fetched = {}
 
         successful_config = None
         current_licenses_count = len(record.license)
         new_licenses_count = 0
         for config in matching_configs:
-            matching_config_licenses = config['licenses']
-
-            matching_config_licenses = sorted(
-                matching_config_licenses,
-                key=lambda lic: (
-                    lic.get('version'),  # with reverse=True, this will actually sort licenses in REVERSE ALPHABETICAL order of their versions, blank versions go last
-                    len(lic['license_statement'])  # longest first with reverse=True
-                ),
-                reverse=True
-            )
+            # the config's license statements are already ordered by whether they have
+            # a version, and then by length
+            lic_statements, matcher = index.statements_for(config)
+            if not matcher.statements:
+                continue
 
-            # try matching like that
-            lic_statements = []
-            for l in matching_config_licenses:
-                lic_statement = {}
-                lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l['version']}
-                lic_statements.append(lic_statement)
-
-            for incoming_url, content in urls_contents.iteritems():
-                self.simple_extract(lic_statements, record, incoming_url, first_match=True, content=content, handler=config.publisher_name)
+            for incoming_url, content in self._fetch_contents(record.provider_urls, fetched):
+                self.simple_extract(lic_statements, record, incoming_url, first_match=True, content=content, handler=config.publisher_name, matcher=matcher)
                 new_licenses_count = len(record.license)
                 # if we find a license, stop trying the different URL-s
                 if new_licenses_count > current_licenses_count:
@@ -150,27 +147,10 @@ class GenericStringMatcherPlugin(plugin.Plugin):
         # do not try the flat list of statements if a matching config has been found
         # this keeps these "virtual" plugins, i.e. the configs, consistent with how
         # the rest of the system operates
-        lic_statements = []
         flat_license_list_success = False
-        if len(matching_configs) <= 0:
-            all_statements = LicenseStatement.all()
-            all_statements = sorted(
-                all_statements,
-                key=lambda lic: (
-                    lic.get('version', '') == '',  # does it NOT have a version? last!
-                    # see http://stackoverflow.com/questions/9386501/sorting-in-python-and-empty-strings
-
-                    len(lic['license_statement'])  # length of license statement
-                )
-            )
-
-            for l in all_statements:
-                lic_statement = {}
-                lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l.get('version', '')}
-                lic_statements.append(lic_statement)
-
-            for incoming_url, content in urls_contents.iteritems():
-                self.simple_extract(lic_statements, record, incoming_url, first_match=True, content=content)  # default handler - the plugin's name
+        if len(matching_configs) <= 0 and index.flat_matcher.statements:
+            for incoming_url, content in self._fetch_contents(record.provider_urls, fetched):
+                self.simple_extract(index.flat_statements, record, incoming_url, first_match=True, content=content, matcher=index.flat_matcher)  # default handler - the plugin's name
                 new_licenses_count = len(record.license)
                 # if we find a license, stop trying the different URL-s
                 if new_licenses_count > current_licenses_count:
@@ -193,12 +173,22 @@ class GenericStringMatcherPlugin(plugin.Plugin):
         return 'oag', self.__version__
 
     @staticmethod
-    def longest_prefix_match(search, urllist):
-        matches = [url for url in urllist if url.startswith(search)]
-        if matches:
-            return max(matches, key=len)
-        else:
-            return ''
+    def _fetch_contents(urls, fetched):
+        """
+        Generate the (url, content) of each of the urls which has any content, in order,
+        only fetching a url when it is reached.  Callers should stop iterating as soon as
+        they have what they need, so that the remaining urls are not fetched at all
+        
+        arguments:
+        urls -- the urls whose content is wanted
+        fetched -- dict of the contents of urls fetched so far, which is added to
+        
+        """
+        for url in urls:
+            if url not in fetched:
+                unused_response, fetched[url], unused_content_length = util.http_stream_get(url)
+            if fetched[url]:
+                yield url, fetched[url]
 
     def _generate_publisher_config_index_by_url(self, all_configs):
         res = {}
@@ -213,3 +203,99 @@ class GenericStringMatcherPlugin(plugin.Plugin):
         for c in all_configs:
             res[c['id']] = c
         return res
+
+
+class PublisherConfigIndex(object):
+    """
+    The publisher configurations and licence statements, compiled into the form the GSM
+    uses them in: a PrefixTrie of the configs' urls, and the licence statements of
+    each config (and the flat list of all statements) in the order they are to be tried,
+    along with their StatementMatchers
+    
+    """
+    
+    def __init__(self, version, all_configs, all_statements, gsm):
+        """
+        arguments:
+        version -- the publisher config version the index was built from
+        all_configs -- list of all the Publisher objects
+        all_statements -- list of all the licence statements (see LicenseStatement.all_statements)
+        gsm -- the GenericStringMatcherPlugin, which does the url cleaning and statement matching
+        
+        """
+        self.version = version
+        
+        self.url_trie = plugin.PrefixTrie()
+        for config_url, config_id in gsm._generate_publisher_config_index_by_url(all_configs).iteritems():
+            self.url_trie.insert(config_url, config_id)
+        self.id_index = gsm._generate_publisher_config_index_by_id(all_configs)
+        
+        self.names = sorted([c['publisher_name'] for c in all_configs])
+        
+        self._statements = {}
+        for config in all_configs:
+            # order their license statements by whether they have a version,
+            # and then by length
+            matching_config_licenses = sorted(
+                config['licenses'],
+                key=lambda lic: (
+                    lic.get('version'),  # with reverse=True, this will actually sort licenses in REVERSE ALPHABETICAL order of their versions, blank versions go last
+                    len(lic['license_statement'])  # longest first with reverse=True
+                ),
+                reverse=True
+            )
+            lic_statements = []
+            for l in matching_config_licenses:
+                lic_statement = {}
+                lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l['version']}
+                lic_statements.append(lic_statement)
+            self._statements[config['id']] = (lic_statements, self._matcher(gsm, lic_statements))
+        
+        all_statements = sorted(
+            all_statements,
+            key=lambda lic: (
+                lic.get('version', '') == '',  # does it NOT have a version? last!
+                # see http://stackoverflow.com/questions/9386501/sorting-in-python-and-empty-strings
+
+                len(lic['license_statement'])  # length of license statement
+            )
+        )
+        self.flat_statements = []
+        for l in all_statements:
+            lic_statement = {}
+            lic_statement[l['license_statement']] = {'type': l['license_type'], 'version': l.get('version', '')}
+            self.flat_statements.append(lic_statement)
+        self.flat_matcher = self._matcher(gsm, self.flat_statements)
+    
+    def matching_configs(self, urls):
+        """
+        Get the configs which have a url that one of the given (cleaned) urls starts with,
+        those with the longest matching url first
+        
+        arguments:
+        urls -- list of the urls to match, as cleaned by clean_urls with strip_leading_www
+        
+        """
+        matches = []
+        for incoming_url in urls:
+            matches += self.url_trie.prefix_matches(incoming_url)
+        matches.sort(key=lambda x: len(x[0]), reverse=True)  # longest url-s first
+        
+        matching_configs = []
+        seen = set()
+        for config_url, config_id in matches:
+            if config_id not in seen:
+                matching_configs.append(self.id_index[config_id])
+                seen.add(config_id)
+        return matching_configs
+    
+    def statements_for(self, config):
+        """
+        Get the ordered list of licence statements of the config, and their StatementMatcher
+        """
+        return self._statements[config['id']]
+    
+    @staticmethod
+    def _matcher(gsm, lic_statements):
+        statements = [statement_mapping.keys()[0] for statement_mapping in lic_statements]
+        return plugin.StatementMatcher(statements, gsm.normalise_string, gsm.strip_html)
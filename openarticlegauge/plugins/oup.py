@@ -117,6 +117,12 @@ class OUPPlugin(plugin.Plugin):
             return True
         return False
     
+    def dispatch_prefixes(self):
+        """
+        The supported url format only matches sub-domains of oxfordjournals.org
+        """
+        return ["*.oxfordjournals.org"]
+    
     def license_detect(self, record):
         """
         To respond to the provider identifier: *.oxfordjournals.org
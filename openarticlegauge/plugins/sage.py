@@ -46,6 +46,12 @@ class SagePlugin(plugin.Plugin):
             return True
         return False
     
+    def dispatch_prefixes(self):
+        """
+        The supported url format only matches sub-domains of sagepub.com
+        """
+        return ["*.sagepub.com"]
+    
     def license_detect(self, record):
         """
         To respond to the provider identifier: *.sagepub.com
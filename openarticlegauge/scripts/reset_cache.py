@@ -0,0 +1,7 @@
+from openarticlegauge import cache
+
+if __name__ == "__main__":
+    # start a new cache generation, which every process will switch to within
+    # CACHE_GENERATION_REFRESH seconds.  The old entries expire by themselves
+    generation = cache.bump_generation()
+    print "cache generation is now " + str(generation)
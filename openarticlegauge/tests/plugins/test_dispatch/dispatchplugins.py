@@ -0,0 +1,34 @@
+from openarticlegauge import plugin
+import re
+
+class BaseURLPlugin(plugin.Plugin):
+    __version__ = "1.0"
+    _short_name = "base_url_plugin"
+    _base_urls = ["http://www.journals.org/open", "www.other.org"]
+    def capabilities(self):
+        return {"license_detect" : True}
+    def supports(self, provider):
+        return self.supports_by_base_url(provider)
+
+class FormatPlugin(plugin.Plugin):
+    __version__ = "1.0"
+    _short_name = "format_plugin"
+    __priority__ = 100
+    def capabilities(self):
+        return {"license_detect" : True}
+    def supports(self, provider):
+        for url in provider.get("url", []):
+            if re.match("http://.+?\.format.com/articles/.+", url):
+                return True
+        return False
+    def dispatch_prefixes(self):
+        return ["*.format.com"]
+
+class DynamicPlugin(plugin.Plugin):
+    __version__ = "1.0"
+    _short_name = "dynamic_plugin"
+    __priority__ = -100
+    def capabilities(self):
+        return {"license_detect" : True}
+    def supports(self, provider):
+        return "http://dynamic.org" in provider.get("url", [])
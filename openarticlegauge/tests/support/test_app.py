@@ -1,4 +1,4 @@
-from flask import Flask, Response
+from flask import Flask, Response, request
 from time import sleep
 import sys
 import argparse
@@ -31,6 +31,25 @@ def stream_long_timeout():
 
     return Response(generate())
 
+@app.route('/stream/resumable')
+def stream_resumable():
+    # the connection stalls half way through, unless the rest is asked for with a range request
+    content = 'HHHH'
+    range_header = request.headers.get('Range')
+    if range_header:
+        offset = int(range_header[len('bytes='):].split('-')[0])
+        resp = Response(content[offset:], status=206)
+        resp.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(offset, len(content) - 1, len(content))
+        return resp
+
+    def generate():
+        for i, char in enumerate(content):
+            yield char
+            if i == 1:
+                sleep(31)
+
+    return Response(generate())
+
 @app.route('/timeout')
 def static_timeout():
     sleep(5)
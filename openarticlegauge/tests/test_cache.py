@@ -14,7 +14,7 @@ config.REDIS_CACHE_HOST = test_host
 config.REDIS_CACHE_PORT = test_port
 config.REDIS_CACHE_DB = test_db
 
-import redis, json, datetime
+import redis, json, datetime, time
 from openarticlegauge import cache, models
 
 class TestWorkflow(TestCase):
@@ -28,6 +28,7 @@ class TestWorkflow(TestCase):
     def tearDown(self):
         client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
         client.delete("exists")
+        client.delete("exists2")
         client.delete("corrupt")
 
         # set the config values back
@@ -70,6 +71,26 @@ class TestWorkflow(TestCase):
         corrupt = client.get("corrupt")
         assert corrupt is None
         
+    def test_04a_check_cache_multi(self):
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        client.set("exists", json.dumps({"key" : "value"}))
+        client.set("exists2", json.dumps({"key" : "value2"}))
+        client.setex("corrupt", 2, "{askjdfafds}")
+        
+        results = cache.check_cache_multi(["exists", "not_exists", "corrupt", "exists2"])
+        assert len(results) == 4
+        assert results[0].record["key"] == "value"
+        assert results[1] is None
+        assert results[2] is None
+        assert results[3].record["key"] == "value2"
+        
+        # the corrupt entry should have been removed
+        corrupt = client.get("corrupt")
+        assert corrupt is None
+        
+        # and an empty request should not touch the cache at all
+        assert cache.check_cache_multi([]) == []
+        
     def test_05_is_stale_unlicenced(self):
         # bibjson = {}
         record = models.MessageObject(record={"bibjson" : {}})
@@ -181,3 +202,140 @@ class TestWorkflow(TestCase):
         
         
         
+    
+    def test_12_local_cache(self):
+        l1 = cache.LocalCache(2, 60)
+        l1.set("one", {"key" : "value"})
+        l1.set("two", {"key" : "value2"})
+        
+        # each get is a copy which can be modified safely
+        obj = l1.get("one")
+        obj["key"] = "changed"
+        assert l1.get("one")["key"] == "value"
+        
+        # "two" is now the least recently used, so goes first
+        l1.set("three", {"key" : "value3"})
+        assert len(l1) == 2
+        assert l1.get("two") is None
+        assert l1.get("one") is not None
+        
+        l1.evict("one")
+        assert l1.get("one") is None
+        
+        # expired entries are not returned
+        l1 = cache.LocalCache(2, -1)
+        l1.set("one", {"key" : "value"})
+        assert l1.get("one") is None
+    
+    def test_12a_local_cache_invalidation_race(self):
+        l1 = cache.LocalCache(2, 60)
+        
+        # a record read before its key was invalidated is not stored
+        stamp = l1.stamp()
+        l1.evict("one")
+        assert not l1.set("one", {"key" : "stale"}, stamp)
+        assert l1.get("one") is None
+        
+        # but one read afterwards is, as are other keys read at the same time
+        assert l1.set("one", {"key" : "fresh"}, l1.stamp())
+        assert l1.set("two", {"key" : "value"}, stamp)
+        assert l1.get("one")["key"] == "fresh"
+        
+        # once the eviction is forgotten, reads from before it are refused for every key
+        l1.evict("two")
+        l1.evict("three")
+        l1.evict("four")
+        assert not l1.set("five", {"key" : "value"}, stamp)
+        
+        # as are all reads from before a clear
+        stamp = l1.stamp()
+        l1.clear()
+        assert not l1.set("six", {"key" : "value"}, stamp)
+    
+    def test_13_l1_cache(self):
+        old_enabled = config.CACHE_L1_ENABLED
+        config.CACHE_L1_ENABLED = True
+        try:
+            client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+            client.set("exists", json.dumps({"key" : "value"}))
+            
+            # the first look up populates the in-process cache ...
+            assert cache.check_cache("exists").record["key"] == "value"
+            
+            # ... so later ones don't need redis
+            client.delete("exists")
+            assert cache.check_cache("exists").record["key"] == "value"
+            assert cache.check_cache_multi(["exists", "not_exists"])[0].record["key"] == "value"
+            
+            # writing through the cache module clears the in-process copy
+            cache.cache("exists", models.MessageObject(record={"key" : "value2"}))
+            assert cache.check_cache("exists").record["key"] == "value2"
+            
+            cache.invalidate("exists")
+            assert cache.check_cache("exists") is None
+        finally:
+            config.CACHE_L1_ENABLED = old_enabled
+            cache.L1.clear()
+    
+    def test_14_calculate_fresh_until(self):
+        config.licence_stale_time = 15552000 # 6 months
+        
+        # no usable dates means the record is always stale
+        record = models.MessageObject(record={"bibjson" : {'license' : [{'provenance' : {'date' : "whenever"}}]}})
+        assert cache.calculate_fresh_until(record) == 0
+        
+        # otherwise it is fresh until 6 months after the most recent date
+        n = datetime.datetime.now().replace(microsecond=0)
+        threemonths = datetime.timedelta(days=90)
+        oneyear = datetime.timedelta(days=365)
+        bibjson = {'license' : [
+                        {'provenance' : {'date' : datetime.datetime.strftime(n - oneyear, "%Y-%m-%dT%H:%M:%SZ")}},
+                        {'provenance' : {'date' : datetime.datetime.strftime(n - threemonths, "%Y-%m-%dT%H:%M:%SZ")}}
+                  ]}
+        record = models.MessageObject(record={"bibjson" : bibjson})
+        expected = time.mktime((n - threemonths).timetuple()) + config.licence_stale_time
+        assert cache.calculate_fresh_until(record) == expected
+    
+    def test_15_is_stale_fresh_until(self):
+        # the precomputed deadline is used in preference to the licence dates
+        bibjson = {'license' : [{'provenance' : {'date' : "whenever"}}], "fresh_until" : time.time() + 100}
+        record = models.MessageObject(record={"bibjson" : bibjson})
+        assert not cache.is_stale(record)
+        
+        bibjson["fresh_until"] = time.time() - 100
+        assert cache.is_stale(record)
+        
+        # but a record without a licence is always stale
+        record = models.MessageObject(record={"bibjson" : {"fresh_until" : time.time() + 100}})
+        assert cache.is_stale(record)
+    
+    def test_16_generations(self):
+        client = redis.StrictRedis(host=test_host, port=test_port, db=test_db)
+        old_generation = client.get(config.CACHE_GENERATION_KEY)
+        old_refresh = config.CACHE_GENERATION_REFRESH
+        config.CACHE_GENERATION_REFRESH = 0
+        try:
+            cache.cache("exists", models.MessageObject(record={"key" : "value"}))
+            assert cache.check_cache("exists") is not None
+            
+            # after a bump, the old entry is no longer seen, but is still there to expire by itself
+            generation = cache.bump_generation()
+            assert cache.check_cache("exists") is None
+            assert cache.check_cache_multi(["exists"]) == [None]
+            
+            # and new entries are stored under the new generation
+            cache.cache("exists", models.MessageObject(record={"key" : "value2"}))
+            assert cache.check_cache("exists").record["key"] == "value2"
+            assert client.get("g" + str(generation) + ":exists") is not None
+            
+            cache.invalidate("exists")
+            assert client.get("g" + str(generation) + ":exists") is None
+            client.delete("exists")
+        finally:
+            config.CACHE_GENERATION_REFRESH = old_refresh
+            if old_generation is None:
+                client.delete(config.CACHE_GENERATION_KEY)
+            else:
+                client.set(config.CACHE_GENERATION_KEY, old_generation)
+            # make sure the next look up re-reads the generation
+            cache._generation = (0, None)
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from openarticlegauge import codec
+import json
+
+RECORD = {
+    "identifier" : {"id" : "10.1", "type" : "doi", "canonical" : "doi:10.1"},
+    "bibjson" : {
+        "title" : u"a title with unicode \u00e9",
+        "license" : [{"type" : "cc-by", "open_access" : True, "provenance" : {"date" : "2013-01-01T00:00:00Z"}}]
+    },
+    "queued" : False
+}
+
+class TestCodec(TestCase):
+
+    def setUp(self):
+        pass
+        
+    def tearDown(self):
+        pass
+    
+    def test_01_json_is_plain(self):
+        # the json codec writes exactly what was always written
+        s = codec.encode(RECORD, "json")
+        assert s == json.dumps(RECORD)
+        assert codec.decode(s) == RECORD
+    
+    def test_02_json_zlib(self):
+        s = codec.encode(RECORD, "json+zlib")
+        assert s.startswith(codec.HEADER_MARKER)
+        assert codec.decode(s) == RECORD
+    
+    def test_03_msgpack(self):
+        if codec.msgpack is None:
+            return
+        for name in ["msgpack", "msgpack+zlib"]:
+            s = codec.encode(RECORD, name)
+            assert s.startswith(codec.HEADER_MARKER)
+            assert codec.decode(s) == RECORD
+    
+    def test_04_legacy(self):
+        # entries written before there were codecs can still be read
+        assert codec.decode('{"title" : "old"}') == {"title" : "old"}
+    
+    def test_05_errors(self):
+        with self.assertRaises(codec.CodecException):
+            codec.encode(RECORD, "whatever")
+        
+        # a corrupt payload is a ValueError, just like corrupt json
+        with self.assertRaises(ValueError):
+            codec.decode(codec.HEADER_MARKER + chr(codec.FORMAT_VERSION) + chr(codec.JSON_ZLIB) + "not compressed")
+        with self.assertRaises(ValueError):
+            codec.decode(codec.HEADER_MARKER + chr(99) + chr(codec.JSON) + "{}")
+        with self.assertRaises(ValueError):
+            codec.decode("{askjdfafds}")
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from openarticlegauge import util
+from openarticlegauge import util, config
 from openarticlegauge.tests.support import helpers
 
 class TestCustomHttp(TestCase):
@@ -8,9 +8,11 @@ class TestCustomHttp(TestCase):
         self.ls = helpers.LiveServer(port=helpers.get_first_free_port())
         self.ls.spawn_live_server()
         self.app_url = self.ls.get_server_url()
+        self.old_chunk_size = config.HTTP_CHUNK_SIZE
 
     def tearDown(self):
         self.ls.terminate_live_server()
+        config.HTTP_CHUNK_SIZE = self.old_chunk_size
 
     def test_01_http_get_normal(self):
         resp = util.http_get(self.app_url + "/normal")
@@ -45,3 +47,24 @@ class TestCustomHttp(TestCase):
         assert content == "H" #the sleep happens after the first character/byte has been transmitted
         assert downloaded_bytes == 1
 
+
+    def test_07_http_stream_get_resume(self):
+        # one byte chunks, so that the bytes before the stall are received
+        config.HTTP_CHUNK_SIZE = 1
+        r, content, downloaded_bytes = util.http_stream_get(self.app_url + "/stream/resumable")
+        assert r
+        assert r.status_code == 200
+        assert content == "HHHH"
+        assert downloaded_bytes == 4
+
+    def test_08_http_stream_get_on_chunk(self):
+        config.HTTP_CHUNK_SIZE = 1
+        chunks = []
+        def on_chunk(chunk):
+            chunks.append(chunk)
+            return False # stop after the first chunk
+        r, content, downloaded_bytes = util.http_stream_get(self.app_url + "/stream/normal", on_chunk=on_chunk)
+        assert r
+        assert chunks == ["H"]
+        assert content == "H"
+        assert downloaded_bytes == 1
@@ -2,7 +2,7 @@ from unittest import TestCase
 import requests, os
 import time
 
-from openarticlegauge import config, models
+from openarticlegauge import config, models, util
 
 ######################################################################################
 # Set these variables/imports and the test case will use them to perform some general
@@ -235,6 +235,18 @@ def mock_get(url, *args, **kwargs):
 
     return resp
 
+FETCHED = []
+
+# records which urls the plugin fetched, and serves them from the test resources
+def mock_http_stream_get(url):
+    FETCHED.append(url)
+    for filename, obj in RESOURCE_AND_RESULT.iteritems():
+        if obj['provenance']['source'] == url:
+            with open(filename) as f:
+                content = f.read()
+            return None, content, len(content)
+    return None, '', 0
+
 class TestProvider(TestCase):
 
     def setUp(self):
@@ -394,3 +406,95 @@ class TestProvider(TestCase):
                 else:
                     # the resulting object must match the comparison object
                     assert value == prov.get(key), ('While testing with ' + path, (key, value), prov.get(key))
+    
+    def test_04_config_index_versioned(self):
+        p = MyPlugin()
+        index = p.config_index()
+        assert index.version == models.publisher_config_version()
+        assert [c['publisher_name'] for c in index.matching_configs(["plosone.org/article/1"])] == ["PLOS"]
+        
+        # the index is only built once for each version of the configs
+        assert p.config_index() is index
+        assert MyPlugin().config_index() is index
+        
+        # saving a config bumps the version, so the index is rebuilt with it in
+        p3 = models.Publisher()
+        p3.publisher_name = 'PLOS Journals'
+        p3.journal_urls = ['http://www.plosone.org/article']
+        p3.licenses = []
+        p3.save()
+        self.test_publishers.append(p3)
+        
+        rebuilt = p.config_index()
+        assert rebuilt is not index
+        assert rebuilt.version > index.version
+        assert [c['publisher_name'] for c in rebuilt.matching_configs(["plosone.org/article/1"])] == ["PLOS Journals", "PLOS"]
+    
+    def test_04a_config_changes_not_refreshed(self):
+        refreshed = []
+        def refresh(cls):
+            refreshed.append(cls.__type__)
+            return old_publisher_refresh.im_func(cls)
+        old_publisher_refresh = models.Publisher.refresh
+        old_statement_refresh = models.LicenseStatement.refresh
+        models.Publisher.refresh = classmethod(refresh)
+        models.LicenseStatement.refresh = classmethod(refresh)
+        try:
+            index = MyPlugin().config_index()
+            del refreshed[:]
+            
+            # saving configs only bumps the version, without refreshing the index each time
+            for i in range(3):
+                p = models.Publisher()
+                p.publisher_name = 'Publisher ' + str(i)
+                p.journal_urls = ['http://www.publisher' + str(i) + '.org']
+                p.licenses = []
+                p.save()
+                self.test_publishers.append(p)
+            assert refreshed == []
+            
+            # the index is refreshed once, when the config index is rebuilt
+            rebuilt = MyPlugin().config_index()
+            assert rebuilt is not index
+            assert sorted(refreshed) == ["license_statement", "publisher"]
+            assert "Publisher 2" in rebuilt.names
+            
+            MyPlugin().config_index()
+            assert len(refreshed) == 2
+        finally:
+            models.Publisher.refresh = old_publisher_refresh
+            models.LicenseStatement.refresh = old_statement_refresh
+    
+    def test_04b_names(self):
+        p = MyPlugin()
+        assert p.has_name("PLOS")
+        assert p.has_name("plos")
+        assert not p.has_name("nobody")
+        
+        assert p.get_description("plos").provider_support == "http://www.plosone.org"
+        assert "PLOS" in p.get_names()
+    
+    def test_05_lazy_fetching(self):
+        old_http_stream_get = util.http_stream_get
+        util.http_stream_get = mock_http_stream_get
+        try:
+            plos = "http://www.plosone.org/article/info%3Adoi%2F10.1371%2Fjournal.pone.0031314"
+            frontiers = "http://journal.frontiersin.org/Journal/10.3389/fnbeh.2013.00049/full"
+            
+            # the first url's licence is found by the first config, so nothing else is fetched
+            del FETCHED[:]
+            record = models.MessageObject(record={"bibjson" : {}, "provider" : {"url" : [plos, frontiers]}})
+            handler, version = MyPlugin().license_detect(record)
+            assert handler == "PLOS"
+            assert FETCHED == [plos]
+            
+            # urls are fetched in order until one of them has a licence, and only once
+            # however many configs try them
+            del FETCHED[:]
+            wiley_unknown = "http://onlinelibrary.wiley.com/doi/unknown"
+            record = models.MessageObject(record={"bibjson" : {}, "provider" : {"url" : [frontiers, wiley_unknown, plos]}})
+            handler, version = MyPlugin().license_detect(record)
+            assert handler == "PLOS"
+            assert FETCHED == [frontiers, wiley_unknown, plos]
+        finally:
+            util.http_stream_get = old_http_stream_get
@@ -0,0 +1,101 @@
+from unittest import TestCase
+
+from openarticlegauge import models, dao, localstore, config, core, licenses
+from openarticlegauge.core import app
+import os, tempfile
+
+PUBLISHERS = [
+    {"id" : "p1", "publisher_name" : "Beta Press", "journal_urls" : ["beta.org/journals", "beta.com"],
+        "licenses" : [{"license_statement" : "This is CC-BY", "license_type" : "cc-by", "version" : ""}]},
+    {"id" : "p2", "publisher_name" : "Alpha", "journal_urls" : ["alpha.org"],
+        "licenses" : [{"license_statement" : "This is CC0", "license_type" : "cc0", "version" : "1.0"}]}
+]
+
+class TestLocalStore(TestCase):
+
+    def setUp(self):
+        self.old_backend = app.config.get("ARCHIVE_BACKEND")
+        self.old_path = app.config.get("ARCHIVE_SQLITE_PATH")
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        app.config["ARCHIVE_BACKEND"] = "sqlite"
+        app.config["ARCHIVE_SQLITE_PATH"] = self.path
+        self.buffering = config.BUFFERING
+        config.BUFFERING = False
+        
+    def tearDown(self):
+        app.config["ARCHIVE_BACKEND"] = self.old_backend
+        app.config["ARCHIVE_SQLITE_PATH"] = self.old_path
+        config.BUFFERING = self.buffering
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+    
+    def test_01_selected_by_config(self):
+        assert isinstance(dao.local_store(), localstore.SQLiteStore)
+        app.config["ARCHIVE_BACKEND"] = "elasticsearch"
+        assert dao.local_store() is None
+    
+    def test_02_store_and_pull(self):
+        response = models.Record.bulk([{"id" : "doi:1", "title" : "one"}, {"id" : "doi:2", "title" : "two"}])
+        assert not response["errors"]
+        assert len(response["items"]) == 2
+        
+        r = models.Record(**{"id" : "doi:3", "title" : "three", "license" : [{"type" : "cc-by"}]})
+        r.save()
+        
+        assert models.Record.pull("doi:1").data["title"] == "one"
+        assert models.Record.pull("doi:4") is None
+        assert [x.id if x is not None else None for x in models.Record.pull_multi(["doi:3", "doi:4", "doi:2"])] == ["doi:3", None, "doi:2"]
+        
+        # field projection, as used by the archive check in store_results
+        assert models.Record.pull("doi:3", source_include=["license"]).data == {"license" : [{"type" : "cc-by"}]}
+        
+        # the archive check finds it too
+        assert models.Record.check_archive("doi:2")["title"] == "two"
+        
+        models.Record.pull("doi:1").delete()
+        assert models.Record.pull("doi:1") is None
+    
+    def test_03_query(self):
+        models.Publisher.bulk(PUBLISHERS)
+        
+        names = [p["publisher_name"] for p in models.Publisher.all(sort=[{"publisher_name.exact" : {"order" : "asc"}}])]
+        assert names == ["Alpha", "Beta Press"]
+        
+        assert models.Publisher.query(q="publisher_name:beta", size=0)["hits"]["total"] == 1
+        assert [p.id for p in models.Publisher.find_by_journal_url("alpha.org")] == ["p2"]
+        assert sorted(models.Publisher.all_journal_urls()) == ["alpha.org", "beta.com", "beta.org/journals"]
+        
+        res = models.Publisher.query(q={"filter" : {"and" : [{"term" : {"licenses.license_type.exact" : "cc0"}}]}})
+        assert [h["_id"] for h in res["hits"]["hits"]] == ["p2"]
+        
+        # anything outside the supported queries is refused, rather than silently answered wrongly
+        with self.assertRaises(localstore.LocalStoreException):
+            models.Publisher.query(q={"query" : {"fuzzy" : {"publisher_name" : "alfa"}}})
+        with self.assertRaises(localstore.LocalStoreException):
+            models.Publisher.query(q="publisher_name:alpha AND publisher_name:beta")
+    
+    def test_04_iterate(self):
+        models.Record.bulk([{"id" : "doi:" + str(i)} for i in range(5)])
+        assert [r.id for r in models.Record.iterate(page_size=2)] == ["doi:0", "doi:1", "doi:2", "doi:3", "doi:4"]
+        assert len(list(models.Record.iterate(limit=3))) == 3
+        
+        models.Record.delete_all()
+        assert models.Record.query()["hits"]["total"] == 0
+    
+    def test_05_load_licenses(self):
+        # the licences are loaded into the local store just as they are into the index
+        core.load_licenses(app)
+        l = models.License.pull("cc-by")
+        assert l is not None
+        assert l.data["title"] == licenses.LICENSES["cc-by"]["title"]
+        assert models.License.query()["hits"]["total"] == len(licenses.LICENSES)
+    
+    def test_06_load_licenses_unknown_backend(self):
+        # a misconfigured backend is refused, and nothing is written anywhere
+        os.remove(self.path)
+        app.config["ARCHIVE_BACKEND"] = "sqllite"
+        with self.assertRaises(ValueError):
+            core.load_licenses(app)
+        assert not os.path.exists(self.path)
@@ -1,24 +1,112 @@
 from unittest import TestCase
 
-from openarticlegauge import models
+from openarticlegauge import models, dao
 from openarticlegauge import config
 import json, redis, time
 
+def bulk_response(bibjson_list, failures=[]):
+    # an elasticsearch bulk response for the list, in which the ids in failures were not indexed
+    items = []
+    for r in bibjson_list:
+        if r['id'] in failures:
+            items.append({"index" : {"_id" : r['id'], "error" : "MapperParsingException[failed to parse]"}})
+        else:
+            items.append({"index" : {"_id" : r['id'], "ok" : True}})
+    return {"took" : 1, "items" : items}
+
 ARCHIVE = []
 @classmethod
 def mock_bulk(cls, bibjson_list):
     global ARCHIVE
     ARCHIVE += bibjson_list
+    return bulk_response(bibjson_list)
 
 @classmethod
 def mock_bulk_blocked(cls, bibjson_list):
     global ARCHIVE
     ARCHIVE.append(bibjson_list)
+    return bulk_response(bibjson_list)
+
+@classmethod
+def mock_bulk_partial(cls, bibjson_list):
+    global ARCHIVE
+    ARCHIVE += bibjson_list
+    return bulk_response(bibjson_list, failures=["doi:456"])
+
+@classmethod
+def mock_bulk_lease_lost(cls, bibjson_list):
+    # someone else takes the flush lease while the block is being indexed
+    client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+    client.set(models.FLUSH_LOCK, "someone else")
+    global ARCHIVE
+    ARCHIVE.append(bibjson_list)
+    return bulk_response(bibjson_list)
 
 @classmethod
-def mock_pull(cls, identifier):
+def mock_pull(cls, identifier, source_include=None, source_exclude=None):
     return None
 
+@classmethod
+def mock_pull_multi(cls, identifiers):
+    return [None] * len(identifiers)
+
+@classmethod
+def mock_pull_multi_error(cls, identifiers):
+    raise Exception("archive unavailable")
+
+@classmethod
+def mock_check_buffer_multi_error(cls, canonicals):
+    raise redis.ConnectionError("buffer unavailable")
+
+class MockResponse(object):
+    def __init__(self, obj, status_code=200):
+        self.obj = obj
+        self.status_code = status_code
+    def json(self):
+        return self.obj
+
+BULK_REQUESTS = []
+def mock_bulk_post(method, url, data=None, **kwargs):
+    # reject doi:456 the first time it is sent, and fail doi:789 permanently
+    global BULK_REQUESTS
+    BULK_REQUESTS.append(data)
+    lines = data.strip().split("\n")
+    items = []
+    for i in range(0, len(lines), 2):
+        id_ = json.loads(lines[i])["index"]["_id"]
+        if id_ == "doi:456" and len(BULK_REQUESTS) == 1:
+            items.append({"index" : {"_id" : id_, "error" : "EsRejectedExecutionException[rejected execution]", "status" : 429}})
+        elif id_ == "doi:789":
+            items.append({"index" : {"_id" : id_, "error" : "MapperParsingException[failed to parse]", "status" : 400}})
+        else:
+            items.append({"index" : {"_id" : id_, "ok" : True}})
+    return MockResponse({"took" : 1, "items" : items})
+
+SOURCE_REQUESTS = []
+def mock_source_request(method, url, data=None, **kwargs):
+    global SOURCE_REQUESTS
+    SOURCE_REQUESTS.append((method, url, data, kwargs))
+    if method == "get":
+        return MockResponse({"exists" : True, "_source" : {"id" : "doi:1", "license" : []}})
+    return MockResponse({"hits" : {"total" : 0, "hits" : []}})
+
+SCROLL_REQUESTS = []
+def mock_scroll_request(method, url, data=None, **kwargs):
+    # three pages of results, of 2, 1 and 0 records
+    global SCROLL_REQUESTS
+    SCROLL_REQUESTS.append((method, url, data))
+    pages = [["doi:1", "doi:2"], ["doi:3"], []]
+    page = pages[min(len(SCROLL_REQUESTS) - 1, 2)]
+    return MockResponse({"_scroll_id" : "scroll" + str(len(SCROLL_REQUESTS)), "hits" : {"total" : 3, "hits" : [{"_source" : {"id" : id_}} for id_ in page]}})
+
+class MockTask(object):
+    def __init__(self):
+        self.calls = 0
+        self.args = []
+    def apply_async(self, args=None):
+        self.calls += 1
+        self.args.append(args)
+
 class TestWorkflow(TestCase):
 
     def setUp(self):
@@ -27,6 +115,12 @@ class TestWorkflow(TestCase):
         self.buffering = config.BUFFERING
         self.bulk = models.Record.bulk
         self.pull = models.Record.pull
+        self.pull_multi = models.Record.pull_multi
+        self.check_buffer_multi = models.Record._check_buffer_multi
+        self.flush_buffer_task = models.flush_buffer
+        self.flush_size = config.BUFFER_FLUSH_SIZE
+        self.flush_bytes = config.BUFFER_FLUSH_BYTES
+        self.partitions = config.BUFFER_PARTITIONS
         
     def tearDown(self):
         global ARCHIVE
@@ -34,11 +128,21 @@ class TestWorkflow(TestCase):
         config.BUFFERING = self.buffering
         models.Record.bulk = self.bulk
         models.Record.pull = self.pull
+        models.Record.pull_multi = self.pull_multi
+        models.Record._check_buffer_multi = self.check_buffer_multi
+        models.flush_buffer = self.flush_buffer_task
+        config.BUFFER_FLUSH_SIZE = self.flush_size
+        config.BUFFER_FLUSH_BYTES = self.flush_bytes
+        config.BUFFER_PARTITIONS = self.partitions
         client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
         client.delete("id_doi:123")
         client.delete("id_doi:456")
         client.delete("id_doi:789")
-        client.delete("flush_buffer_lock")
+        for shard in range(3):
+            client.delete(models.buffer_key(models.FLUSH_LOCK, shard))
+            client.delete(models.buffer_key(models.BUFFER_LOG, shard))
+            client.delete(models.buffer_key(models.BUFFER_BYTES, shard))
+            client.delete(models.buffer_key(models.FLUSH_TRIGGER, shard))
         
     def test_01_resultset_init(self):
         rs = models.ResultSet()
@@ -228,6 +332,35 @@ class TestWorkflow(TestCase):
         obj = models.Record.check_archive("doi:123")
         assert obj["identifier"][0]["canonical"] == "doi:123"
     
+    def test_08a_check_archive_multi_with_buffering(self):
+        config.BUFFERING = True
+        models.Record.pull_multi = mock_pull_multi
+        
+        record = {"identifier" : [{"canonical" : "doi:123"}]}
+        models.Record.store(record)
+        
+        objs = models.Record.check_archive_multi(["doi:456", "doi:123"])
+        assert len(objs) == 2
+        assert objs[0] is None
+        assert objs[1]["identifier"][0]["canonical"] == "doi:123"
+    
+    def test_08b_check_archive_multi_errors(self):
+        config.BUFFERING = True
+        models.Record.pull_multi = mock_pull_multi_error
+        
+        record = {"identifier" : [{"canonical" : "doi:123"}]}
+        models.Record.store(record)
+        
+        # if the remote archive can't be checked, those records are treated as not archived
+        objs = models.Record.check_archive_multi(["doi:456", "doi:123"])
+        assert objs[0] is None
+        assert objs[1]["identifier"][0]["canonical"] == "doi:123"
+        
+        # and so are all of them if the buffer can't be checked either
+        models.Record._check_buffer_multi = mock_check_buffer_multi_error
+        objs = models.Record.check_archive_multi(["doi:456", "doi:123"])
+        assert objs == [None, None]
+    
     def test_09_record_flush_buffer(self):
         config.BUFFERING = True
         models.Record.bulk = mock_bulk
@@ -325,6 +458,308 @@ class TestWorkflow(TestCase):
         assert "doi:456" in canonicals
         assert "doi:789" in canonicals
         
+    def test_11a_record_flush_buffer_acknowledgement(self):
+        config.BUFFERING = True
+        models.Record.bulk = mock_bulk_partial
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        records = [
+            {"identifier" : [{"canonical" : "doi:123"}]},
+            {"identifier" : [{"canonical" : "doi:456"}]}
+        ]
+        for record in records:
+            models.Record.store(record)
+        
+        result = models.Record.flush_buffer()
+        assert result
+        assert len(ARCHIVE) == 2
+        
+        # the record which was indexed has gone from the buffer, but the one which failed
+        # is still there, and is back on the log to be tried again
+        assert models.Record.check_archive("doi:123") is None
+        assert models.Record.check_archive("doi:456") is not None
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        assert client.lrange(models.BUFFER_LOG, 0, -1) == ["doi:456"]
+        
+        # next time around it is indexed
+        models.Record.bulk = mock_bulk
+        result = models.Record.flush_buffer()
+        assert result
+        assert models.Record.check_archive("doi:456") is None
+        assert client.llen(models.BUFFER_LOG) == 0
+        
+    def test_11b_bulk_retries_rejected(self):
+        old_request = dao._request
+        old_concurrency = dao.app.config.get("ES_BULK_CONCURRENCY")
+        dao._request = mock_bulk_post
+        dao.app.config["ES_BULK_CONCURRENCY"] = 1
+        del BULK_REQUESTS[:]
+        try:
+            response = models.Record.bulk([{"id" : "doi:123"}, {"id" : "doi:456"}, {"id" : "doi:789"}])
+        finally:
+            dao._request = old_request
+            dao.app.config["ES_BULK_CONCURRENCY"] = old_concurrency
+        
+        # only the rejected item is sent again, and the items come back in the order they were sent
+        assert len(BULK_REQUESTS) == 2
+        assert "doi:456" in BULK_REQUESTS[1]
+        assert "doi:123" not in BULK_REQUESTS[1]
+        assert "doi:789" not in BULK_REQUESTS[1]
+        assert [item["index"]["_id"] for item in response["items"]] == ["doi:123", "doi:456", "doi:789"]
+        assert "error" not in response["items"][1]["index"]
+        assert "error" in response["items"][2]["index"]
+        assert response["errors"]
+        
+    def test_11c_store_triggers_flush(self):
+        config.BUFFERING = True
+        config.BUFFER_FLUSH_SIZE = 2
+        config.BUFFER_FLUSH_BYTES = 0
+        task = MockTask()
+        models.flush_buffer = task
+        
+        # the buffer is small enough to wait for the schedule
+        models.Record.store({"identifier" : [{"canonical" : "doi:123"}]})
+        assert task.calls == 0
+        
+        # now it has reached the limit, so a flush is triggered
+        models.Record.store({"identifier" : [{"canonical" : "doi:456"}]})
+        assert task.calls == 1
+        
+        # but not again straight away
+        models.Record.store({"identifier" : [{"canonical" : "doi:789"}]})
+        assert task.calls == 1
+        
+        # the same goes for the size in bytes
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client.delete(models.FLUSH_TRIGGER)
+        config.BUFFER_FLUSH_SIZE = 0
+        config.BUFFER_FLUSH_BYTES = 1
+        models.Record.store({"identifier" : [{"canonical" : "doi:123"}]})
+        assert task.calls == 2
+        
+        # the flush is for the partition that the record went into
+        assert task.args[-1] == [models.buffer_shard("doi:123")]
+    
+    def test_11d_partitioned_buffer(self):
+        config.BUFFERING = True
+        config.BUFFER_PARTITIONS = 3
+        models.Record.bulk = mock_bulk
+        models.Record.pull = mock_pull
+        models.Record.pull_multi = mock_pull_multi
+        global ARCHIVE
+        
+        canonicals = ["doi:123", "doi:456", "doi:789"]
+        for canonical in canonicals:
+            models.Record.store({"identifier" : [{"canonical" : canonical}]})
+        
+        # each record is in the log of its own partition, and can be found directly
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        for canonical in canonicals:
+            shard = models.buffer_shard(canonical)
+            assert canonical in client.lrange(models.buffer_key(models.BUFFER_LOG, shard), 0, -1)
+            assert models.Record.check_archive(canonical) is not None
+        assert len([obj for obj in models.Record.check_archive_multi(canonicals) if obj is not None]) == 3
+        
+        # a single partition can be flushed on its own
+        shard = models.buffer_shard("doi:123")
+        result = models.Record.flush_buffer(shard=shard)
+        assert result
+        assert models.Record.check_archive("doi:123") is None
+        
+        # and flushing without a partition flushes the rest
+        result = models.Record.flush_buffer()
+        assert result
+        assert len(ARCHIVE) == 3
+        for canonical in canonicals:
+            assert models.Record.check_archive(canonical) is None
+        
+        # the celery task hands each partition to its own task
+        task = MockTask()
+        celery_task = models.flush_buffer
+        models.flush_buffer = task
+        result = celery_task()
+        assert result
+        assert task.args == [[0], [1], [2]]
+    
+    def test_11e_iterate_scroll(self):
+        old_request = dao._request
+        dao._request = mock_scroll_request
+        del SCROLL_REQUESTS[:]
+        try:
+            ids = [r.id for r in models.Record.iterate(q={"query" : {"match_all" : {}}}, page_size=2)]
+            requests = list(SCROLL_REQUESTS)
+            
+            del SCROLL_REQUESTS[:]
+            limited = [r.id for r in models.Record.iterate(page_size=2, limit=1)]
+            limited_requests = list(SCROLL_REQUESTS)
+        finally:
+            dao._request = old_request
+        
+        assert ids == ["doi:1", "doi:2", "doi:3"]
+        
+        # the first request opens the scroll, the next ones continue it, and the last one clears it
+        assert "_search?scroll=" in requests[0][1]
+        assert json.loads(requests[0][2])["size"] == 2
+        assert requests[1][1].split("?")[0].endswith("/_search/scroll")
+        assert requests[1][2] == "scroll1"
+        assert requests[-1][0] == "delete"
+        
+        # stopping early still clears the scroll, without fetching any more pages
+        assert limited == ["doi:1"]
+        assert len(limited_requests) == 2
+        assert limited_requests[-1][0] == "delete"
+    
+    def test_11f_source_filtering(self):
+        old_request = dao._request
+        dao._request = mock_source_request
+        del SOURCE_REQUESTS[:]
+        try:
+            models.Record.query(q={"query" : {"match_all" : {}}}, source_include=["id", "license"], source_exclude=["provider"])
+            models.Record.query()
+            record = models.Record.pull("doi:1", source_include=["id", "license"])
+            requests = list(SOURCE_REQUESTS)
+        finally:
+            dao._request = old_request
+        
+        # the query body limits the fields returned, but only when asked to
+        assert json.loads(requests[0][2])["_source"] == {"include" : ["id", "license"], "exclude" : ["provider"]}
+        assert "_source" not in json.loads(requests[1][2])
+        
+        # the pull passes the fields as url parameters
+        assert requests[2][3]["params"] == {"_source_include" : "id,license"}
+        assert record.id == "doi:1"
+    
+    def test_11g_record_flush_buffer_duplicates(self):
+        config.BUFFERING = True
+        models.Record.bulk = mock_bulk_blocked
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        # doi:123 is in the log twice, in different blocks
+        records = [
+            {"identifier" : [{"canonical" : "doi:123"}]},
+            {"identifier" : [{"canonical" : "doi:456"}]},
+            {"identifier" : [{"canonical" : "doi:123"}]}
+        ]
+        for record in records:
+            models.Record.store(record)
+        
+        # it is only sent to the archive once, even though it is still in the buffer when the second block is read
+        result = models.Record.flush_buffer(key_timeout=30, block_size=2)
+        assert result
+        assert len(ARCHIVE) == 1, ARCHIVE
+        assert [r['identifier'][0]['canonical'] for r in ARCHIVE[0]] == ["doi:123", "doi:456"]
+        
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        assert client.llen(models.BUFFER_LOG) == 0
+    
+    def test_11h_record_flush_buffer_lease(self):
+        config.BUFFERING = True
+        models.Record.bulk = mock_bulk_blocked
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        records = [
+            {"identifier" : [{"canonical" : "doi:123"}]},
+            {"identifier" : [{"canonical" : "doi:456"}]},
+            {"identifier" : [{"canonical" : "doi:789"}]}
+        ]
+        for record in records:
+            models.Record.store(record)
+        
+        # take a lease with a short timeout, which the flush should renew
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client.set(models.FLUSH_LOCK, "token", ex=1)
+        
+        result = models.Record.flush_buffer(key_timeout=30, block_size=2, shard=0, lease=(models.FLUSH_LOCK, "token"))
+        assert result
+        assert len(ARCHIVE) == 2, ARCHIVE
+        assert client.llen(models.BUFFER_LOG) == 0
+        assert client.get(models.FLUSH_LOCK) == "token"
+        assert client.ttl(models.FLUSH_LOCK) > 1
+    
+    def test_11i_record_flush_buffer_lease_lost(self):
+        config.BUFFERING = True
+        models.Record.bulk = mock_bulk_lease_lost
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        records = [
+            {"identifier" : [{"canonical" : "doi:123"}]},
+            {"identifier" : [{"canonical" : "doi:456"}]},
+            {"identifier" : [{"canonical" : "doi:789"}]}
+        ]
+        for record in records:
+            models.Record.store(record)
+        
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client.set(models.FLUSH_LOCK, "token")
+        
+        # the lease is lost during the first block, so the flush stops there
+        result = models.Record.flush_buffer(key_timeout=30, block_size=2, shard=0, lease=(models.FLUSH_LOCK, "token"))
+        assert not result
+        assert len(ARCHIVE) == 1, ARCHIVE
+        
+        # the log is left alone for whoever holds the lease now, and their lease is untouched
+        assert client.llen(models.BUFFER_LOG) == 3
+        assert client.get(models.FLUSH_LOCK) == "someone else"
+        
+        # and the next flush picks up where this one stopped
+        client.delete(models.FLUSH_LOCK)
+        models.Record.bulk = mock_bulk_blocked
+        result = models.Record.flush_buffer(key_timeout=30, block_size=2, shard=0)
+        assert result
+        assert [r['identifier'][0]['canonical'] for r in ARCHIVE[-1]] == ["doi:789"]
+        assert client.llen(models.BUFFER_LOG) == 0
+    
+    def test_11j_record_flush_buffer_lease_expired(self):
+        config.BUFFERING = True
+        models.Record.bulk = mock_bulk_lease_lost
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        records = [
+            {"identifier" : [{"canonical" : "doi:123"}]},
+            {"identifier" : [{"canonical" : "doi:456"}]}
+        ]
+        for record in records:
+            models.Record.store(record)
+        
+        # the lease expires and is taken by someone else during the only block of the flush
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        client.set(models.FLUSH_LOCK, "token", ex=30)
+        
+        # so the log must not be trimmed, as the new holder may be flushing the same entries
+        result = models.Record.flush_buffer(key_timeout=30, block_size=10, shard=0, lease=(models.FLUSH_LOCK, "token"))
+        assert not result
+        assert len(ARCHIVE) == 1, ARCHIVE
+        assert client.lrange(models.BUFFER_LOG, 0, -1) == ["doi:123", "doi:456"]
+        assert client.get(models.FLUSH_LOCK) == "someone else"
+        
+        # while the holder of the lease is able to trim it
+        models.Record.bulk = mock_bulk_blocked
+        result = models.Record.flush_buffer(key_timeout=30, block_size=10, shard=0, lease=(models.FLUSH_LOCK, "someone else"))
+        assert result
+        assert client.llen(models.BUFFER_LOG) == 0
+    
+    def test_11k_celery_flush_buffer_lease_expired(self):
+        config.BUFFERING = True
+        config.BUFFER_BLOCK_SIZE = 10
+        models.Record.bulk = mock_bulk_lease_lost
+        models.Record.pull = mock_pull
+        global ARCHIVE
+        
+        models.Record.store({"identifier" : [{"canonical" : "doi:123"}]})
+        
+        # the task still runs, but leaves the log and the new lease alone
+        result = models.flush_buffer()
+        assert result
+        
+        client = redis.StrictRedis(host=config.REDIS_BUFFER_HOST, port=config.REDIS_BUFFER_PORT, db=config.REDIS_BUFFER_DB)
+        assert client.llen(models.BUFFER_LOG) == 1
+        assert client.get(models.FLUSH_LOCK) == "someone else"
+    
     def test_12_celery_flush_buffer_no_buffering(self):
         config.BUFFERING = False
         result = models.flush_buffer()
@@ -0,0 +1,121 @@
+from unittest import TestCase
+import os, re
+
+try:
+    import bleach
+except ImportError:
+    bleach = None
+
+from openarticlegauge import normalise, plugin
+from openarticlegauge.plugins import bmc, bmj, copernicus, elife, epmc_license, hindawi, nature, oup, sage, springerlink
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+PLUGINS = [
+    bmc.BMCPlugin, bmj.BMJPlugin, copernicus.COPERNICUSPlugin, elife.ELifePlugin, epmc_license.EPMCLicensePlugin,
+    hindawi.HindawiPlugin, nature.NaturePlugin, oup.OUPPlugin, sage.SagePlugin, springerlink.SpringerLinkPlugin
+]
+
+def bleach_normalise_string(s, strip=False):
+    # the normalisation as it was done with bleach, before the normalise module
+    if not s:
+        return s
+    if strip:
+        s = bleach_strip_html(s)
+        s = ''.join(c for c in s if c in normalise._allowed)
+    s = re.sub(r'\s+', ' ', s)
+    return s.lower()
+
+def bleach_strip_html(s):
+    return bleach.clean(s, tags=[], strip=True, strip_comments=True)
+
+def bleach_matches(statements, content):
+    # the positions of the statements which the string matching found in the content,
+    # as it was done with bleach (see Plugin.simple_extract)
+    content = bleach_normalise_string(content)
+    found = []
+    for i, statement in enumerate(statements):
+        cmp_statement = bleach_normalise_string(statement)
+        if not cmp_statement:
+            continue
+        cmp_statement = normalise.to_unicode(cmp_statement)
+        content = normalise.to_unicode(content)
+        match = cmp_statement in content
+        if not match:
+            cmp_statement = bleach_strip_html(cmp_statement)
+            content = bleach_strip_html(content)
+            if not cmp_statement:
+                continue
+            match = cmp_statement in content
+        if match:
+            found.append(i)
+    return found
+
+class TestNormalise(TestCase):
+
+    def setUp(self):
+        pass
+        
+    def tearDown(self):
+        pass
+    
+    def test_01_normalise_string(self):
+        assert normalise.normalise_string("  A  Licence\n\tStatement ") == " a licence statement "
+        assert normalise.normalise_string("") == ""
+        assert normalise.normalise_string(None) is None
+        assert normalise.normalise_string("<p>CC-BY &amp; more</p>", strip=True) == "ccby amp more"
+    
+    def test_02_strip_html(self):
+        html = '<!-- a comment --><p class="x" title="a > b">Some <b>bold</b> text</p> where 1 < 2 &amp; &copy;'
+        assert normalise.strip_html(html) == u"Some bold text where 1 &lt; 2 &amp; \u00a9"
+        
+        # entities are resolved, and the text is escaped again, as bleach.clean did
+        assert normalise.strip_html("&amp;lt; &#169; &#xa9; &nbsp;") == u"&amp;lt; \u00a9 \u00a9 \u00a0"
+        assert normalise.strip_html("a<![CDATA[ x < y ]]>b<script>1 < 2</script>") == u"ab1 &lt; 2"
+        
+        # bytes are decoded, and the result is always unicode
+        assert normalise.strip_html("caf\xc3\xa9") == u"caf\u00e9"
+    
+    def test_03_strip_special_chars(self):
+        assert normalise.strip_special_chars("CC-BY 4.0\n(c)") == "CCBY 40c"
+        assert normalise.strip_special_chars(u"caf\u00e9 au lait!") == u"caf au lait"
+    
+    def test_04_normalised_content(self):
+        page = normalise.NormalisedContent("<P>This   article is <B>Open</B></P>")
+        assert page.normalised == u"<p>this article is <b>open</b></p>"
+        assert page.stripped == u"this article is open"
+    
+    def test_05_page_memoised(self):
+        content = "<p>some page</p>"
+        page = normalise.page(content)
+        assert normalise.page("<p>some " + "page</p>") is page
+        
+        # only the last few pages are kept
+        for i in range(normalise.PAGE_CACHE_SIZE):
+            normalise.page("page " + str(i))
+        assert normalise.page(content) is not page
+    
+    def test_06_matches_as_bleach_did(self):
+        # the same licence statements are found in the stored plugin test pages as were
+        # found when bleach was used to strip their html
+        if bleach is None:
+            self.skipTest("bleach is not installed")
+        
+        pages = []
+        for name in sorted(os.listdir(RESOURCES)):
+            if name.endswith(".html") or name.endswith(".xml"):
+                with open(os.path.join(RESOURCES, name)) as f:
+                    pages.append((name, f.read()))
+        
+        found = 0
+        for klass in PLUGINS:
+            p = klass()
+            statements = [mapping.keys()[0] for mapping in p._license_mappings]
+            matcher = plugin.StatementMatcher(statements, p.normalise_string, p.strip_html)
+            for name, content in pages:
+                expected = bleach_matches(statements, content)
+                assert list(matcher.matches(normalise.page(content))) == expected, (klass.__name__, name)
+                found += len(expected)
+        
+        # and the pages do have statements in them, so this has compared something
+        assert found > 0
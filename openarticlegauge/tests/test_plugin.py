@@ -1,6 +1,11 @@
 import os
 from unittest import TestCase
-from openarticlegauge import plugin, config, models
+from openarticlegauge import plugin, config, models, normalise
+
+CONFIG_VERSION = 0
+
+def mock_publisher_config_version():
+    return CONFIG_VERSION
 
 class TestPlugin(TestCase):
 
@@ -144,5 +149,144 @@ class TestPlugin(TestCase):
         
         assert cfg["all"][0]._short_name == "provider_plugin"
         assert cfg["all"][0].__priority__ == 1000
+    
+    def test_10_license_detect_dispatch(self):
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_dispatch")
+        config.PLUGIN_DIR = pdir
+        
+        def routed(urls):
+            p = plugin.PluginFactory.license_detect({"url" : urls})
+            return p._short_name if p is not None else None
+        
+        # base urls match whatever the protocol and www prefix
+        assert routed(["http://www.journals.org/open/article/1"]) == "base_url_plugin"
+        assert routed(["https://journals.org/open"]) == "base_url_plugin"
+        assert routed(["http://www.other.org/anything"]) == "base_url_plugin"
+        assert routed(["http://www.journals.org/closed/article/1"]) is None
+        
+        # sub-domain rules are confirmed by the plugin
+        assert routed(["http://www.a.format.com/articles/1"]) == "format_plugin"
+        assert routed(["http://www.a.format.com/about"]) is None
+        
+        # plugins which can't be routed to by url are still asked
+        assert routed(["http://dynamic.org"]) == "dynamic_plugin"
+        
+        # and priority is respected when more than one plugin supports the record
+        assert routed(["http://dynamic.org", "http://www.other.org/1", "http://b.format.com/articles/2"]) == "format_plugin"
+        assert routed(["http://dynamic.org", "http://www.other.org/1"]) == "base_url_plugin"
+    
+    def test_10a_license_detect_dispatch_as_supports(self):
+        # the dispatch table chooses the same plugin as asking each plugin in turn whether it
+        # supports the record, for every base url of the real plugins and the ways they may
+        # be written in provider records
+        plugin.PluginFactory.load_from_directory()
+        plugins = plugin.PluginFactory.PLUGIN_CONFIG["license_detect"]
+        
+        def asked(urls):
+            for p in plugins:
+                if p.supports({"url" : urls}):
+                    return p
+            return None
+        
+        urls = ["http://gut.bmj.com/content/1", "http://nar.oxfordjournals.org/content/1", "http://jcn.sagepub.com/content/1"]
+        for p in plugins:
+            for bu in p._base_urls:
+                cleaned = p.clean_url(bu)
+                urls += [
+                    "http://" + cleaned, "https://www." + cleaned, "http://" + cleaned + ":80/article/1",
+                    "http://" + cleaned.rstrip("/") + "/article/1", "http://" + cleaned + ".mirror.org/article/1"
+                ]
         
+        for url in urls:
+            expected = asked([url])
+            assert expected is not None, url
+            assert plugin.PluginFactory.license_detect({"url" : [url]}) is expected, url
+    
+    def test_11_statement_matcher(self):
+        stripped = []
+        def strip(s):
+            stripped.append(s)
+            return old_strip(s)
+        old_strip = normalise.strip_html
+        normalise.strip_html = strip
+        try:
+            p = plugin.Plugin()
+            statements = ["Licensed CC-BY", "", "<b>cc0</b> waiver", "licensed   cc-by"]
+            matcher = plugin.StatementMatcher(statements, p.normalise_string, p.strip_html)
+            
+            # statements are found in the order they were given, and empty ones never match
+            del stripped[:]
+            page = normalise.NormalisedContent("this is licensed cc-by and has a <i>cc0</i> waiver")
+            assert list(matcher.matches(page)) == [0, 2, 3]
+            
+            # the page is only stripped once, however many statements need it
+            list(matcher.matches(page))
+            assert len(stripped) == 1
+            
+            # and not at all if the caller has what it wants before then
+            del stripped[:]
+            for i in matcher.matches(normalise.NormalisedContent("licensed cc-by, cc0 waiver")):
+                break
+            assert i == 0
+            assert len(stripped) == 0
+        finally:
+            normalise.strip_html = old_strip
+        
+        # matchers are compiled once for each list of statements
+        lic_statements = [{s : {"type" : "cc-by"}} for s in statements if s]
+        assert p.statement_matcher(lic_statements) is p.statement_matcher([dict(l) for l in lic_statements])
+        assert p.statement_matcher(lic_statements) is not p.statement_matcher(lic_statements[1:])
+    
+    def test_12_prefix_trie(self):
+        trie = plugin.PrefixTrie()
+        trie.insert("journals.org", 1)
+        trie.insert("journals.org/open", 2)
+        trie.insert("journals.org/open/special", 3)
+        trie.insert("other.org", 4)
+        trie.insert("journals.org", 5)
+        assert len(trie) == 4
         
+        # all the keys which are prefixes of the string, longest first
+        assert trie.prefix_matches("journals.org/open/article/1") == [("journals.org/open", 2), ("journals.org", 5)]
+        assert trie.prefix_matches("journals.org/open/special") == [("journals.org/open/special", 3), ("journals.org/open", 2), ("journals.org", 5)]
+        assert trie.prefix_matches("journals.com") == []
+        assert trie.prefix_matches("") == []
+        
+        assert trie.longest_prefix_match("other.org/about") == ("other.org", 4)
+        assert trie.longest_prefix_match("journals") is None
+    
+    def test_13_description_registry(self):
+        global CONFIG_VERSION
+        described = []
+        def get_description(self, plugin_name):
+            described.append(plugin_name)
+            return old_get_description(self, plugin_name)
+        old_get_description = plugin.Plugin.get_description
+        old_version = models.publisher_config_version
+        plugin.Plugin.get_description = get_description
+        models.publisher_config_version = mock_publisher_config_version
+        try:
+            pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_plugin")
+            plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+            cfg = plugin.PluginFactory.PLUGIN_CONFIG
+            priority_order = list(cfg["all"])
+            
+            names = [d.name for d in plugin.PluginFactory.list_plugins(sort_for_display=True)]
+            assert names == ["canon_plugin", "detect_plugin", "provider_plugin"]
+            
+            # the shared list of plugins keeps its priority order
+            assert cfg["all"] == priority_order
+            
+            # each plugin is only described once, however it is asked for
+            plugin.PluginFactory.list_plugins(sort_for_display=True)
+            plugin.PluginFactory.list_plugins()
+            assert plugin.PluginFactory.description("canon_plugin").name == "canon_plugin"
+            assert sorted(described) == ["canon_plugin", "detect_plugin", "provider_plugin"]
+            
+            # until the publisher configs change
+            CONFIG_VERSION += 1
+            plugin.PluginFactory.description("canon_plugin")
+            assert len(described) == 4
+        finally:
+            plugin.Plugin.get_description = old_get_description
+            models.publisher_config_version = old_version
@@ -26,6 +26,9 @@ def mock_cache(key, record):
     global CACHE
     CACHE[key] = json.loads(record.json())
 
+def mock_cache_error(key, record):
+    raise models.LookupException("unable to cache " + key)
+
 def mock_check_cache_general(key):
     global CACHE
     return models.MessageObject(record=CACHE.get(key))
@@ -64,16 +67,43 @@ def mock_is_stale_false(*args, **kwargs): return False
 
 def mock_null_cache(key): return None
 
+def mock_claim_all(keys): return [True] * len(keys)
+
+def mock_claim_none(keys): return [False] * len(keys)
+
+def mock_claim_all_but_first(keys): return [False] + [True] * (len(keys) - 1)
+
+RELEASED = []
+def mock_release(key):
+    global RELEASED
+    RELEASED.append(key)
+
+def mock_multi(check_cache):
+    # turn one of the single key cache mocks into a mock for check_cache_multi
+    return lambda keys: [check_cache(key) for key in keys]
+
 @classmethod
-def mock_check_archive(cls, key):
+def mock_check_archive(cls, key, fields=None):
     if key == "doi:10.none": return None
     if key == "doi:10.bibjson": return {"title" : "whatever"}
     if key == "doi:10.archived": return {"title" : "archived"}
 
 @classmethod
-def mock_null_archive(cls, key): return None
+def mock_null_archive(cls, key, fields=None): return None
+
+@classmethod
+def mock_check_archive_multi(cls, keys):
+    return [mock_check_archive.__func__(cls, key) for key in keys]
+
+@classmethod
+def mock_null_archive_multi(cls, keys): return [None] * len(keys)
+
+def mock_back_end(record, priority=False): pass
 
-def mock_back_end(record): pass
+BACK_END = []
+def mock_back_end_batch(records, priority=False):
+    global BACK_END
+    BACK_END += records
 
 def mock_is_stale(record):
     return record.record['bibjson']["title"] == "stale"
@@ -104,6 +134,15 @@ class TestWorkflow(TestCase):
         
         self.old_cache = cache.cache
         self.old_check_cache = cache.check_cache
+        self.old_check_cache_multi = cache.check_cache_multi
+        self.old_check_archive = models.Record.check_archive
+        self.old_check_archive_multi = models.Record.check_archive_multi
+        self.old_claim_multi = cache.claim_multi
+        self.old_release = cache.release
+        
+        # by default, every lookup gets to send its records to the back-end
+        cache.claim_multi = mock_claim_all
+        cache.release = mock_release
         
     def tearDown(self):
         global ARCHIVE
@@ -112,11 +151,18 @@ class TestWorkflow(TestCase):
         current_support_request = 0
         del ARCHIVE[:]
         del ERROR[:]
+        del BACK_END[:]
+        del RELEASED[:]
         for key in CACHE.keys():
             del CACHE[key]
             
         cache.cache = self.old_cache
         cache.check_cache = self.old_check_cache
+        cache.check_cache_multi = self.old_check_cache_multi
+        models.Record.check_archive = self.old_check_archive
+        models.Record.check_archive_multi = self.old_check_archive_multi
+        cache.claim_multi = self.old_claim_multi
+        cache.release = self.old_release
             
         
     def test_01_detect_verify_type(self):
@@ -194,6 +240,31 @@ class TestWorkflow(TestCase):
         cache_copy = workflow._check_cache(record)
         assert cache_copy is None
         
+    def test_03a_check_cache_multi(self):
+        cache.check_cache_multi = mock_multi(mock_check_cache)
+        cache.is_stale = mock_is_stale
+        cache.invalidate = mock_invalidate
+        
+        records = [
+            models.MessageObject(record={"identifier" : {"id" : "10.none", "type" : "doi", "canonical" : "doi:10.none"}}),
+            models.MessageObject(record={"identifier" : {"id" : "10.queued", "type" : "doi", "canonical" : "doi:10.queued"}}),
+            models.MessageObject(record={"identifier" : {"id" : "10.bibjson", "type" : "doi", "canonical" : "doi:10.bibjson"}}),
+            models.MessageObject(record={"identifier" : {"id" : "10.stale", "type" : "doi", "canonical" : "doi:10.stale"}})
+        ]
+        cache_copies = workflow._check_cache_multi(records)
+        
+        # results come back in the same order as the records that were asked for
+        assert len(cache_copies) == 4
+        assert cache_copies[0] is None
+        assert cache_copies[1].record['queued']
+        assert cache_copies[2].record["bibjson"]["title"] == "fresh"
+        assert cache_copies[3] is None
+        
+        # a record without a canonical identifier can't be looked up
+        records.append(models.MessageObject(record={"identifier" : {"id" : "10.nocanonical", "type" : "doi"}}))
+        with self.assertRaises(models.LookupException):
+            workflow._check_cache_multi(records)
+    
     def test_04_check_archive(self):
         models.Record.check_archive = mock_check_archive
         
@@ -212,6 +283,28 @@ class TestWorkflow(TestCase):
         
         assert archive_copy.has_key("title")
     
+    def test_04a_check_archive_multi(self):
+        models.Record.check_archive_multi = mock_check_archive_multi
+        old_is_stale = workflow._is_stale
+        workflow._is_stale = mock_is_stale
+        
+        records = [
+            models.MessageObject(record={"identifier" : {"id" : "10.none", "type" : "doi", "canonical" : "doi:10.none"}}),
+            models.MessageObject(record={"identifier" : {"id" : "10.bibjson", "type" : "doi", "canonical" : "doi:10.bibjson"}}),
+            models.MessageObject(record={"identifier" : {"id" : "10.archived", "type" : "doi", "canonical" : "doi:10.archived"}})
+        ]
+        archive_copies = workflow._check_archive_multi(records)
+        workflow._is_stale = old_is_stale
+        
+        # results come back in the same order as the records that were asked for
+        assert len(archive_copies) == 3
+        assert archive_copies[0] is None
+        assert archive_copies[1]["title"] == "whatever"
+        assert archive_copies[2]["title"] == "archived"
+        
+        # nothing to look up, nothing to return
+        assert workflow._check_archive_multi([]) == []
+    
     def test_05_cache_success(self):
         ids = [{"id" : "10.cached"}]
         
@@ -220,6 +313,7 @@ class TestWorkflow(TestCase):
         plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
         
         cache.check_cache = mock_queue_cache
+        cache.check_cache_multi = mock_multi(mock_queue_cache)
         
         # first do a lookup on a queued version
         rs = workflow.lookup(ids)
@@ -231,6 +325,7 @@ class TestWorkflow(TestCase):
         
         # now update the cache mock for the appropriate result
         cache.check_cache = mock_success_cache
+        cache.check_cache_multi = mock_multi(mock_success_cache)
         old_is_stale = workflow._is_stale
         workflow._is_stale = mock_is_stale_false
         
@@ -251,6 +346,7 @@ class TestWorkflow(TestCase):
         global CACHE
         CACHE["doi:10.cached"] = {"error" : "prior error"}
         cache.check_cache = mock_check_cache_general
+        cache.check_cache_multi = mock_multi(mock_check_cache_general)
         
         ids = [{"id" : "10.cached"}]
         rs = workflow.lookup(ids)
@@ -264,7 +360,9 @@ class TestWorkflow(TestCase):
         plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
         
         cache.check_cache = mock_null_cache
+        cache.check_cache_multi = mock_multi(mock_null_cache)
         models.Record.check_archive = mock_check_archive
+        models.Record.check_archive_multi = mock_check_archive_multi
         old_is_stale = workflow._is_stale
         workflow._is_stale = mock_is_stale_false
         
@@ -430,7 +528,9 @@ class TestWorkflow(TestCase):
         pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
         plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
         cache.check_cache = mock_null_cache
+        cache.check_cache_multi = mock_multi(mock_null_cache)
         models.Record.check_archive = mock_null_archive
+        models.Record.check_archive_multi = mock_null_archive_multi
         
         # mock out the cache method to allow us to record
         # calls to it
@@ -440,6 +540,8 @@ class TestWorkflow(TestCase):
         # back end
         old_back_end = workflow._start_back_end
         workflow._start_back_end = mock_back_end
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
         
         # do the lookup
         rs = workflow.lookup(ids)
@@ -457,6 +559,7 @@ class TestWorkflow(TestCase):
         # reset the test cache and reinstate the old back-end
         del CACHE["doi:10.queued"]
         workflow._start_back_end = old_back_end
+        workflow._start_back_end_batch = old_back_end_batch
     
     def test_15_store(self):
         global CACHE
@@ -478,6 +581,8 @@ class TestWorkflow(TestCase):
         assert record["bibjson"]["license"][0]["provenance"]["handler"] == "oag"
         assert record["bibjson"]["license"][0]["provenance"]["handler_version"] == "0.0"
         assert "identifier" in record["bibjson"]
+        assert record["bibjson"]["fresh_until"] > 0
+        assert RELEASED == ["doi:10.1"]
         
         del CACHE['doi:10.1']
         del ARCHIVE[0]
@@ -578,7 +683,7 @@ class TestWorkflow(TestCase):
         cache.cache = mock_cache
         models.Record.store = mock_store
         old_check_archive = workflow._check_archive
-        workflow._check_archive = lambda x: {"license" : [{"title" : "l1"}]}
+        workflow._check_archive = lambda x, fields=None: {"license" : [{"title" : "l1"}]}
         
         # run the chain synchronously
         record = workflow.detect_provider(record)
@@ -645,6 +750,179 @@ class TestWorkflow(TestCase):
         assert "bibjson" in record # should be a basic bibjson object
         assert "license" not in record["bibjson"], record
     
+    def test_21_batch_tasks(self):
+        global CACHE
+        global ARCHIVE
+        
+        cache.cache = mock_cache
+        models.Record.store = mock_store
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_09_1")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        old_check_archive = workflow._check_archive
+        workflow._check_archive = lambda x, fields=None: None
+        
+        # one good record and one which will error in every stage of the chain
+        records = [
+            {'identifier' : {"id" : "10.1", "type" : "doi", "canonical" : "doi:10.1"}, "queued" : True},
+            "whatever"
+        ]
+        
+        # run the batch tasks synchronously
+        records = workflow.detect_provider_batch(records)
+        records = workflow.store_results_batch(records)
+        workflow._check_archive = old_check_archive
+        
+        # the error in the second record must not affect the first
+        assert len(records) == 2
+        assert "error" not in records[0], records[0]
+        assert records[0]["provider"]["url"][0] == "http://provider"
+        assert "error" in records[1]
+        
+        # the good record is cached and archived as with the single record chain
+        assert CACHE.has_key("doi:10.1")
+        assert not CACHE["doi:10.1"].get("queued", False)
+        assert len(ARCHIVE) == 1
+    
+    def test_22_lookup_batches_back_end(self):
+        global BACK_END
+        ids = [{"id" : "10.queued/1"}, {"id" : "10.queued/2"}, {"id" : "10.queued/3"}]
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        cache.check_cache_multi = mock_multi(mock_null_cache)
+        models.Record.check_archive_multi = mock_null_archive_multi
+        cache.cache = mock_cache
+        
+        old_batching = config.BACK_END_BATCHING
+        config.BACK_END_BATCHING = True
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
+        
+        rs = workflow.lookup(ids)
+        
+        workflow._start_back_end_batch = old_back_end_batch
+        config.BACK_END_BATCHING = old_batching
+        
+        # all the records are processing, and were sent to the back-end in one go
+        assert len(rs.processing) == 3
+        assert len(BACK_END) == 3
+        assert [r.id for r in BACK_END] == ["10.queued/1", "10.queued/2", "10.queued/3"]
+    
+    def test_23_lookup_stream(self):
+        ids = [{"id" : "10.new"}, {"id" : "10.queued"}, {"id" : "notanid"}]
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        cache.check_cache_multi = mock_multi(mock_check_cache)
+        models.Record.check_archive_multi = mock_null_archive_multi
+        cache.cache = mock_cache
+        
+        old_batching = config.BACK_END_BATCHING
+        config.BACK_END_BATCHING = True
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
+        
+        stream = list(workflow.lookup_stream(ids))
+        
+        workflow._start_back_end_batch = old_back_end_batch
+        config.BACK_END_BATCHING = old_batching
+        
+        # records come out in the order they are resolved, not the order they were requested
+        assert len(stream) == 3
+        assert stream[0].id == "notanid"
+        assert stream[0].has_error()
+        assert stream[1].id == "10.queued"
+        assert stream[1].queued
+        assert stream[2].id == "10.new"
+        assert stream[2].queued
+        
+        # and each one can be turned into a line of the streamed response
+        rs = models.ResultSet(ids)
+        assert json.loads(rs.json_line(stream[0])).keys() == ["errors"]
+        assert json.loads(rs.json_line(stream[1])).keys() == ["processing"]
+    
+    def test_24_lookup_already_in_flight(self):
+        global CACHE
+        ids = [{"id" : "10.inflight"}]
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        cache.check_cache_multi = mock_multi(mock_null_cache)
+        models.Record.check_archive_multi = mock_null_archive_multi
+        cache.cache = mock_cache
+        cache.claim_multi = mock_claim_none
+        
+        old_batching = config.BACK_END_BATCHING
+        config.BACK_END_BATCHING = True
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
+        
+        rs = workflow.lookup(ids)
+        
+        workflow._start_back_end_batch = old_back_end_batch
+        config.BACK_END_BATCHING = old_batching
+        
+        # the record is reported as processing, but another lookup has it in hand,
+        # so it is neither sent to the back-end nor written to the cache
+        assert len(rs.processing) == 1
+        assert len(BACK_END) == 0
+        assert len(CACHE.keys()) == 0
+    
+    def test_25_lookup_releases_claim_on_error(self):
+        global RELEASED
+        ids = [{"id" : "10.claimed"}]
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        cache.check_cache_multi = mock_multi(mock_null_cache)
+        models.Record.check_archive_multi = mock_null_archive_multi
+        cache.cache = mock_cache_error
+        
+        old_batching = config.BACK_END_BATCHING
+        config.BACK_END_BATCHING = True
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
+        
+        rs = workflow.lookup(ids)
+        
+        workflow._start_back_end_batch = old_back_end_batch
+        config.BACK_END_BATCHING = old_batching
+        
+        # the record could not be queued, so it is reported as an error and the claim
+        # on it is given up, rather than leaving it looking like it is in flight
+        assert len(rs.errors) == 1
+        assert len(BACK_END) == 0
+        assert RELEASED == ["doi:10.claimed"]
+    
+    def test_26_lookup_stream_disconnect(self):
+        ids = [{"id" : "10.inflight"}, {"id" : "10.new"}]
+        
+        pdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins", "test_workflow", "test_14")
+        plugin.PluginFactory.load_from_directory(plugin_dir=pdir)
+        cache.check_cache_multi = mock_multi(mock_null_cache)
+        models.Record.check_archive_multi = mock_null_archive_multi
+        cache.cache = mock_cache
+        cache.claim_multi = mock_claim_all_but_first
+        
+        old_batching = config.BACK_END_BATCHING
+        config.BACK_END_BATCHING = True
+        old_back_end_batch = workflow._start_back_end_batch
+        workflow._start_back_end_batch = mock_back_end_batch
+        
+        # the client goes away after the first record it is sent
+        stream = workflow.lookup_stream(ids)
+        first = stream.next()
+        stream.close()
+        
+        workflow._start_back_end_batch = old_back_end_batch
+        config.BACK_END_BATCHING = old_batching
+        
+        # the record which was claimed by this lookup has still been sent to the back-end
+        assert first.id == "10.inflight"
+        assert first.queued
+        assert [r.id for r in BACK_END] == ["10.new"]
+    
     """
     def test_20_store_error_integration(self):
         # pre-existing error
@@ -81,12 +81,36 @@ def request_wants_json():
         best = True
     return best
         
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def request_wants_ndjson():
+    # only stream when it has been explicitly asked for, so that */* does not count
+    if request.values.get('format','').lower() == 'ndjson':
+        return True
+    if request.values.get('stream','').lower() in ['true', 'yes', '1']:
+        return True
+    return NDJSON_MIMETYPE in [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+        
 def generate_password(length=8):
     chars = string.letters + string.digits
     pw = ''.join(choice(chars) for _ in range(length))
     return pw
 
-def http_stream_get(url):
+def http_stream_get(url, on_chunk=None):
+    """
+    Download the content at the url, a chunk at a time, refusing anything which is larger
+    than MAX_REMOTE_FILE_SIZE or is a PDF.  If the connection times out part way through,
+    the download is resumed from where it got to, up to MAX_CONN_RETRIES times
+    
+    arguments:
+    url -- the url to download
+    on_chunk -- function which is called with each chunk of the content as it arrives.  If
+        it returns False the download is stopped, and the content so far is returned
+    
+    returns:
+    a tuple of the (first) response, the content, and the number of bytes downloaded
+    
+    """
     r = requests.get(url, stream=True, timeout=config.CONN_TIMEOUT)
     r.encoding = 'utf-8'
 
@@ -98,38 +122,87 @@ def http_stream_get(url):
         header_reported_size = 0
 
     if header_reported_size > size_limit:
-        return ''
+        r.connection.close()
+        return r, '', 0
+
+    # byte ranges are of the content as sent, so a download can only be resumed with a
+    # range request if the content was not compressed on the way
+    resumable = r.headers.get("content-encoding", "identity").lower() == "identity"
 
-    downloaded_bytes = 0
-    content = ''
-    chunk_no = 0
+    content = bytearray()
+    resp = r
+    skip = 0
     attempt = 0
     retries = config.MAX_CONN_RETRIES
     while attempt <= retries:
         try:
-            for chunk in r.iter_content(chunk_size=config.HTTP_CHUNK_SIZE):
-                chunk_no += 1
-                downloaded_bytes += len(bytes(chunk))
-
-                if chunk_no == 1:
+            if resp is None:
+                resp, skip = _resume_stream(url, len(content), resumable)
+                if resp is None:
+                    break
+            for chunk in resp.iter_content(chunk_size=config.HTTP_CHUNK_SIZE):
+                if not chunk:  # filter out keep-alive new chunks
+                    continue
+                
+                # drop anything we already have, if the server sent the content again from the start
+                if skip > 0:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                    if not chunk:
+                        continue
+
+                if len(content) == 0:
                     if magic.from_buffer(chunk).startswith('PDF'):
                         raise models.LookupException('File at {0} is a PDF according to the python-magic library. Not allowed!'.format(url))
 
                 # check the size limit again
-                if downloaded_bytes > size_limit:
+                if len(content) + len(chunk) > size_limit:
                     raise models.LookupException('File at {0} is larger than limit of {1}'.format(url, size_limit))
-                if chunk:  # filter out keep-alive new chunks
-                    content += chunk
+                content.extend(chunk)
+                
+                if on_chunk is not None and on_chunk(chunk) is False:
+                    break
             break
 
-        except socket.timeout:
+        except (socket.timeout, requests.exceptions.Timeout, requests.exceptions.ConnectionError):
             attempt += 1
             log.debug('Request to {url} timeout, attempt {attempt}'.format(url=url, attempt=attempt))
+            if resp is not None and resp is not r:
+                resp.connection.close()
+            resp = None
 
         sleep(2 ** attempt)
 
+    if resp is not None and resp is not r:
+        resp.connection.close()
+    r.connection.close()
+    return r, str(content), len(content)
+
+def _resume_stream(url, offset, resumable):
+    """
+    Request the content at the url again, from the given offset if the server supports it
+    
+    returns:
+    a tuple of the response (or None if the server did not send the content) and the number
+    of bytes at the start of the response which have already been downloaded
+    
+    """
+    headers = {}
+    if resumable and offset > 0:
+        headers["Range"] = "bytes={0}-".format(offset)
+    r = requests.get(url, stream=True, timeout=config.CONN_TIMEOUT, headers=headers)
+    if r.status_code == 206 and "Range" in headers:
+        if r.headers.get("content-range", "").startswith("bytes {0}-".format(offset)):
+            return r, 0
+        # not the part we asked for
+        r.connection.close()
+        return None, 0
+    if r.status_code == requests.codes.ok:
+        # the whole content again
+        return r, offset
     r.connection.close()
-    return r, content, downloaded_bytes
+    return None, 0
 
 def http_get(url):
     attempt = 0
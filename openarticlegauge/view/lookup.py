@@ -1,8 +1,8 @@
-from flask import Blueprint, request, make_response, render_template, abort
+from flask import Blueprint, request, make_response, render_template, abort, Response
 
 import json, logging
 
-from openarticlegauge import workflow, config
+from openarticlegauge import workflow, config, models
 from openarticlegauge import util
 
 LOG_FORMAT = '%(asctime)-15s %(message)s'
@@ -17,6 +17,7 @@ blueprint = Blueprint('lookup', __name__)
 @util.jsonp
 def api_lookup(path='',ids=[]):
     givejson = util.request_wants_json()
+    givestream = util.request_wants_ndjson()
     path = path.replace('.json','')
     idlimit = config.LOOKUP_LIMIT
     
@@ -70,6 +71,10 @@ def api_lookup(path='',ids=[]):
     if len(idlist) > idlimit:
         abort(400)
 
+    if idlist and givestream:
+        # write out one line per identifier as soon as we know what has happened to it
+        return Response(_stream_results(idlist, priority), mimetype=util.NDJSON_MIMETYPE)
+
     if idlist:
         results = workflow.lookup(idlist, priority).json()
     else:
@@ -86,3 +91,7 @@ def api_lookup(path='',ids=[]):
         resp.mimetype = "application/json"
         return resp
 
+def _stream_results(idlist, priority):
+    rs = models.ResultSet(idlist)
+    for record in workflow.lookup_stream(idlist, priority):
+        yield rs.json_line(record) + "\n"
@@ -53,8 +53,13 @@ def query(path='Record'):
         else: 
             qs = ''
         for item in request.values:
-            if item not in ['q','source','callback','_'] and isinstance(qs,dict):
+            if item not in ['q','source','callback','_','source_include','source_exclude'] and isinstance(qs,dict):
                 qs[item] = request.values[item]
+        # limit the fields returned for each record, e.g. ?source_include=id,license
+        if isinstance(qs,dict):
+            for item, part in [('source_include', 'include'), ('source_exclude', 'exclude')]:
+                if item in request.values:
+                    qs.setdefault('_source', {})[part] = request.values[item].split(',')
         if 'sort' not in qs and app.config['SEARCH_SORT']:
             qs['sort'] = {app.config['SEARCH_SORT'].rstrip(app.config['FACET_FIELD']) + app.config['FACET_FIELD'] : {"order":app.config.get('SEARCH_SORT_ORDER','asc')}}
         #if app.config['ANONYMOUS_SEARCH_FILTER'] and current_user.is_anonymous():
@@ -58,9 +58,52 @@ def lookup(bibjson_ids, priority=False):
     log.debug("looking up ids: " + str(bibjson_ids))
     rs = models.ResultSet(bibjson_ids)
     
-    # now run through each passed id, and either obtain a cached copy or 
-    # inject it into the asynchronous back-end
-    for bid in bibjson_ids:
+    # records are resolved a batch at a time, so they don't come back in the order 
+    # they were requested.  Put them back in order as we write them into the result set
+    for position, record in sorted(_lookup(bibjson_ids, priority), key=lambda x: x[0]):
+        rs.add_result_record(record)
+    
+    # finish by returning the result set
+    return rs
+
+def lookup_stream(bibjson_ids, priority=False):
+    """
+    Take a list of bibjson id objects, as with lookup, but rather than returning a
+    models.ResultSet once all of them have been dealt with, yield each record as soon
+    as it is known whether it is a result, an error, or waiting to be processed
+    
+    arguments:
+    bibjson_ids -- a list of bibjson id objects with optional type parameter
+    priority -- should the request be placed on the priority queue
+    
+    returns:
+    a generator of OAG record objects, in the order in which they are resolved
+    
+    """
+    log.debug("streaming lookup of ids: " + str(bibjson_ids))
+    for position, record in _lookup(bibjson_ids, priority):
+        yield record
+
+def _lookup(bibjson_ids, priority=False):
+    """
+    Do the work of looking up a list of bibjson id objects, on behalf of lookup and
+    lookup_stream.  Each record is yielded as soon as its state is known, with those
+    found in the cache first, then those found in the archive, and finally those
+    which have been injected into the asynchronous back-end
+    
+    arguments:
+    bibjson_ids -- a list of bibjson id objects with optional type parameter
+    priority -- should the request be placed on the priority queue
+    
+    returns:
+    a generator of tuples of the position of the id in bibjson_ids and the OAG record object for it
+    
+    """
+    # first run through each passed id and work out its type and canonical form.  We
+    # do this for the whole batch up front, so that the cache can be checked for
+    # all of the identifiers in one go
+    records = []
+    for position, bid in enumerate(bibjson_ids):
         # first, create the basic record object
         record = models.MessageObject(bid=bid)
         log.debug("initial record " + str(record))
@@ -79,57 +122,100 @@ def lookup(bibjson_ids, priority=False):
             _canonicalise_identifier(record)
             log.debug("canonicalised record " + str(record))
             
-            # Step 3: check the cache for an existing record
-            cached_copy = _check_cache(record)
-            log.debug("cached record " + str(cached_copy))
+            # Step 2a: without a canonical form we can't go on to look in the cache
+            if record.canonical is None:
+                raise models.LookupException("can't look anything up in the cache without a canonical id")
             
-            # this returns either a valid, returnable copy of the record, or None
-            # if the record is not cached or is stale
-            if cached_copy is not None:
-                if cached_copy.has_error():
-                    raise models.LookupException("identifier has permanent errors - please contact us and let us know: " + cached_copy.error)
-                if cached_copy.queued:
-                    record.queued = True
-                elif cached_copy.has_bibjson():
-                    record.bibjson = cached_copy.bibjson
-                log.debug("loaded from cache " + str(record))
-                try:
-                    record.id = bid['id']
-                    record_bibjson = record.bibjson
-                    for recorded_id in record_bibjson['identifier']:
-                        if recorded_id['canonical'] == record.canonical:
-                            recorded_id['id'] = record.id
-                except KeyError:
-                    log.error('Bibjson ID object {0} does not have an "id" key and is invalid.'.format(bid))
-                rs.add_result_record(record)
-                log.debug(str(bid) + " added to result, continuing ...")
-                continue
-            
-            # Step 4: check the archive for an existing record
-            archived_bibjson = _check_archive(record)
-            log.debug("archived bibjson: " + str(archived_bibjson))
-            
-            # this returns either a valid, returnable copy of the record, or None
-            # if the record is not archived, or is stale
-            if archived_bibjson is not None:
-                record.bibjson = archived_bibjson
-                log.debug("loaded from archive " + str(archived_bibjson))
+        except models.LookupException as e:
+            record.error = _safe_message(e)
+            yield position, record
+            continue
+        
+        records.append((position, bid, record))
+    
+    # Step 3: check the cache for existing copies of all the records, and
+    # deal with any that we find
+    cached_copies = _check_cache_multi([record for position, bid, record in records])
+    uncached = []
+    for (position, bid, record), cached_copy in zip(records, cached_copies):
+        log.debug("cached record " + str(cached_copy))
+        
+        # this is either a valid, returnable copy of the record, or None
+        # if the record is not cached or is stale
+        if cached_copy is None:
+            uncached.append((position, bid, record))
+            continue
+        
+        # trap any lookup errors
+        try:
+            if cached_copy.has_error():
+                raise models.LookupException("identifier has permanent errors - please contact us and let us know: " + cached_copy.error)
+            if cached_copy.queued:
+                record.queued = True
+            elif cached_copy.has_bibjson():
+                record.bibjson = cached_copy.bibjson
+            log.debug("loaded from cache " + str(record))
+            _restore_requested_id(record, bid)
+        except models.LookupException as e:
+            record.error = _safe_message(e)
+        
+        log.debug(str(bid) + " added to result, continuing ...")
+        yield position, record
+    
+    # Step 4: check the archive for existing copies of all the records which
+    # were not found in the cache, and deal with any that we find
+    archived_copies = _check_archive_multi([record for position, bid, record in uncached])
+    unarchived = []
+    for (position, bid, record), archived_bibjson in zip(uncached, archived_copies):
+        log.debug("archived bibjson: " + str(archived_bibjson))
+        
+        # this is either a valid, returnable copy of the record, or None
+        # if the record is not archived, or is stale
+        if archived_bibjson is None:
+            unarchived.append((position, record))
+            continue
+        
+        # trap any lookup errors
+        try:
+            record.bibjson = archived_bibjson
+            log.debug("loaded from archive " + str(archived_bibjson))
 
-                # the record is not in the cache for some reason, so put it there
-                _update_cache(record)
-                log.debug("archived item retrieved, so re-cache it " + str(record))
-                try:
-                    record.id = bid['id']
-                    record_bibjson = record.bibjson
-                    for recorded_id in record_bibjson['identifier']:
-                        if recorded_id['canonical'] == record.canonical:
-                            recorded_id['id'] = record.id
-                except KeyError:
-                    log.error('Bibjson ID object {0} does not have an "id" key and is invalid.'.format(bid))
-                rs.add_result_record(record)
-                log.debug(str(bid) + " added to result, continuing ...")
+            # the record is not in the cache for some reason, so put it there
+            _update_cache(record)
+            log.debug("archived item retrieved, so re-cache it " + str(record))
+            _restore_requested_id(record, bid)
+        except models.LookupException as e:
+            record.error = _safe_message(e)
+        
+        log.debug(str(bid) + " added to result, continuing ...")
+        yield position, record
+    
+    # everything left needs to go to the back-end, but only once.  Another lookup
+    # may have sent the same identifier to the back-end since we checked the cache,
+    # so we claim each record before queueing it, and only the claimant sends it on
+    claims = _claim_for_back_end([record for position, record in unarchived])
+    
+    # nothing is yielded from here on until the claimed records have been sent to the
+    # back-end, so that a consumer which stops early (e.g. a streaming client which
+    # disconnects) can't leave records claimed, or cached as queued, which were never sent
+    back_end = []
+    deferred = []
+    for (position, record), claimed in zip(unarchived, claims):
+        # whether the claim on the record is ours, rather than it being already queued
+        claim_taken = claimed and not record.queued
+        
+        # trap any lookup errors
+        try:
+            # Step 4a: if someone else has already claimed the record, then it
+            # is already on its way through the back-end and we just report it as
+            # queued.  We leave the cache alone, as the claimant may already have
+            # stored the results there
+            if not claimed and not record.queued:
+                record.queued = True
+                log.debug(record.canonical + " is already in flight in the back-end")
+                deferred.append((position, record))
                 continue
-
+            
             # Step 5: we need to check to see if any record we have has already
             # been queued.  In theory, this step is pointless, but we add it
             # in for completeness, and just in case any of the above checks change
@@ -141,32 +227,84 @@ def lookup(bibjson_ids, priority=False):
                 _update_cache(record)
                 log.debug("caching record " + str(record))
                 continue
-                        
+            
             # Step 6: if we get to here, we need to set the state of the record
             # queued, and then cache it.
             record.queued = True
             _update_cache(record)
             log.debug("caching record " + str(record))
             
-            # Step 7: the record needs the licence looked up on it, so we inject
-            # it into the asynchronous lookup workflow
-            _start_back_end(record, priority)
-            
         except models.LookupException as e:
             record.error = _safe_message(e)
+            # the record isn't going to the back-end, so let someone else have it
+            if claim_taken:
+                cache.release(record.canonical)
+            deferred.append((position, record))
+            continue
         
-        # write the resulting record into the result set
-        rs.add_result_record(record)
+        back_end.append((position, record))
+    
+    # Step 7: the records which need the licence looked up on them are injected
+    # into the asynchronous lookup workflow.  This is done before any of the records
+    # claimed above are yielded
+    if len(back_end) > 0:
+        if config.BACK_END_BATCHING:
+            _start_back_end_batch([record for position, record in back_end], priority)
+        else:
+            for position, record in back_end:
+                _start_back_end(record, priority)
     
-    # finish by returning the result set
-    return rs
+    for position, record in deferred + back_end:
+        yield position, record
 
-def _check_archive(record):
+def _claim_for_back_end(records):
+    """
+    claim each of the records which is not already queued, so that no other lookup
+    will send it to the back-end at the same time
+    
+    arguments:
+    records -- a list of OAG record objects, see the module documentation for details
+    
+    returns:
+    a list of the same length as records, with True for each record which has been claimed
+    (or which is already queued, and needs no claim) and False for each which has already
+    been claimed by some other lookup
+    
+    """
+    to_claim = [record.canonical for record in records if not record.queued]
+    claimed = iter(cache.claim_multi(to_claim))
+    return [True if record.queued else claimed.next() for record in records]
+
+def _restore_requested_id(record, bid):
+    """
+    put the id as it was supplied by the client back into the record and the identifier
+    in its bibjson which corresponds to it, as the copy of the record that we retrieved
+    may have been requested with a different form of the id
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    bid -- the bibjson id object supplied by the client
+    
+    """
+    try:
+        record.id = bid['id']
+        record_bibjson = record.bibjson
+        if record_bibjson is None:
+            # queued records have no bibjson to update
+            return
+        for recorded_id in record_bibjson['identifier']:
+            if recorded_id['canonical'] == record.canonical:
+                recorded_id['id'] = record.id
+    except KeyError:
+        log.error('Bibjson ID object {0} does not have an "id" key and is invalid.'.format(bid))
+
+def _check_archive(record, fields=None):
     """
     check the record archive for a copy of the bibjson record
     
     arguments:
     record -- an OAG record object, see the module documentation for details
+    fields -- list of the fields of the bibjson record which are needed.  If omitted, the whole record is retrieved
     
     returns:
     - None if there is nothing for this record in the archive
@@ -178,7 +316,7 @@ def _check_archive(record):
     
     # obtain a copy of the archived bibjson
     log.debug("checking archive for canonical identifier: " + record.canonical)
-    archived_bibjson = models.Record.check_archive(record.canonical)
+    archived_bibjson = models.Record.check_archive(record.canonical, fields=fields)
     
     # if it's not in the archive, return
     if archived_bibjson is None:
@@ -198,6 +336,46 @@ def _check_archive(record):
     log.debug(record.canonical + " is in the archive")
     return archived_bibjson
 
+def _check_archive_multi(records):
+    """
+    check the record archive for copies of the bibjson records for all of the
+    supplied records, in a single request to the archive.  Each archived copy is then
+    subjected to the same stale check as in _check_archive
+    
+    arguments:
+    records -- a list of OAG record objects, see the module documentation for details
+    
+    returns:
+    a list of the same length as records, where each entry is:
+    - None if there is nothing for this record in the archive, or it is stale
+    - a bibjson record if one is found
+    
+    """
+    for record in records:
+        if record.canonical is None:
+            raise models.LookupException("can't look anything up in the archive without a canonical id")
+    
+    if len(records) == 0:
+        return []
+    
+    # obtain copies of the archived bibjson
+    canonicals = [record.canonical for record in records]
+    log.debug("checking archive for canonical identifiers: " + str(canonicals))
+    archived = models.Record.check_archive_multi(canonicals)
+    
+    results = []
+    for canonical, archived_bibjson in zip(canonicals, archived):
+        if archived_bibjson is None:
+            log.debug(canonical + " is not in the archive")
+            results.append(None)
+        elif _is_stale(models.MessageObject(bibjson=archived_bibjson)):
+            log.debug(canonical + " is in the archive, but is stale")
+            results.append(None)
+        else:
+            log.debug(canonical + " is in the archive")
+            results.append(archived_bibjson)
+    return results
+
 def _update_cache(record):
     """
     update the cache, and reset the timeout on the cached item
@@ -256,7 +434,45 @@ def _check_cache(record):
     
     log.debug("checking cache for key: " + record.canonical)
     cached_copy = cache.check_cache(record.canonical)
+    return _classify_cached_copy(record, cached_copy)
+
+def _check_cache_multi(records):
+    """
+    check the live local cache for copies of all of the supplied objects in a single
+    request to the cache.  Each cached copy is then subjected to the same checks as
+    in _check_cache
+    
+    arguments:
+    records -- a list of OAG record objects, see the module documentation for details
+    
+    returns:
+    a list of the same length as records, where each entry is:
+    - None if nothing in the cache or the cached record is found to be stale
+    - OAG record object if one is found
+    
+    """
+    for record in records:
+        if record.canonical is None:
+            raise models.LookupException("can't look anything up in the cache without a canonical id")
     
+    keys = [record.canonical for record in records]
+    log.debug("checking cache for keys: " + str(keys))
+    cached_copies = cache.check_cache_multi(keys)
+    return [_classify_cached_copy(record, cached_copy) for record, cached_copy in zip(records, cached_copies)]
+
+def _classify_cached_copy(record, cached_copy):
+    """
+    decide whether the copy of the record retrieved from the cache can be used
+    
+    arguments:
+    record -- an OAG record object, see the module documentation for details
+    cached_copy -- the OAG record object retrieved from the cache for that record, or None
+    
+    returns:
+    - None if there is no cached copy or the cached record is found to be stale
+    - the cached copy otherwise
+    
+    """
     # if it's not in the cache, then return
     if cached_copy is None:
         log.debug(record.canonical + " not found in cache")
@@ -357,6 +573,38 @@ def _start_back_end(record, priority=False):
         r = ch.apply_async()
         return r
 
+def _start_back_end_batch(records, priority=False):
+    """
+    kick off the asynchronous licence lookup process for a list of records.  The records
+    are split into batches of config.BACK_END_BATCH_SIZE, and each batch is sent through
+    a single chain of batch tasks, rather than each record having its own chain.  There
+    is no need for this to return anything, although handles on the asynchronous request
+    objects are provided for convenience of testing
+    
+    arguments:
+    records -- a list of OAG record objects, see the module documentation for details
+    
+    returns:
+    list of AsyncRequest objects from the Celery framework, one per batch
+    
+    """
+    log.debug("injecting " + str(len(records)) + " records into asynchronous batch processing chains")
+    
+    # ask each record to prep itself for injection into the processing chain, as
+    # with _start_back_end
+    chainables = [record.prep_for_backend() for record in records]
+    
+    size = max(config.BACK_END_BATCH_SIZE, 1)
+    results = []
+    for i in range(0, len(chainables), size):
+        batch = chainables[i:i + size]
+        if priority:
+            ch = chain(priority_detect_provider_batch.s(batch), priority_provider_licence_batch.s(), priority_store_results_batch.s())
+        else:
+            ch = chain(detect_provider_batch.s(batch), provider_licence_batch.s(), store_results_batch.s())
+        results.append(ch.apply_async())
+    return results
+
 ############################################################################
 # Utilities
 ############################################################################
@@ -382,6 +630,14 @@ def detect_provider(record_json):
 def priority_detect_provider(record_json):
     return do_detect_provider(record_json)
 
+@celery.task(name="openarticlegauge.workflow.detect_provider_batch")
+def detect_provider_batch(record_jsons):
+    return [do_detect_provider(record_json) for record_json in record_jsons]
+
+@celery.task(name="openarticlegauge.workflow.priority_detect_provider_batch")
+def priority_detect_provider_batch(record_jsons):
+    return [do_detect_provider(record_json) for record_json in record_jsons]
+
 def do_detect_provider(record_json):
     """
     Attempt to detect the provider of the identifier supplied in the record.  This
@@ -442,6 +698,14 @@ def provider_licence(record_json):
 def priority_provider_licence(record_json):
     return do_provider_licence(record_json)
 
+@celery.task(name="openarticlegauge.workflow.provider_licence_batch")
+def provider_licence_batch(record_jsons):
+    return [do_provider_licence(record_json) for record_json in record_jsons]
+
+@celery.task(name="openarticlegauge.workflow.priority_provider_licence_batch")
+def priority_provider_licence_batch(record_jsons):
+    return [do_provider_licence(record_json) for record_json in record_jsons]
+
 def do_provider_licence(record_json):
     """
     Attempt to determine the licence of the record based on the provider information
@@ -527,6 +791,14 @@ def store_results(record_json):
 def priority_store_results(record_json):
     return do_store_results(record_json)
 
+@celery.task(name="openarticlegauge.workflow.store_results_batch")
+def store_results_batch(record_jsons):
+    return [do_store_results(record_json) for record_json in record_jsons]
+
+@celery.task(name="openarticlegauge.workflow.priority_store_results_batch")
+def priority_store_results_batch(record_jsons):
+    return [do_store_results(record_json) for record_json in record_jsons]
+
 def do_store_results(record_json):
     """
     Store the OAG record object in all the appropriate locations:
@@ -594,13 +866,18 @@ def do_store_results(record_json):
             record.queued = False
         
         # Step 2.5: determine if this is already in the archive
-        existing_bibjson = _check_archive(record)
+        # we only need its licences, and what we need to tell if they are stale
+        existing_bibjson = _check_archive(record, fields=["license", "fresh_until"])
         if existing_bibjson is not None:
             # if already archived, then we need to merge the existing licenses with the newly
             # discovered licenses
             log.debug(str(record.identifier) + ": has record in archive; merging")
             record.merge(existing_bibjson)
         
+        # Step 2.75: record when the licences will become stale, so that the cache and
+        # archive checks don't have to work it out every time the record is looked up
+        record.fresh_until = cache.calculate_fresh_until(record)
+        
         # Step 3: update the archive if no errors
         record.add_identifier_to_bibjson()
         if not record.has_error():
@@ -616,6 +893,10 @@ def do_store_results(record_json):
         log.debug(str(record.identifier) + ": storing this item in the cache")
         _update_cache(record)
         
+        # Step 5: the record is no longer in flight, so let it be looked up again
+        # when it becomes stale
+        cache.release(record.canonical)
+        
         # we have to return the record so that the next step in the chain can
         # deal with it (if such a step exists)
         log.debug("yielded result " + str(record))
@@ -21,7 +21,6 @@ setup(
         "beautifulsoup4",
         "nose==1.3.0",
         "setproctitle",
-        "bleach==1.4",
         "python-magic==0.4.6",
 		]
 )